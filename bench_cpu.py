@@ -0,0 +1,106 @@
+"""Benchmark the CPU-bound stages inline and over growing process pools.
+
+    python bench_cpu.py [max workers]
+
+Runs each stage on synthetic data shaped like the real thing (central
+directories of a few hundred entries, __init__.py members, packages'
+filepaths) with CPU_WORKERS = 0 (inline), 1, 2, 4, ... and prints the
+throughput of each, so the scaling across cores shows at a glance.
+"""
+import asyncio
+import io
+import os
+import random
+import sys
+import time
+import zipfile
+
+from cpu_pool import CpuPool
+from lazy_zip import _find_central_directory
+
+WHEELS = 2000
+FILES_PER_WHEEL = 300
+NAMESPACE_JOBS = 2000
+PACKAGES = 20000
+
+
+def _filepaths(rng, package, n):
+    dirs = [package] + [f"{package}/{rng.choice(['core', 'utils', 'io', 'ext'])}{i}" for i in range(n // 10)]
+    filepaths = [f"{rng.choice(dirs)}/{'__init__' if i % 7 == 0 else f'module{i}'}.py" for i in range(n)]
+    return list(dict.fromkeys(filepaths))
+
+
+def _central_directories(rng):
+    result = []
+    for i in range(WHEELS // 20):
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, "w") as zf:
+            for filepath in _filepaths(rng, f"pkg{i}", FILES_PER_WHEEL):
+                zf.writestr(filepath, b"")
+        data = buffer.getvalue()
+        cd_offset, cd_size, concat = _find_central_directory(data, 0)
+        result.append((data[cd_offset:cd_offset + cd_size], concat))
+    # Few distinct ones (building zips is slow), repeated
+    return result * 20
+
+
+def _namespace_members(rng):
+    declaring = b"__path__ = __import__('pkgutil').extend_path(__path__, __name__)\n"
+    filler = b"".join(b"from .module%d import thing%d\n" % (i, i) for i in range(200))
+    return [
+        [(f"pkg{i}/sub{j}/__init__.py", declaring if rng.random() < 0.3 else filler) for j in range(8)]
+        for i in range(NAMESPACE_JOBS)
+    ]
+
+
+def _packages(rng):
+    return [(f"pkg{i}", _filepaths(rng, f"pkg{i}", rng.randint(5, 200))) for i in range(PACKAGES)]
+
+
+async def _gather(fn, jobs):
+    return await asyncio.gather(*(fn(*job) for job in jobs))
+
+
+def bench(workers, central_directories, members, packages):
+    with CpuPool(workers) as cpu:
+        if workers:
+            # Don't count the workers starting up
+            asyncio.run(_gather(cpu.central_directory_names, central_directories[:workers]))
+        timings = {}
+        start = time.perf_counter()
+        asyncio.run(_gather(cpu.central_directory_names, central_directories))
+        timings["central directories/s"] = len(central_directories) / (time.perf_counter() - start)
+
+        start = time.perf_counter()
+        asyncio.run(_gather(cpu.find_explicit_namespaces, [(job,) for job in members]))
+        timings["namespace scans/s"] = len(members) / (time.perf_counter() - start)
+
+        start = time.perf_counter()
+        for _ in cpu.package_prefixes(iter(packages)):
+            pass
+        timings["package prefixes/s"] = len(packages) / (time.perf_counter() - start)
+    return timings
+
+
+def main():
+    max_workers = int(sys.argv[1]) if len(sys.argv) > 1 else os.cpu_count()
+    rng = random.Random(0)
+    central_directories = _central_directories(rng)
+    members = _namespace_members(rng)
+    packages = _packages(rng)
+
+    counts = [0]
+    while counts[-1] < max_workers:
+        counts.append(min(max(1, counts[-1] * 2), max_workers))
+
+    baseline = None
+    for workers in counts:
+        timings = bench(workers, central_directories, members, packages)
+        baseline = baseline or timings
+        print(f"CPU_WORKERS={workers}")
+        for name, rate in timings.items():
+            print(f"  {name:>24}: {rate:10.0f} ({rate / baseline[name]:.2f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+"""Benchmark a full crawl against a local fake PyPI (see fake_pypi.py).
+
+    python bench_offline.py [save]
+
+Starts the fake index/file host, runs main.main in a scratch directory
+against it (index at INDEX_URL, no range cache) and prints packages/s,
+requests and bytes per wheel, SQLite rows/s and the peak RSS of the
+crawling process. With `save` the numbers become the baseline
+(BENCH_BASELINE); otherwise they're compared to it, if there is one.
+
+The shape of the fake PyPI comes from BENCH_PACKAGES, BENCH_FILES_PER_WHEEL,
+BENCH_FILE_SIZE, BENCH_LATENCY_MS, BENCH_THROTTLE_RATE (share of 429s) and
+BENCH_RETRY_AFTER; main's own settings (CONCURRENCY, CPU_WORKERS, ...)
+apply as usual.
+"""
+import contextlib
+import json
+import os
+import resource
+import sqlite3
+import sys
+import tempfile
+import time
+import urllib.request
+
+import fake_pypi
+
+PACKAGES = int(os.getenv("BENCH_PACKAGES", "500"))
+FILES_PER_WHEEL = int(os.getenv("BENCH_FILES_PER_WHEEL", "50"))
+FILE_SIZE = int(os.getenv("BENCH_FILE_SIZE", "2048"))
+LATENCY_MS = float(os.getenv("BENCH_LATENCY_MS", "20"))
+THROTTLE_RATE = float(os.getenv("BENCH_THROTTLE_RATE", "0.01"))
+RETRY_AFTER = int(os.getenv("BENCH_RETRY_AFTER", "0"))
+BASELINE = os.getenv("BENCH_BASELINE", "bench_baseline.json")
+# Higher is better for these, lower for the rest
+HIGHER_IS_BETTER = ("packages/s", "rows/s")
+
+
+def _stats(base_url):
+    with urllib.request.urlopen(f"{base_url}/_stats") as response:
+        return json.load(response)
+
+
+def _rows(db_path):
+    db = sqlite3.connect(db_path)
+    try:
+        return sum(
+            db.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+            for table in ("packages", "filepaths", "namespace_packages", "package_prefixes", "simple_pages")
+        )
+    finally:
+        db.close()
+
+
+def run(base_url):
+    workdir = tempfile.mkdtemp(prefix="bench_offline_")
+    with open(os.path.join(workdir, "packages.txt"), "w") as f:
+        f.writelines(f"pkg{i}\n" for i in range(PACKAGES))
+    os.environ["INDEX_URL"] = f"{base_url}/simple/"
+    os.environ["GH_RELEASES_URL"] = f"{base_url}/gh?page={{page}}"
+    os.environ["RANGE_CACHE"] = ""
+    os.chdir(workdir)
+    # Imported only now, main reads its settings on import
+    import main
+
+    started = time.perf_counter()
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        main.main()
+    elapsed = time.perf_counter() - started
+
+    stats = _stats(base_url)
+    return {
+        "packages/s": PACKAGES / elapsed,
+        "requests/wheel": stats.get("file_requests", 0) / PACKAGES,
+        "bytes/wheel": stats.get("file_bytes", 0) / PACKAGES,
+        "index requests/package": stats.get("index_requests", 0) / PACKAGES,
+        "rows/s": _rows(os.path.join(workdir, "package_database.sqlite")) / elapsed,
+        # KiB on Linux
+        "peak RSS MiB": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "429s": stats.get("throttled", 0),
+    }
+
+
+def main():
+    process, base_url = fake_pypi.start(
+        packages=PACKAGES,
+        files_per_wheel=FILES_PER_WHEEL,
+        file_size=FILE_SIZE,
+        latency=LATENCY_MS / 1000,
+        throttle_rate=THROTTLE_RATE,
+        retry_after=RETRY_AFTER,
+    )
+    baseline_path = os.path.abspath(BASELINE)
+    try:
+        results = run(base_url)
+    finally:
+        process.kill()
+
+    baseline = {}
+    if os.path.exists(baseline_path):
+        with open(baseline_path) as f:
+            baseline = json.load(f)
+    print(f"{PACKAGES} packages, {FILES_PER_WHEEL} files of {FILE_SIZE} bytes, {LATENCY_MS:g}ms latency, "
+          f"{THROTTLE_RATE:.1%} 429s")
+    for name, value in results.items():
+        line = f"  {name:>24}: {value:12.2f}"
+        if name in baseline and baseline[name]:
+            change = value / baseline[name] - 1
+            worse = change < 0 if name in HIGHER_IS_BETTER else change > 0
+            line += f"  ({change:+.1%} vs baseline{', worse' if worse and abs(change) > 0.1 else ''})"
+        print(line)
+    if sys.argv[1:2] == ["save"]:
+        with open(baseline_path, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"saved as the baseline in {baseline_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+"""Compare the text and compact (COMPACT_FILEPATHS) filepath layouts.
+
+    python bench_storage.py [package_database.sqlite]
+
+Loads the packages and filepaths of the given DB (or, without one,
+synthetic packages shaped like PyPI's) into a fresh DB of each layout and
+prints their size after a VACUUM and how long (best of three) a full
+iterate_filepaths() scan and the `__init__.py` owner lookup take on each.
+"""
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+from package_database import PackageDatabase
+
+PACKAGES = 8000
+
+
+def _synthetic_packages(rng):
+    shared = [f"{ns}/__init__.py" for ns in ("google", "azure", "zope", "jaraco", "sphinxcontrib")]
+    for i in range(PACKAGES):
+        name = f"package{i}"
+        dirs = [name] + [f"{name}/{rng.choice(['core', 'utils', '_vendor/six', 'ext', 'tests'])}{j}" for j in range(rng.randint(0, 30))]
+        filepaths = {f"{d}/__init__.py" for d in dirs}
+        filepaths.update(f"{rng.choice(dirs)}/module{j}.py" for j in range(rng.randint(1, 300)))
+        if rng.random() < 0.05:
+            filepaths.add(rng.choice(shared))
+        yield name, sorted(filepaths)
+
+
+def _packages_from(db_path):
+    db = sqlite3.connect(db_path)
+    rows = db.execute("SELECT package_name, filepath FROM filepaths ORDER BY package_name")
+    package, filepaths = None, []
+    for package_name, filepath in rows:
+        if package_name != package and filepaths:
+            yield package, filepaths
+            filepaths = []
+        package = package_name
+        filepaths.append(filepath)
+    if filepaths:
+        yield package, filepaths
+
+
+def _load(db_path, compact, packages):
+    db = PackageDatabase(db_path, compact=compact)
+    db.create_tables()
+    started = time.perf_counter()
+    with db.writer():
+        for pos, (package, filepaths) in enumerate(packages):
+            db.insert_package(package, "1.0", f"https://example.invalid/{package}.whl", pos, filepaths)
+    load_time = time.perf_counter() - started
+    db.close()
+    with sqlite3.connect(db_path) as conn:
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    conn = sqlite3.connect(db_path)
+    conn.execute("VACUUM")
+    conn.close()
+    return load_time
+
+
+def _best_of(fn, runs=3):
+    """Return fn()'s result and its best time over runs."""
+    best = None
+    for _ in range(runs):
+        started = time.perf_counter()
+        result = fn()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return result, best
+
+
+def _scan(db_path, compact):
+    db = PackageDatabase(db_path, compact=compact)
+    db.create_tables()
+    files, scan_time = _best_of(lambda: sum(len(filepaths) for _, filepaths in db.iterate_filepaths()))
+    owners, owners_time = _best_of(lambda: len(db.get_dunder_init_owners()))
+    db.close()
+    return files, scan_time, owners, owners_time
+
+
+def main():
+    if len(sys.argv) > 1:
+        packages = list(_packages_from(sys.argv[1]))
+    else:
+        packages = list(_synthetic_packages(random.Random(0)))
+    print(f"{len(packages)} packages, {sum(len(f) for _, f in packages)} filepaths")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        results = {}
+        for compact in (False, True):
+            db_path = os.path.join(tmp, f"{'compact' if compact else 'text'}.sqlite")
+            load_time = _load(db_path, compact, packages)
+            files, scan_time, owners, owners_time = _scan(db_path, compact)
+            results[compact] = (os.path.getsize(db_path), scan_time, owners_time)
+            print(
+                f"{'compact' if compact else 'text':>8}: {os.path.getsize(db_path) / 2 ** 20:8.1f} MiB, "
+                f"load {load_time:6.2f}s, scan of {files} files {scan_time:6.2f}s, "
+                f"{owners} __init__.py owners {owners_time:6.2f}s"
+            )
+        (size, scan, owners), (compact_size, compact_scan, compact_owners) = results[False], results[True]
+        print(
+            f"compact/text: size {compact_size / size:.2f}x, scan {compact_scan / scan:.2f}x, "
+            f"owners {compact_owners / owners:.2f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,316 @@
+"""Round-trip checks of the binary formats read and written by hand.
+
+    python check_formats.py
+
+- export.py: a synthetic DB is exported, every lookup through the mmapped
+  MappingFile must match resolver.py's, the writer must be deterministic,
+  and a delta between two exports must apply back to the new one, byte for
+  byte. Corrupt files and mismatched deltas must be refused. The restart
+  interval is varied, so the binary search lands on every kind of boundary.
+- tar_stream.TarGzScanner: the members picked out of a generated .tar.gz
+  (long GNU and pax names, skipped members larger than a decompressed
+  chunk, several gzip members) fed in chunks of every size must be the
+  ones tarfile reads.
+- lazy_zip._parse_multipart_byteranges: parts whose data looks like the
+  delimiter or a header end must come back whole, and truncated bodies or
+  parts without a Content-Range must raise BadZipFile.
+"""
+import gzip
+import io
+import os
+import random
+import shutil
+import sys
+import tarfile
+import tempfile
+from zipfile import BadZipFile
+
+import export
+from lazy_zip import _parse_multipart_byteranges
+from package_database import PackageDatabase
+from resolver import Resolver
+from tar_stream import MAX_INFLATE, TarGzScanner
+
+PACKAGES = 300
+
+
+def _packages(version):
+    """Return [(package, package_pos, prefixes, namespace `__init__.py`s)].
+
+    Version 2 drops some packages, adds others, reranks a few and changes
+    some prefixes, which is what a delta has to carry."""
+    packages = []
+    for i in range(PACKAGES + (version - 1) * 20):
+        if version == 2 and i % 37 == 0:
+            continue
+        package_pos = i + 1 if version == 1 or i % 11 else PACKAGES * 2 - i
+        prefixes = [f"pkg{i}"]
+        if i % 3 == 0:
+            prefixes.append(f"pkg{i}/sub{i % 5}")
+        if version == 2 and i % 13 == 0:
+            prefixes.append(f"pkg{i}/added")
+        packages.append((f"pkg-{i}", package_pos, prefixes, []))
+    for j, name in enumerate(("storage", "bigquery", "pubsub", "storage_transfer")):
+        packages.append((
+            f"google-cloud-{name}", 10 + j, [f"google/cloud/{name}"],
+            ["google/__init__.py", "google/cloud/__init__.py"],
+        ))
+    packages += [
+        # A package claiming a namespace's top level must not match below it
+        ("google-shim", 5, ["google"], []),
+        ("protobuf", 2, ["google/protobuf"], []),
+        ("azure-mgmt-compute", 40, ["azure/mgmt/compute"], []),
+        ("azure-mgmt-network", 41, ["azure/mgmt/network"], []),
+        # Not importable, so not exported
+        ("data-files", 50, ["0data", "data-files.data/scripts"], []),
+        # Non-ASCII keys sort by UTF-8 bytes in the file
+        ("cafe", 60, ["café", "caff", "cafè"], []),
+    ]
+    if version == 2:
+        packages.append(("google-cloud-tasks", 14, ["google/cloud/tasks"], ["google/cloud/__init__.py"]))
+    return packages
+
+
+def build(db_path, version):
+    db = PackageDatabase(db_path)
+    db.create_tables()
+    with db.writer():
+        for package, package_pos, prefixes, namespaces in _packages(version):
+            filepaths = [f"{prefix}/__init__.py" for prefix in prefixes] + namespaces
+            db.insert_package(package, "1.0", f"https://files.example/{package}-1.0-py3-none-any.whl", package_pos, filepaths)
+            for filepath in namespaces:
+                db.check_and_store_namespace_package(package, filepath, True)
+            db.insert_package_prefixes(package, prefixes)
+    return db
+
+
+def _queries(keys):
+    queries = {"", "nothing", "zzzz", "google.foo", "google.cloud.foo.bar", "azure", "azure.mgmt"}
+    for key in keys:
+        parts = key.split(".")
+        queries.update(".".join(parts[:depth]) for depth in range(1, len(parts) + 1))
+        queries.update((key + ".child", key + "_", key[:-1], key + "\x00"))
+    queries.discard("")
+    return sorted(queries)
+
+
+def check(name, ok, detail=""):
+    print(f"  {'ok  ' if ok else 'FAIL'} {name}")
+    if not ok and detail:
+        print("       " + str(detail).replace("\n", "\n       "))
+    return ok
+
+
+def check_export(workdir):
+    ok = True
+    paths = {}
+    for version in (1, 2):
+        db = build(os.path.join(workdir, f"v{version}.sqlite"), version)
+        try:
+            entries, positions = export.mapping_from_database(db)
+            resolver = Resolver.from_database(db)
+        finally:
+            db.close()
+        paths[version] = path = os.path.join(workdir, f"v{version}.bin")
+        export.write(path, entries, positions)
+        with open(path, "rb") as f:
+            data = f.read()
+        export.write(path + ".again", entries, positions)
+        with open(path + ".again", "rb") as f:
+            ok &= check(f"v{version}: the same mapping gives the same bytes", f.read() == data)
+
+        queries = _queries(entries)
+        for restart_interval in (1, 2, 3, export.RESTART_INTERVAL, len(entries) + 1):
+            interval_path = f"{path}.{restart_interval}"
+            export.write(interval_path, entries, positions, restart_interval)
+            with export.MappingFile(interval_path) as mapping:
+                mapping.verify()
+                label = f"v{version}, restart interval {restart_interval}"
+                items = {module: (namespace, set(packages)) for module, namespace, packages in mapping.items()}
+                ok &= check(f"{label}: items() is the mapping", items == entries)
+                found = {key: mapping.get(key) for key in queries}
+                wrong = [
+                    key for key, entry in found.items()
+                    if (entry and (entry[0], set(entry[1]))) != entries.get(key)
+                ]
+                ok &= check(f"{label}: get() finds exactly the exported keys", not wrong, wrong[:5])
+                wrong = [
+                    (key, mapping.resolve(key), resolver.resolve(key))
+                    for key in queries if mapping.resolve(key) != resolver.resolve(key)
+                ]
+                ok &= check(f"{label}: resolve() matches resolver.py ({len(queries)} names)", not wrong, "\n".join(map(str, wrong[:5])))
+                ok &= check(f"{label}: positions()", mapping.positions() == positions)
+
+        # Prefix compression only stores what a key doesn't share with the
+        # previous one, and a restart point after every entry undoes it
+        with export.MappingFile(path) as compressed, export.MappingFile(f"{path}.1") as uncompressed:
+            ok &= check(f"v{version}: prefix compression shrinks the entries",
+                        compressed._restarts - compressed._entries < uncompressed._restarts - uncompressed._entries)
+
+    delta_path = os.path.join(workdir, "v1-v2.delta")
+    applied_path = os.path.join(workdir, "v2.applied.bin")
+    export.write_delta(paths[1], paths[2], delta_path)
+    export.apply_delta(paths[1], delta_path, applied_path)
+    with open(paths[2], "rb") as new, open(applied_path, "rb") as applied:
+        ok &= check("apply(v1, delta(v1, v2)) is v2, byte for byte", new.read() == applied.read())
+    ok &= check("the delta is smaller than v2", os.path.getsize(delta_path) < os.path.getsize(paths[2]))
+
+    try:
+        export.apply_delta(paths[2], delta_path, os.path.join(workdir, "wrong.bin"))
+    except ValueError:
+        refused = True
+    else:
+        refused = False
+    ok &= check("a delta doesn't apply to another export", refused)
+
+    corrupt_path = os.path.join(workdir, "corrupt.bin")
+    shutil.copy(paths[1], corrupt_path)
+    with open(corrupt_path, "r+b") as f:
+        f.seek(-1, os.SEEK_END)
+        last = f.read(1)
+        f.seek(-1, os.SEEK_END)
+        f.write(bytes([last[0] ^ 1]))
+    with export.MappingFile(corrupt_path) as mapping:
+        try:
+            mapping.verify()
+        except ValueError:
+            refused = True
+        else:
+            refused = False
+    ok &= check("verify() refuses a flipped bit", refused)
+
+    for name, offset, value in (("magic", 0, b"X"), ("version", 8, bytes([export.VERSION + 1]))):
+        shutil.copy(paths[1], corrupt_path)
+        with open(corrupt_path, "r+b") as f:
+            f.seek(offset)
+            f.write(value)
+        try:
+            export.MappingFile(corrupt_path).close()
+        except ValueError:
+            refused = True
+        else:
+            refused = False
+        ok &= check(f"a bad header {name} is refused", refused)
+    return ok
+
+
+def _tar_gz(members, tar_format, split_at=None):
+    """Return a .tar.gz of members ({name: content}) and a directory, as
+    two gzip members if split_at is given."""
+    raw = io.BytesIO()
+    with tarfile.open(fileobj=raw, mode="w", format=tar_format) as tar:
+        for name, content in members.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(content)
+            tar.addfile(info, io.BytesIO(content))
+        directory = tarfile.TarInfo("pkg-1.0/empty_dir")
+        directory.type = tarfile.DIRTYPE
+        tar.addfile(directory)
+    data = raw.getvalue()
+    if split_at is None:
+        return gzip.compress(data)
+    return gzip.compress(data[:split_at]) + gzip.compress(data[split_at:])
+
+
+def check_tar_stream():
+    ok = True
+    long_name = "pkg-1.0/" + "deep/" * 30 + "__init__.py"
+    members = {
+        "pkg-1.0/PKG-INFO": b"Metadata-Version: 2.1\nName: pkg\n",
+        # Larger than what's inflated at once, and skipped
+        "pkg-1.0/data.bin": random.Random(0).randbytes(3 * MAX_INFLATE + 17),
+        "pkg-1.0/pkg/__init__.py": b"",
+        long_name: b"__path__ = __import__('pkgutil').extend_path(__path__, __name__)\n",
+        "pkg-1.0/pkg/été.py": b"x = 1\n" * 200,
+        "pkg-1.0/pkg/big.py": b"# padding\n" * MAX_INFLATE,
+    }
+    wanted = {"pkg-1.0/PKG-INFO", long_name, "pkg-1.0/pkg/été.py", "pkg-1.0/pkg/big.py", "pkg-1.0/pkg/__init__.py"}
+    expected = {name: members[name] for name in wanted}
+    archives = {
+        "pax": _tar_gz(members, tarfile.PAX_FORMAT),
+        "pax, two gzip members": _tar_gz(members, tarfile.PAX_FORMAT, split_at=3 * tarfile.BLOCKSIZE + 100),
+        "gnu": _tar_gz(members, tarfile.GNU_FORMAT),
+    }
+    for label, archive in archives.items():
+        with tarfile.open(fileobj=io.BytesIO(archive), mode="r:gz") as tar:
+            read = {name: tar.extractfile(name).read() for name in wanted}
+        ok &= check(f"{label}: tarfile reads the members back", read == expected)
+        for chunk_size in (1, 7, 512, 4096, len(archive)):
+            scanner = TarGzScanner(wanted)
+            found = []
+            fed = 0
+            while fed < len(archive) and not scanner.done:
+                found.extend(scanner.feed(archive[fed:fed + chunk_size]))
+                fed += chunk_size
+            ok &= check(f"{label}, {chunk_size} byte chunks: every wanted member, once",
+                        scanner.done and not scanner.missing and len(found) == len(wanted) and dict(found) == expected)
+
+        scanner = TarGzScanner(wanted | {"pkg-1.0/missing.py"})
+        found = scanner.feed(archive)
+        ok &= check(f"{label}: a missing member ends the scan at the end of the archive",
+                    scanner.done and scanner.missing == {"pkg-1.0/missing.py"} and dict(found) == expected)
+    return ok
+
+
+def _multipart(parts, boundary, content_range=b"Content-Range"):
+    body = bytearray()
+    for start, data, total in parts:
+        body += b"\r\n--" + boundary + b"\r\n"
+        body += b"Content-Type: application/zip\r\n"
+        body += content_range + f": bytes {start}-{start + len(data) - 1}/{total}\r\n\r\n".encode()
+        body += data
+    body += b"\r\n--" + boundary + b"--\r\n"
+    return bytes(body)
+
+
+def check_multipart():
+    ok = True
+    boundary = b"3d6b6a416f9b5"
+    parts = [
+        (0, b"PK\x03\x04" + os.urandom(100), 10_000),
+        # Data that looks like the delimiter, a header end and the final delimiter
+        (500, b"--" + boundary + b"\r\n\r\nContent-Range: bytes 0-0/1\r\n\r\n--" + boundary + b"--", 10_000),
+        (9_000, b"\r\n\r\n", 10_000),
+        (9_999, b"x", 10_000),
+    ]
+    body = _multipart(parts, boundary)
+    parsed = [(start, bytes(data)) for start, data in _parse_multipart_byteranges(body, boundary)]
+    ok &= check("every part, whole", parsed == [(start, data) for start, data, _ in parts])
+
+    preamble = b"This is a multipart message.\r\n" + body
+    parsed = [(start, bytes(data)) for start, data in _parse_multipart_byteranges(preamble, boundary)]
+    ok &= check("a preamble is skipped", parsed == [(start, data) for start, data, _ in parts])
+
+    lower = _multipart(parts, boundary, b"content-range")
+    parsed = [(start, bytes(data)) for start, data in _parse_multipart_byteranges(lower, boundary)]
+    ok &= check("header names are case-insensitive", parsed == [(start, data) for start, data, _ in parts])
+
+    for name, broken in (
+        ("a truncated part's headers", body[:body.index(b"\r\n\r\n", body.index(b"Content-Range")) - 3]),
+        ("a part without Content-Range", body.replace(b"Content-Range: bytes 9000", b"X-Range: bytes 9000")),
+    ):
+        try:
+            list(_parse_multipart_byteranges(broken, boundary))
+        except BadZipFile:
+            refused = True
+        else:
+            refused = False
+        ok &= check(f"{name} raises BadZipFile", refused)
+    return ok
+
+
+def main():
+    ok = True
+    with tempfile.TemporaryDirectory() as workdir:
+        print("export")
+        ok &= check_export(workdir)
+    print("tar_stream")
+    ok &= check_tar_stream()
+    print("multipart/byteranges")
+    ok &= check_multipart()
+    if not ok:
+        sys.exit("format regression, see above")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,178 @@
+"""Check the query plans of a run against a synthetic DB.
+
+    python check_query_plans.py [filepath rows]
+
+Builds a throwaway DB per filepaths layout with about a million filepaths
+(by default), some `__init__.py`s shared by several packages and namespace
+results for a few of them, then runs the lookups a crawl makes (missing
+packages, package states, the pipeline's seed, the namespace prune, the
+prefix stage's journal and filepaths) and the statements of re-storing a
+package. It fails unless SQLite plans them as lookups: temp tables driving
+the joins, then index searches, and no full scan of a table that grows
+with the crawl where a search would do. No ANALYZE is run, like on the
+crawled DB.
+"""
+import os
+import sys
+import tempfile
+import time
+
+from package_database import PackageDatabase
+
+FILES_PER_PACKAGE = 10
+# One package in this many has a `__init__.py` shared with others
+DUPLICATE_EVERY = 10
+# And one in this many has a namespace result for its own `__init__.py`,
+# as if it had been shared until a re-crawl (what the prune drops)
+CHECKED_EVERY = 20
+
+
+def _filepaths(i):
+    name = f"pkg{i}"
+    filepaths = [f"{name}/__init__.py"] + [f"{name}/module{j}.py" for j in range(FILES_PER_PACKAGE - 2)]
+    if i % DUPLICATE_EVERY == 0:
+        filepaths.append(f"shared{i // DUPLICATE_EVERY % 50}/__init__.py")
+    else:
+        filepaths.append(f"{name}/extra.py")
+    return filepaths
+
+
+def build(db_path, rows, compact):
+    db = PackageDatabase(db_path, compact=compact)
+    db.create_tables()
+    packages = rows // FILES_PER_PACKAGE
+    with db.writer(batch_rows=100_000):
+        for i in range(packages):
+            name = f"pkg{i}"
+            filepaths = _filepaths(i)
+            db.insert_package(name, "1.0", f"https://files.example/{name}-1.0-py3-none-any.whl", i + 1, filepaths)
+            if i % DUPLICATE_EVERY == 0:
+                db.check_and_store_namespace_package(name, filepaths[-1], True)
+            if i % CHECKED_EVERY == 1:
+                db.check_and_store_namespace_package(name, filepaths[0], False)
+            db.insert_package_prefixes(name, [name])
+    return db, packages
+
+
+def plans(db, calls):
+    """Run calls() and return (sql, plan lines) of every SELECT it made."""
+    connection = db._reader_connection()
+    statements = []
+    connection.set_trace_callback(statements.append)
+    try:
+        calls()
+    finally:
+        connection.set_trace_callback(None)
+    return [
+        (sql, [row[3] for row in connection.execute(f"EXPLAIN QUERY PLAN {sql}")])
+        for sql in statements
+        if sql.lstrip().upper().startswith("SELECT")
+    ]
+
+
+def write_plans(db, calls):
+    """Run calls() with db's writes kept instead of made, and return (sql,
+    plan lines) of every statement they would have run."""
+    units = []
+    db._write = units.append
+    try:
+        calls()
+    finally:
+        del db._write
+    connection = db._reader_connection()
+    return [
+        (" ".join(sql.split()), [row[3] for row in connection.execute(f"EXPLAIN QUERY PLAN {sql}", params[0])])
+        for unit in units
+        for sql, params in unit
+        if params
+    ]
+
+
+def check(name, plan, required, forbidden):
+    text = "\n".join(plan)
+    missing = [pattern for pattern in required if pattern not in text]
+    # "SCAN d" is a scan of d, not of dup
+    present = [pattern for pattern in forbidden if any(line == pattern or line.startswith(pattern + " ") for line in plan)]
+    ok = not missing and not present
+    print(f"  {'ok  ' if ok else 'FAIL'} {name}")
+    if not ok:
+        print("       " + text.replace("\n", "\n       "))
+        for pattern in missing:
+            print(f"       missing: {pattern}")
+        for pattern in present:
+            print(f"       unexpected: {pattern}")
+    return ok
+
+
+def check_layout(db, packages, compact):
+    ok = True
+    wanted = [f"pkg{i}" for i in range(0, packages * 2, 997)]
+
+    (_, plan), = plans(db, lambda: db.get_missing_packages(wanted))
+    ok &= check("get_missing_packages", plan,
+                ["SCAN w", "SEARCH p USING"], ["SCAN p", "SCAN packages"])
+
+    (_, plan), = plans(db, lambda: db.get_package_states(wanted))
+    ok &= check("get_package_states", plan,
+                ["SCAN w", "SEARCH p USING", "SEARCH s USING"], ["SCAN p", "SCAN s"])
+
+    # Reads every `__init__.py` once, so dunder_init_counts is scanned, but
+    # each owner is found through the indexes
+    plan = [line for _, lines in plans(db, db.get_dunder_init_owners) for line in lines]
+    if compact:
+        required = ["SCAN c", "SEARCH d USING", "SEARCH fi USING", "SEARCH f USING", "SEARCH p USING"]
+        forbidden = ["SCAN fi", "SCAN files", "SCAN d", "SCAN f", "SCAN p"]
+    else:
+        required = ["SCAN c", "SEARCH f USING INDEX idx_filepaths_filepath", "SEARCH p USING"]
+        forbidden = ["SCAN f", "SCAN filepaths", "SCAN p"]
+    ok &= check("get_dunder_init_owners", plan, required, forbidden)
+
+    (_, plan), = plans(db, db.prune_namespace_packages)
+    ok &= check("prune_namespace_packages", plan,
+                ["SCAN np", "SEARCH c USING"], ["SCAN c", "SCAN dunder_init_counts"])
+
+    for name, call in (
+        ("get_open_units", lambda: db.get_open_units("prefixes")),
+        ("stage_finished", lambda: db.stage_finished("namespace")),
+    ):
+        (_, plan), = plans(db, call)
+        ok &= check(name, plan, ["idx_stage_progress_open"], ["SCAN stage_progress"])
+
+    pending = wanted[:50]
+    plan = [line for _, lines in plans(db, lambda: list(db.iterate_filepaths(packages=pending))) for line in lines]
+    if compact:
+        required = ["SCAN w", "SEARCH pi USING", "SEARCH f USING"]
+        forbidden = ["SCAN f", "SCAN files", "SCAN pi"]
+    else:
+        required = ["SCAN w", "SEARCH f USING", "SEARCH np USING"]
+        forbidden = ["SCAN f", "SCAN filepaths", "SCAN np"]
+    ok &= check("iterate_filepaths (pending packages)", plan, required, forbidden)
+
+    # Re-storing a package with a shared `__init__.py`: every statement is
+    # keyed on it, so none of them may scan a table
+    for sql, plan in write_plans(db, lambda: db.insert_package(
+        "pkg0", "2.0", "https://files.example/pkg0-2.0-py3-none-any.whl", 1, _filepaths(0)
+    )):
+        ok &= check(f"insert_package: {sql[:70]}", plan, [], [
+            line for line in plan if line.startswith("SCAN ")
+        ])
+    return ok
+
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    ok = True
+    with tempfile.TemporaryDirectory() as workdir:
+        for compact in (False, True):
+            started = time.perf_counter()
+            db, packages = build(os.path.join(workdir, f"plans{int(compact)}.sqlite"), rows, compact)
+            print(f"{'compact' if compact else 'plain'} layout, {rows} filepaths "
+                  f"(built in {time.perf_counter() - started:.0f}s)")
+            ok &= check_layout(db, packages, compact)
+            db.close()
+    if not ok:
+        sys.exit("query plan regression, see above")
+
+
+if __name__ == "__main__":
+    main()
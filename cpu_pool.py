@@ -0,0 +1,190 @@
+import asyncio
+import collections
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from imports import scan_file
+from namespaces import find_explicit_namespaces
+from prefixes import package_prefixes
+
+# Jobs handed to a worker in one go, and how long a partial batch waits for more
+BATCH_SIZE = 64
+MAX_DELAY = 0.005
+
+
+def _central_directory_names(batch):
+    # Imported only now, lazy_zip brings in httpx, which no other job needs
+    from lazy_zip import _parse_central_directory
+
+    return [
+        [entry.name for entry in _parse_central_directory(memoryview(data), concat)]
+        for data, concat in batch
+    ]
+
+
+def _explicit_namespaces(batch):
+    return [find_explicit_namespaces(members) for members in batch]
+
+
+def _prefixes(batch):
+    return [package_prefixes(filepaths) for filepaths in batch]
+
+
+def _package_prefixes(batch):
+    return [(package, package_prefixes(filepaths)) for package, filepaths in batch]
+
+
+def _import_scans(batch):
+    results = []
+    for path, digest in batch:
+        try:
+            results.append((path, *scan_file(path, digest)))
+        except OSError:
+            # Gone or unreadable since the walk
+            results.append((path, None, []))
+    return results
+
+
+class _Batcher:
+    """Collects jobs for one worker function and submits them in batches.
+
+    fn takes a list of jobs and returns the list of their results. A batch
+    goes out once it holds batch_size jobs or max_delay after its first
+    job, whichever comes first, so a process round trip (and the pickling
+    overhead) is paid per batch rather than per wheel.
+    """
+
+    def __init__(self, executor, fn, batch_size, max_delay):
+        self._executor = executor
+        self._fn = fn
+        self._batch_size = batch_size
+        self._max_delay = max_delay
+        self._jobs = []
+        self._futures = []
+        self._timer = None
+
+    def submit(self, job):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._jobs.append(job)
+        self._futures.append(future)
+        if len(self._jobs) >= self._batch_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self._max_delay, self._flush)
+        return future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        jobs, futures = self._jobs, self._futures
+        self._jobs, self._futures = [], []
+        if not jobs:
+            return
+        batch = asyncio.get_running_loop().run_in_executor(self._executor, self._fn, jobs)
+        batch.add_done_callback(lambda batch: _resolve(batch, futures))
+
+
+def _resolve(batch, futures):
+    error = None if batch.cancelled() else batch.exception()
+    for i, future in enumerate(futures):
+        if future.done():
+            continue
+        if batch.cancelled():
+            future.cancel()
+        elif error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(batch.result()[i])
+
+
+class CpuPool:
+    """Runs the CPU-bound parts of the pipeline, in a process pool if asked to.
+
+    The network side stays on the event loop; what comes back from it (raw
+    central directory bytes, raw member contents, a package's filepaths)
+    is handed to the worker processes in batches. With workers=0 every
+    call runs inline instead, which is the same work on one core.
+
+        with CpuPool(8) as cpu:
+            names = await cpu.central_directory_names(data, concat)
+    """
+
+    def __init__(self, workers, batch_size=BATCH_SIZE, max_delay=MAX_DELAY):
+        self.workers = workers
+        self._executor = None
+        self._batchers = {}
+        if workers:
+            # Not forked: by the time this runs there are threads (the DB writer) around
+            self._executor = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("spawn"))
+            for fn in (_central_directory_names, _explicit_namespaces, _prefixes):
+                self._batchers[fn] = _Batcher(self._executor, fn, batch_size, max_delay)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    async def _run(self, fn, job):
+        if self._executor is None:
+            return fn([job])[0]
+        return await self._batchers[fn].submit(job)
+
+    async def central_directory_names(self, data, concat=0):
+        """Return the member names of a raw central directory."""
+        return await self._run(_central_directory_names, (data, concat))
+
+    async def find_explicit_namespaces(self, members):
+        """Return the filepaths of the (filepath, raw bytes) members declaring a namespace."""
+        return await self._run(_explicit_namespaces, members)
+
+    async def prefixes(self, filepaths):
+        """Return the package_prefixes of filepaths."""
+        return await self._run(_prefixes, filepaths)
+
+    def package_prefixes(self, packages, batch_size=256):
+        """Yield (package, prefixes) for each (package, filepaths) of packages."""
+        return self._map(_package_prefixes, packages, batch_size)
+
+    def scan_imports(self, files, batch_size=64):
+        """Yield (path, digest, imports) for each (path, digest) of files,
+        imports being None when the file's content still has that digest
+        (see imports.scan_file)."""
+        return self._map(_import_scans, files, batch_size)
+
+    def _map(self, fn, items, batch_size):
+        """Yield fn's results over items, a batch at a time.
+
+        Results come back in the order of items; with a pool the batches
+        are spread over the workers as they're read, with at most two per
+        worker in flight (Executor.map would read all of them up front).
+        """
+        if self._executor is None:
+            for batch in _batched(items, batch_size):
+                yield from fn(batch)
+            return
+        pending = collections.deque()
+        for batch in _batched(items, batch_size):
+            pending.append(self._executor.submit(fn, batch))
+            if len(pending) >= 2 * self.workers:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+
+def _batched(items, n):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == n:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
@@ -0,0 +1,349 @@
+"""A read-only, memory-mappable export of the prefix -> packages mapping.
+
+    python export.py [package_database.sqlite] [package_mapping.bin]
+    python export.py delta old.bin new.bin delta.bin
+    python export.py apply old.bin delta.bin new.bin
+
+Clients that only look modules up don't need the DB: MappingFile mmaps an
+export and binary-searches it in place, without reading it at startup.
+A delta between two exports turns the old one into the new one, byte for
+byte (the writer is deterministic and the result's digest is checked).
+
+Layout (little-endian), after an 80 byte header (HEADER):
+- package names: package_count + 1 u32 offsets, then the UTF-8 names.
+  Package ids are ranks: packages are numbered by (package_pos, name)
+- package_pos: package_count u32
+- entries, sorted by their UTF-8 dotted module name, each one being
+  varint shared prefix length (with the previous key), varint suffix
+  length, suffix, flags byte (FLAG_NAMESPACE), varint count, then that
+  many package ids as varint deltas (smallest, i.e. best ranked, first)
+- restart points: restart_count u32 entry offsets. Every restart_interval
+  entries the shared prefix length is 0, so a key can be read there
+  without what comes before it; lookups binary-search the restart points
+  and scan at most restart_interval entries
+The header's digest is the blake2b (16 bytes) of everything after it.
+"""
+import hashlib
+import json
+import mmap
+import struct
+import sys
+import zlib
+
+from package_database import PackageDatabase
+from resolver import Resolution, module_parts
+
+MAGIC = b"PYPKGMAP"
+DELTA_MAGIC = b"PYPKGDLT"
+VERSION = 1
+RESTART_INTERVAL = 16
+FLAG_NAMESPACE = 1
+# magic, version, restart_interval, package_count, entry_count, restart_count,
+# reserved, then the offsets of names, package_pos, entries and restart points,
+# and the digest
+HEADER = struct.Struct("<8sIIIIII4Q16s")
+DELTA_HEADER = struct.Struct("<8sI16s16s")
+_U32 = struct.Struct("<I")
+
+
+def _digest(data):
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+
+def _varint(value):
+    out = bytearray()
+    while value >= 0x80:
+        out.append(value & 0x7F | 0x80)
+        value >>= 7
+    out.append(value)
+    return out
+
+
+def _read_varint(buffer, offset):
+    value = shift = 0
+    while True:
+        byte = buffer[offset]
+        offset += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, offset
+        shift += 7
+
+
+def mapping_from_database(db):
+    """Return ({module: (namespace, packages)}, {package: package_pos}) of db."""
+    entries = {}
+    positions = {}
+    for prefix, package, package_pos in db.iterate_ranked_prefixes():
+        parts = module_parts(prefix)
+        if parts is None:
+            continue
+        positions.setdefault(package, package_pos)
+        entries.setdefault(".".join(parts), (False, set()))[1].add(package)
+    for filepath in db.get_namespace_filepaths():
+        parts = module_parts(filepath.rpartition("/")[0])
+        if parts is not None:
+            entries[".".join(parts)] = (True, entries.get(".".join(parts), (False, set()))[1])
+    return entries, positions
+
+
+def write(path, entries, positions, restart_interval=RESTART_INTERVAL):
+    """Write the mapping ({module: (namespace, packages)} and every
+    package's package_pos) to path. The same mapping always gives the
+    same bytes."""
+    packages = sorted(positions, key=lambda package: (positions[package], package))
+    ids = {package: i for i, package in enumerate(packages)}
+
+    body = bytearray()
+    names_offset = HEADER.size
+    encoded = [package.encode() for package in packages]
+    offset = 0
+    for name in encoded:
+        body += _U32.pack(offset)
+        offset += len(name)
+    body += _U32.pack(offset)
+    for name in encoded:
+        body += name
+    positions_offset = HEADER.size + len(body)
+    for package in packages:
+        body += _U32.pack(positions[package])
+
+    entries_offset = HEADER.size + len(body)
+    restarts = []
+    previous = b""
+    keys = sorted((module.encode(), module) for module in entries)
+    for i, (key, module) in enumerate(keys):
+        namespace, entry_packages = entries[module]
+        shared = 0
+        if i % restart_interval == 0:
+            restarts.append(HEADER.size + len(body))
+        else:
+            limit = min(len(key), len(previous))
+            while shared < limit and key[shared] == previous[shared]:
+                shared += 1
+        body += _varint(shared)
+        body += _varint(len(key) - shared)
+        body += key[shared:]
+        body.append(FLAG_NAMESPACE if namespace else 0)
+        body += _varint(len(entry_packages))
+        last = 0
+        for package_id in sorted(ids[package] for package in entry_packages):
+            body += _varint(package_id - last)
+            last = package_id
+        previous = key
+    restarts_offset = HEADER.size + len(body)
+    for restart in restarts:
+        body += _U32.pack(restart)
+    if HEADER.size + len(body) > 0xFFFFFFFF:
+        raise ValueError("mapping too large for 32-bit offsets")
+
+    header = HEADER.pack(
+        MAGIC, VERSION, restart_interval, len(packages), len(keys), len(restarts), 0,
+        names_offset, positions_offset, entries_offset, restarts_offset, _digest(body),
+    )
+    with open(path, "wb") as f:
+        f.write(header)
+        f.write(body)
+
+
+def export(db, path):
+    """Write db's mapping to path (see the module docstring)."""
+    write(path, *mapping_from_database(db))
+
+
+class MappingFile:
+    """An export, memory-mapped. Nothing is read until a lookup asks for it."""
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        (
+            magic, version, self.restart_interval, self.package_count, self.entry_count,
+            self.restart_count, _, self._names, self._positions, self._entries, self._restarts, self.digest,
+        ) = HEADER.unpack_from(self._mm)
+        if magic != MAGIC:
+            raise ValueError(f"{path} isn't a package mapping export")
+        if version != VERSION:
+            raise ValueError(f"{path} is version {version}, only {VERSION} is supported")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self._mm.close()
+
+    def verify(self):
+        """Raise ValueError if the content doesn't match the header's digest."""
+        if _digest(self._mm[HEADER.size:]) != self.digest:
+            raise ValueError("package mapping export is corrupt (digest mismatch)")
+
+    def package(self, package_id):
+        start, end = struct.unpack_from("<II", self._mm, self._names + 4 * package_id)
+        base = self._names + 4 * (self.package_count + 1)
+        return self._mm[base + start:base + end].decode()
+
+    def package_pos(self, package_id):
+        return _U32.unpack_from(self._mm, self._positions + 4 * package_id)[0]
+
+    def _restart_key(self, i):
+        offset = _U32.unpack_from(self._mm, self._restarts + 4 * i)[0]
+        _, offset = _read_varint(self._mm, offset)
+        length, offset = _read_varint(self._mm, offset)
+        return self._mm[offset:offset + length]
+
+    def _scan(self, key):
+        """Yield (key, namespace, package ids) from the first key >= key on."""
+        low, high = 0, self.restart_count
+        # The last restart point whose key is <= key
+        while high - low > 1:
+            middle = (low + high) // 2
+            if self._restart_key(middle) <= key:
+                low = middle
+            else:
+                high = middle
+        if not self.restart_count:
+            return
+        offset = _U32.unpack_from(self._mm, self._restarts + 4 * low)[0]
+        mm = self._mm
+        previous = b""
+        for _ in range(self.entry_count - low * self.restart_interval):
+            shared, offset = _read_varint(mm, offset)
+            length, offset = _read_varint(mm, offset)
+            current = previous[:shared] + mm[offset:offset + length]
+            offset += length
+            flags = mm[offset]
+            count, offset = _read_varint(mm, offset + 1)
+            if current < key:
+                for _ in range(count):
+                    _, offset = _read_varint(mm, offset)
+            else:
+                package_ids = []
+                package_id = 0
+                for _ in range(count):
+                    delta, offset = _read_varint(mm, offset)
+                    package_id += delta
+                    package_ids.append(package_id)
+                yield current, bool(flags & FLAG_NAMESPACE), package_ids
+            previous = current
+
+    def _get(self, key):
+        for current, namespace, package_ids in self._scan(key):
+            if current == key:
+                return namespace, package_ids
+            return None
+        return None
+
+    def get(self, module_name):
+        """Return (namespace, packages) for exactly module_name, or None."""
+        entry = self._get(module_name.encode())
+        if entry is None:
+            return None
+        namespace, package_ids = entry
+        return namespace, tuple(map(self.package, package_ids))
+
+    def items(self):
+        """Yield (module, namespace, packages) for every entry, in key order."""
+        for key, namespace, package_ids in self._scan(b""):
+            yield key.decode(), namespace, tuple(map(self.package, package_ids))
+
+    def positions(self):
+        return {self.package(i): self.package_pos(i) for i in range(self.package_count)}
+
+    def resolve(self, module_name):
+        """Same as resolver.Resolver.resolve, from the export."""
+        parts = module_name.split(".")
+        last = len(parts) - 1
+        match = None
+        entry = None
+        for depth in range(len(parts)):
+            prefix = ".".join(parts[:depth + 1]) if depth < last else module_name
+            entry = self._get(prefix.encode())
+            if entry is not None and entry[1] and (depth == last or not entry[0]):
+                match = prefix, entry[1]
+        below = (module_name + ".").encode()
+        if (entry is not None and entry[0]) or match is None:
+            package_ids = set(entry[1]) if entry is not None else set()
+            found = entry is not None and entry[0]
+            for key, _, ids in self._scan(below):
+                if not key.startswith(below):
+                    break
+                found = True
+                package_ids.update(ids)
+            if found:
+                return Resolution(module_name, module_name, tuple(map(self.package, sorted(package_ids))), True)
+        if match is None:
+            return Resolution(module_name, None, (), False)
+        prefix, package_ids = match
+        return Resolution(module_name, prefix, tuple(map(self.package, package_ids)), False)
+
+
+def write_delta(old_path, new_path, path):
+    """Write what turns the export at old_path into the one at new_path."""
+    with MappingFile(old_path) as old, MappingFile(new_path) as new:
+        old_entries = {module: (namespace, packages) for module, namespace, packages in old.items()}
+        new_entries = {module: (namespace, packages) for module, namespace, packages in new.items()}
+        old_positions, new_positions = old.positions(), new.positions()
+        delta = {
+            "restart_interval": new.restart_interval,
+            "removed": sorted(old_entries.keys() - new_entries.keys()),
+            "changed": {
+                module: [namespace, list(packages)]
+                for module, (namespace, packages) in new_entries.items()
+                if old_entries.get(module) != (namespace, packages)
+            },
+            "removed_packages": sorted(old_positions.keys() - new_positions.keys()),
+            "positions": {
+                package: package_pos for package, package_pos in new_positions.items()
+                if old_positions.get(package) != package_pos
+            },
+        }
+        header = DELTA_HEADER.pack(DELTA_MAGIC, VERSION, old.digest, new.digest)
+    with open(path, "wb") as f:
+        f.write(header)
+        f.write(zlib.compress(json.dumps(delta, sort_keys=True).encode(), 9))
+
+
+def apply_delta(old_path, delta_path, path):
+    """Write the export the delta at delta_path makes of the one at old_path."""
+    with open(delta_path, "rb") as f:
+        data = f.read()
+    magic, version, base, target = DELTA_HEADER.unpack_from(data)
+    if magic != DELTA_MAGIC or version != VERSION:
+        raise ValueError(f"{delta_path} isn't a version {VERSION} package mapping delta")
+    delta = json.loads(zlib.decompress(data[DELTA_HEADER.size:]))
+    with MappingFile(old_path) as old:
+        if old.digest != base:
+            raise ValueError(f"{delta_path} doesn't apply to {old_path}")
+        entries = {module: (namespace, packages) for module, namespace, packages in old.items()}
+        positions = old.positions()
+    for module in delta["removed"]:
+        del entries[module]
+    for module, (namespace, packages) in delta["changed"].items():
+        entries[module] = (namespace, packages)
+    for package in delta["removed_packages"]:
+        del positions[package]
+    positions.update(delta["positions"])
+    write(path, entries, positions, delta["restart_interval"])
+    with MappingFile(path) as new:
+        if new.digest != target:
+            raise ValueError(f"applying {delta_path} to {old_path} didn't give the expected export")
+
+
+def main():
+    if sys.argv[1:2] == ["delta"]:
+        write_delta(*sys.argv[2:5])
+    elif sys.argv[1:2] == ["apply"]:
+        apply_delta(*sys.argv[2:5])
+    else:
+        db = PackageDatabase(sys.argv[1] if len(sys.argv) > 1 else "package_database.sqlite", read_only=True)
+        try:
+            export(db, sys.argv[2] if len(sys.argv) > 2 else "package_mapping.bin")
+        finally:
+            db.close()
+
+
+if __name__ == "__main__":
+    main()
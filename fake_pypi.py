@@ -0,0 +1,250 @@
+"""A local stand-in for PyPI's simple index and file host, for benchmarks.
+
+    python fake_pypi.py [port]
+
+Serves `packages` synthetic projects (pkg0, pkg1, ...), each with one
+wheel and one sdist of files_per_wheel modules of file_size bytes:
+- /simple/<name>/ in PEP 691 JSON or HTML, by the Accept header, with an
+  ETag (and 304s for If-None-Match)
+- /files/<filename> with Range support: single ranges, suffix ranges and
+  multi-range requests (answered as multipart/byteranges)
+- /gh?page=N, an empty GitHub releases list
+- /_stats, the request and byte counts so far, as JSON
+Every namespace_every-th package also ships a pkgutil-style
+`fakens/__init__.py`, so the namespace stage has work to do. Each answer
+waits latency seconds first, and throttle_rate of them (at random) are a
+429 with a `Retry-After: retry_after` instead.
+"""
+from collections import Counter
+from email.utils import formatdate
+import hashlib
+import html
+import io
+import json
+import multiprocessing
+import random
+import sys
+import tarfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import zipfile
+
+LAST_MODIFIED = formatdate(1_700_000_000, usegmt=True)
+NAMESPACE_INIT = b"__path__ = __import__('pkgutil').extend_path(__path__, __name__)\n"
+
+
+class FakePyPI:
+    """The synthetic projects: their index pages and files, built up front."""
+
+    def __init__(self, packages=100, files_per_wheel=50, file_size=2048, namespace_every=10, seed=0):
+        self.pages = {}
+        self.files = {}
+        rng = random.Random(seed)
+        for i in range(packages):
+            name = f"pkg{i}"
+            members = [(f"{name}/__init__.py", b"")]
+            members += [
+                (f"{name}/{'sub%d/' % (j % 5) if j % 3 else ''}module{j}.py", rng.randbytes(file_size))
+                for j in range(files_per_wheel - 1)
+            ]
+            members += [(f"{name}/sub{j}/__init__.py", b"") for j in range(min(5, files_per_wheel))]
+            if namespace_every and i % namespace_every == 0:
+                members.append(("fakens/__init__.py", NAMESPACE_INIT))
+            wheel = f"{name}-1.0-py3-none-any.whl"
+            sdist = f"{name}-1.0.tar.gz"
+            self.files[wheel] = _wheel(name, members)
+            self.files[sdist] = _sdist(name, members)
+            self.pages[name] = [(filename, hashlib.sha256(self.files[filename]).hexdigest()) for filename in (sdist, wheel)]
+
+    def page(self, name, json_format):
+        files = [
+            (filename, f"/files/{filename}", sha256, len(self.files[filename]))
+            for filename, sha256 in self.pages[name]
+        ]
+        if json_format:
+            body = json.dumps({
+                "meta": {"api-version": "1.1"},
+                "name": name,
+                "files": [
+                    {"filename": filename, "url": url, "hashes": {"sha256": sha256}, "size": size, "yanked": False}
+                    for filename, url, sha256, size in files
+                ],
+            }).encode()
+            return body, "application/vnd.pypi.simple.v1+json"
+        links = "".join(
+            f'<a href="{html.escape(url)}#sha256={sha256}">{html.escape(filename)}</a><br/>\n'
+            for filename, url, sha256, _ in files
+        )
+        return f"<!DOCTYPE html><html><body>\n{links}</body></html>\n".encode(), "text/html"
+
+
+def _wheel(name, members):
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as zf:
+        for filepath, content in members:
+            zf.writestr(filepath, content)
+        dist_info = f"{name}-1.0.dist-info"
+        zf.writestr(f"{dist_info}/METADATA", f"Metadata-Version: 2.1\nName: {name}\nVersion: 1.0\n")
+        zf.writestr(f"{dist_info}/WHEEL", "Wheel-Version: 1.0\nRoot-Is-Purelib: true\nTag: py3-none-any\n")
+        zf.writestr(f"{dist_info}/RECORD", "")
+    return buffer.getvalue()
+
+
+def _sdist(name, members):
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w:gz") as tf:
+        for filepath, content in members:
+            info = tarfile.TarInfo(f"{name}-1.0/{filepath}")
+            info.size = len(content)
+            tf.addfile(info, io.BytesIO(content))
+    return buffer.getvalue()
+
+
+def _byte_ranges(header, length):
+    """Return the inclusive (start, end) ranges of a Range header, None if
+    it isn't one this server does."""
+    unit, _, specs = header.partition("=")
+    if unit.strip() != "bytes":
+        return None
+    ranges = []
+    for spec in specs.split(","):
+        first, _, last = spec.strip().partition("-")
+        if not first:
+            start, end = max(0, length - int(last)), length - 1
+        else:
+            start, end = int(first), min(int(last), length - 1) if last else length - 1
+        if start > end:
+            return None
+        ranges.append((start, end))
+    return ranges
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server: "_Server"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        if self.path == "/_stats":
+            with server.lock:
+                self._send(200, json.dumps(server.stats).encode(), {"Content-Type": "application/json"})
+            return
+        time.sleep(server.latency)
+        if server.throttle_rate and server.rng.random() < server.throttle_rate:
+            server.count("throttled")
+            self._send(429, b"", {"Retry-After": str(server.retry_after)})
+            return
+        if self.path.startswith("/simple/"):
+            self._page(self.path[len("/simple/"):].strip("/"))
+        elif self.path.startswith("/files/"):
+            self._file(self.path[len("/files/"):])
+        elif self.path.startswith("/gh"):
+            self._send(200, b"[]", {"Content-Type": "application/json"})
+        else:
+            self._send(404, b"")
+
+    def _page(self, name):
+        server = self.server
+        server.count("index_requests")
+        if name not in server.pypi.pages:
+            self._send(404, b"")
+            return
+        body, content_type = server.pypi.page(name, "json" in self.headers.get("Accept", ""))
+        etag = f'"{hashlib.sha256(body).hexdigest()[:16]}"'
+        if self.headers.get("If-None-Match") == etag:
+            server.count("not_modified")
+            self._send(304, b"", {"ETag": etag}, send_body=False)
+            return
+        self._send(200, body, {"Content-Type": content_type, "ETag": etag, "Last-Modified": LAST_MODIFIED})
+
+    def _file(self, filename):
+        server = self.server
+        data = server.pypi.files.get(filename)
+        if data is None:
+            self._send(404, b"")
+            return
+        server.count("file_requests")
+        headers = {"Last-Modified": LAST_MODIFIED, "Accept-Ranges": "bytes"}
+        ranges = _byte_ranges(self.headers["Range"], len(data)) if "Range" in self.headers else None
+        if not ranges:
+            body = data
+            status = 200
+            headers["Content-Type"] = "application/octet-stream"
+        elif len(ranges) == 1:
+            (start, end), = ranges
+            body = data[start:end + 1]
+            status = 206
+            headers["Content-Type"] = "application/octet-stream"
+            headers["Content-Range"] = f"bytes {start}-{end}/{len(data)}"
+        else:
+            boundary = "fakepypiboundary"
+            parts = []
+            for start, end in ranges:
+                parts.append(
+                    f"--{boundary}\r\nContent-Type: application/octet-stream\r\n"
+                    f"Content-Range: bytes {start}-{end}/{len(data)}\r\n\r\n".encode()
+                )
+                parts.append(data[start:end + 1])
+                parts.append(b"\r\n")
+            parts.append(f"--{boundary}--\r\n".encode())
+            body = b"".join(parts)
+            status = 206
+            headers["Content-Type"] = f"multipart/byteranges; boundary={boundary}"
+            server.count("multi_range_requests")
+        server.count("file_bytes", len(body))
+        self._send(status, body, headers)
+
+    def _send(self, status, body, headers=None, send_body=True):
+        self.send_response(status)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if send_body and body:
+            self.wfile.write(body)
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, pypi, latency=0.0, throttle_rate=0.0, retry_after=0):
+        super().__init__(address, _Handler)
+        self.pypi = pypi
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.rng = random.Random(0)
+        self.lock = threading.Lock()
+        self.stats = Counter()
+
+    def count(self, key, n=1):
+        with self.lock:
+            self.stats[key] += n
+
+
+def serve(port=0, ready=None, latency=0.0, throttle_rate=0.0, retry_after=0, **pypi_options):
+    """Serve a FakePyPI on 127.0.0.1:port until killed, sending the port
+    actually bound to the ready connection (if any) once listening."""
+    server = _Server(("127.0.0.1", port), FakePyPI(**pypi_options), latency, throttle_rate, retry_after)
+    if ready is not None:
+        ready.send(server.server_address[1])
+    else:
+        print(f"serving on http://127.0.0.1:{server.server_address[1]}/simple/")
+    server.serve_forever()
+
+
+def start(**options):
+    """Run serve(**options) in a child process; return it and the server's base URL."""
+    receiver, sender = multiprocessing.Pipe(duplex=False)
+    process = multiprocessing.get_context("spawn").Process(target=serve, kwargs={"ready": sender, **options}, daemon=True)
+    process.start()
+    port = receiver.recv()
+    return process, f"http://127.0.0.1:{port}"
+
+
+if __name__ == "__main__":
+    serve(int(sys.argv[1]) if len(sys.argv) > 1 else 8000)
@@ -0,0 +1,229 @@
+import asyncio
+from email.utils import parsedate_to_datetime
+import random
+import time
+
+import httpx
+
+import metrics
+
+# Most requests in flight per host; each limit adapts (AIMD) between 1 and this
+HOST_LIMITS = {
+    "pypi.org": 64,
+    "files.pythonhosted.org": 256,
+    "api.github.com": 4,
+}
+DEFAULT_HOST_LIMIT = 32
+# Answers that mean "slow down/try again", rather than a broken request
+RETRY_STATUSES = frozenset((429, 502, 503, 504))
+OVERLOAD_STATUSES = frozenset((429, 503))
+IDEMPOTENT_METHODS = frozenset(("GET", "HEAD"))
+
+
+def _retry_after(response):
+    """Return the seconds a Retry-After header asks to wait, if any."""
+    value = response.headers.get("Retry-After")
+    if value is None:
+        return None
+    if value.strip().isdigit():
+        return float(value)
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class HostLimiter:
+    """Concurrency limit for one host, adapted AIMD-style.
+
+    Every successful response raises the limit by 1/limit (so about one per
+    round trip's worth of responses); a 429/503 or a transport error halves
+    it, at most once per (smoothed) round trip. Slow responses alone don't
+    count: CDN latency varies too much to read congestion from it. A
+    Retry-After also holds off every new request to the host until it has
+    passed.
+    """
+
+    def __init__(self, maximum, minimum=1):
+        self.maximum = maximum
+        self.minimum = minimum
+        self.limit = float(maximum)
+        self.in_flight = 0
+        self.requests = 0
+        self.retries = 0
+        self.overloads = 0
+        # Smoothed round trip (like TCP's SRTT), the window a decrease covers
+        self._smoothed_latency = None
+        self._last_decrease = 0.0
+        self._paused_until = 0.0
+        self._condition = asyncio.Condition()
+
+    async def acquire(self):
+        async with self._condition:
+            await self._condition.wait_for(lambda: self.in_flight < max(self.minimum, int(self.limit)))
+            self.in_flight += 1
+        delay = self._paused_until - time.monotonic()
+        if delay > 0:
+            try:
+                await asyncio.sleep(delay)
+            except BaseException:
+                await self.release()
+                raise
+        self.requests += 1
+
+    async def release(self):
+        async with self._condition:
+            self.in_flight -= 1
+            self._condition.notify_all()
+
+    def _observe(self, latency):
+        if self._smoothed_latency is None:
+            self._smoothed_latency = latency
+        else:
+            self._smoothed_latency += (latency - self._smoothed_latency) / 8
+
+    def succeeded(self, latency):
+        self._observe(latency)
+        self.limit = min(self.maximum, self.limit + 1 / self.limit)
+
+    def overloaded(self, latency, pause=None):
+        self.overloads += 1
+        self._decrease(latency)
+        if pause:
+            self._paused_until = max(self._paused_until, time.monotonic() + pause)
+
+    def _decrease(self, latency):
+        now = time.monotonic()
+        # Everything in flight sees the same congestion, only react once to it
+        if now - self._last_decrease < max(latency, self._smoothed_latency or 0):
+            return
+        self._last_decrease = now
+        self.limit = max(self.minimum, self.limit / 2)
+
+    def report(self):
+        return (
+            f"limit {self.limit:.1f}/{self.maximum}, {self.requests} requests, "
+            f"{self.retries} retries, {self.overloads} overloads"
+        )
+
+
+class _ReleasingStream(httpx.AsyncByteStream):
+    """Response body that gives its host slot back once closed, so a
+    streamed download counts against the limit until it's done."""
+
+    def __init__(self, stream, limiter, host):
+        self._stream = stream
+        self._limiter = limiter
+        self._host = host
+        self._released = False
+
+    async def __aiter__(self):
+        async for chunk in self._stream:
+            metrics.count("http_response_bytes_total", len(chunk), host=self._host)
+            yield chunk
+
+    async def aclose(self):
+        try:
+            await self._stream.aclose()
+        finally:
+            if not self._released:
+                self._released = True
+                await self._limiter.release()
+                metrics.gauge("http_in_flight", self._limiter.in_flight, host=self._host)
+
+
+class AdaptiveTransport(httpx.AsyncBaseTransport):
+    """Transport wrapper scheduling requests per host, with retries.
+
+    Each host gets its own HostLimiter (HOST_LIMITS, else
+    DEFAULT_HOST_LIMIT). GET/HEAD requests failing with a transport error
+    or one of RETRY_STATUSES are retried up to max_retries times, after
+    the Retry-After the server asked for or a jittered exponential backoff.
+    """
+
+    def __init__(self, transport, host_limits=HOST_LIMITS, default_limit=DEFAULT_HOST_LIMIT,
+                 max_retries=5, backoff=0.5, max_backoff=60.0):
+        self._transport = transport
+        self._host_limits = host_limits
+        self._default_limit = default_limit
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.limiters = {}
+
+    def limiter(self, host):
+        if host not in self.limiters:
+            self.limiters[host] = HostLimiter(self._host_limits.get(host, self._default_limit))
+        return self.limiters[host]
+
+    def _backoff(self, attempt):
+        # "Full jitter", so retries of a burst of failures don't come back as a burst
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    async def handle_async_request(self, request):
+        host = request.url.host
+        limiter = self.limiter(host)
+        retries = self.max_retries if request.method in IDEMPOTENT_METHODS else 0
+        for attempt in range(retries + 1):
+            await limiter.acquire()
+            # Whatever goes wrong (cancellation included) while the slot is
+            # held gives it back, once the response is wrapped its stream does
+            held, response = True, None
+            try:
+                metrics.gauge("http_in_flight", limiter.in_flight, host=host)
+                started = time.monotonic()
+                try:
+                    response = await self._transport.handle_async_request(request)
+                except httpx.TransportError:
+                    held = False
+                    await limiter.release()
+                    limiter.overloaded(time.monotonic() - started)
+                    metrics.count("http_requests_total", host=host, status="error")
+                    if attempt == retries:
+                        raise
+                    limiter.retries += 1
+                    metrics.count("http_retries_total", host=host)
+                    await asyncio.sleep(self._backoff(attempt))
+                    continue
+                latency = time.monotonic() - started
+                metrics.count("http_requests_total", host=host, status=str(response.status_code))
+                metrics.observe("http_request_seconds", latency, host=host)
+
+                if response.status_code not in RETRY_STATUSES:
+                    limiter.succeeded(latency)
+                else:
+                    retry_after = _retry_after(response)
+                    if retry_after is not None:
+                        retry_after = min(retry_after, self.max_backoff)
+                    # A 502/504 is a gateway's trouble, it's retried without lowering the limit
+                    if response.status_code in OVERLOAD_STATUSES:
+                        limiter.overloaded(latency, retry_after)
+                if response.status_code in RETRY_STATUSES and attempt < retries:
+                    await response.aclose()
+                    held = False
+                    await limiter.release()
+                    limiter.retries += 1
+                    metrics.count("http_retries_total", host=host)
+                    await asyncio.sleep(self._backoff(attempt) if retry_after is None else retry_after)
+                    continue
+                metrics.gauge("http_limit", limiter.limit, host=host)
+                wrapped = httpx.Response(
+                    response.status_code,
+                    headers=response.headers,
+                    stream=_ReleasingStream(response.stream, limiter, host),
+                    extensions=response.extensions,
+                )
+                held = False
+                return wrapped
+            except BaseException:
+                if held:
+                    if response is not None:
+                        await response.aclose()
+                    await limiter.release()
+                raise
+
+    def report(self):
+        return "\n".join(f"{host}: {limiter.report()}" for host, limiter in sorted(self.limiters.items()))
+
+    async def aclose(self):
+        await self._transport.aclose()
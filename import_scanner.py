@@ -0,0 +1,193 @@
+"""Find the third-party distributions a source tree imports.
+
+    python import_scanner.py [root]
+
+Scans every .py file under root (the current directory by default) for
+import statements, drops the standard library, relative imports and
+modules defined in the tree itself, resolves the rest with the package DB
+(see resolver.py) and prints the distributions each project needs. A
+project is the nearest directory with a pyproject.toml, setup.py or
+setup.cfg, else root.
+
+Files are read and scanned by `SCAN_WORKERS` processes (all cores by
+default), and what was found is kept in `IMPORT_CACHE` by path: a file
+with the same mtime and size isn't read again, one with the same content
+hash isn't scanned again, so a re-run only pays for what changed.
+"""
+from collections import defaultdict
+import os
+import sqlite3
+import sys
+import time
+
+from cpu_pool import CpuPool
+import resolver
+
+SCAN_WORKERS = int(os.getenv("SCAN_WORKERS", str(os.cpu_count() or 1)))
+IMPORT_CACHE = os.getenv("IMPORT_CACHE", "import_scan_cache.sqlite")
+# Below this many files to scan, starting worker processes isn't worth it
+MIN_FILES_PER_WORKER = 256
+
+PROJECT_MARKERS = ("pyproject.toml", "setup.py", "setup.cfg")
+SKIPPED_DIRS = frozenset(("__pycache__", "node_modules", "site-packages"))
+
+
+class ImportCache:
+    """What each file imported, by path, with its mtime, size and hash."""
+
+    def __init__(self, db_path=IMPORT_CACHE):
+        self.db = sqlite3.connect(db_path)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY,
+                mtime_ns INTEGER,
+                size INTEGER,
+                digest TEXT,
+                imports TEXT
+            )
+        """)
+
+    def load(self, root):
+        """Return {path: (mtime_ns, size, digest, imports)} for the files under root."""
+        return {
+            path: (mtime_ns, size, digest, imports.split("\n") if imports else [])
+            for path, mtime_ns, size, digest, imports in self.db.execute(
+                "SELECT path, mtime_ns, size, digest, imports FROM files WHERE path >= ? AND path < ?",
+                (root + os.sep, root + chr(ord(os.sep) + 1)),
+            )
+        }
+
+    def update(self, rows, removed):
+        """Store the (path, mtime_ns, size, digest, imports) rows and drop the removed paths."""
+        with self.db:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO files (path, mtime_ns, size, digest, imports) VALUES (?, ?, ?, ?, ?)",
+                ((path, mtime_ns, size, digest, "\n".join(imports)) for path, mtime_ns, size, digest, imports in rows),
+            )
+            self.db.executemany("DELETE FROM files WHERE path = ?", ((path,) for path in removed))
+
+    def close(self):
+        self.db.close()
+
+
+def walk(root):
+    """Return the (path, mtime_ns, size, project) of every .py file under
+    root, the top-level module names the tree defines (the modules and
+    packages directly in root, a project or its src/) and every module
+    name it has anywhere (scripts import their siblings)."""
+    files = []
+    local = set()
+    defined = set()
+    # (directory, its project, whether its parent is a source root)
+    stack = [(root, root, False)]
+    while stack:
+        directory, project, in_source_root = stack.pop()
+        try:
+            entries = list(os.scandir(directory))
+        except OSError:
+            continue
+        names = {entry.name for entry in entries}
+        if "pyvenv.cfg" in names:
+            continue
+        if any(marker in names for marker in PROJECT_MARKERS):
+            project = directory
+        source_root = directory in (root, project) or (in_source_root and os.path.basename(directory) == "src")
+        has_modules = False
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                if not entry.name.startswith(".") and entry.name not in SKIPPED_DIRS:
+                    stack.append((entry.path, project, source_root))
+            elif entry.name.endswith(".py") and entry.is_file():
+                stat = entry.stat()
+                files.append((entry.path, stat.st_mtime_ns, stat.st_size, project))
+                has_modules = True
+                defined.add(entry.name[:-3])
+                if source_root:
+                    local.add(entry.name[:-3])
+        if has_modules:
+            defined.add(os.path.basename(directory))
+            if in_source_root:
+                local.add(os.path.basename(directory))
+    return files, local, defined
+
+
+def scan(root, files, cache, workers=SCAN_WORKERS):
+    """Return {path: imports} for root's files (from walk) through the
+    cache, and how many files had to be read."""
+    cached = cache.load(root)
+    imports = {}
+    stats = {}
+    jobs = []
+    for path, mtime_ns, size, _ in files:
+        entry = cached.get(path)
+        if entry is not None and entry[:2] == (mtime_ns, size):
+            imports[path] = entry[3]
+        else:
+            stats[path] = (mtime_ns, size)
+            jobs.append((path, entry[2] if entry else None))
+
+    updates = []
+    if len(jobs) < MIN_FILES_PER_WORKER * max(workers, 1):
+        workers = 0
+    with CpuPool(workers) as cpu:
+        for path, digest, found in cpu.scan_imports(jobs):
+            if found is None:
+                found = cached[path][3]
+            imports[path] = found
+            if digest is not None:
+                updates.append((path, *stats[path], digest, found))
+    seen = {path for path, *_ in files}
+    cache.update(updates, [path for path in cached if path not in seen])
+    return imports, len(jobs)
+
+
+def requirements(files, imports, local, defined=(), resolve_many=resolver.resolve_many):
+    """Return {project: ({distribution: modules}, unresolved modules)}.
+
+    Names from local are never resolved, those from defined only count
+    when nothing else resolves them."""
+    ignored = set(sys.stdlib_module_names) | local | {"__future__"}
+    wanted = defaultdict(set)
+    for path, _, _, project in files:
+        wanted[project].update(name for name in imports[path] if name.partition(".")[0] not in ignored)
+    resolutions = resolve_many(set().union(*wanted.values()))
+
+    report = {}
+    for project, names in wanted.items():
+        distributions = defaultdict(set)
+        unresolved = set()
+        for name in names:
+            resolution = resolutions[name]
+            if resolution.packages and not resolution.namespace:
+                distributions[resolution.packages[0]].add(resolution.prefix)
+            elif resolution.namespace:
+                unresolved.add(name)
+            elif name.partition(".")[0] not in defined:
+                unresolved.add(name.partition(".")[0])
+        report[project] = (distributions, unresolved)
+    return report
+
+
+def main():
+    root = os.path.abspath(sys.argv[1] if len(sys.argv) > 1 else ".")
+    started = time.perf_counter()
+    files, local, defined = walk(root)
+    cache = ImportCache()
+    try:
+        imports, scanned = scan(root, files, cache)
+    finally:
+        cache.close()
+    report = requirements(files, imports, local, defined)
+    for project in sorted(report):
+        distributions, unresolved = report[project]
+        print(f"{os.path.relpath(project, root)}:")
+        for distribution in sorted(distributions, key=str.lower):
+            print(f"  {distribution:<30} {', '.join(sorted(distributions[distribution]))}")
+        for name in sorted(unresolved):
+            print(f"  {'?':<30} {name}")
+    print(f"{len(files)} files ({scanned} scanned) in {time.perf_counter() - started:.2f}s")
+
+
+if __name__ == "__main__":
+    main()
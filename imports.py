@@ -0,0 +1,147 @@
+import hashlib
+import re
+
+# A string literal from its opening quote (prefixes don't change where it ends)
+_STRING = rb"""(?:\"\"\"[^"\\]*(?:(?:\\[\s\S]|"(?!""))[^"\\]*)*\"\"\"|'''[^'\\]*(?:(?:\\[\s\S]|'(?!''))[^'\\]*)*'''|"[^"\\\n]*(?:\\[\s\S][^"\\\n]*)*"|'[^'\\\n]*(?:\\[\s\S][^'\\\n]*)*')"""
+# Strings and comments are skipped whole, so that the import/from keywords
+# found are in code; everything else is skipped over by the search itself
+_SCAN = re.compile(rb"(?P<string>" + _STRING + rb")|(?P<comment>\#[^\n]*)|(?P<keyword>(?<![\w.])(?:import|from)\b)")
+# The tokens of one import statement
+_TOKEN = re.compile(rb"(?P<string>" + _STRING + rb""")
+    |(?P<comment>\#[^\n]*)
+    |(?P<continuation>\\\r?\n)
+    |(?P<newline>\n)
+    |(?P<open>[(\[{])
+    |(?P<close>[)\]}])
+    |(?P<name>[A-Za-z_\x80-\xff][A-Za-z0-9_\x80-\xff]*)
+    |(?P<punct>[.,*;])
+""", re.VERBOSE)
+_SKIPPED = frozenset(("comment", "continuation"))
+
+
+def _statement_tokens(source, pos):
+    """Return the tokens of the statement starting at pos, and where it ends."""
+    tokens = []
+    depth = 0
+    for m in _TOKEN.finditer(source, pos):
+        kind = m.lastgroup
+        if kind in _SKIPPED:
+            continue
+        if depth == 0 and (kind == "newline" or m.group() == b";"):
+            return tokens, m.start()
+        if kind == "open":
+            depth += 1
+        elif kind == "close":
+            depth -= 1
+        tokens.append((kind, m.group()))
+    return tokens, len(source)
+
+
+def _starts_statement(source, pos):
+    # Only blanks since the line start or a `;`/`:` (`try: import x`); not
+    # bracket-aware, but a keyword starting a line inside brackets is a
+    # `yield from`/`raise ... from` continuation, never followed by import
+    i = pos
+    while i and source[i - 1] in b" \t\f":
+        i -= 1
+    return i == 0 or source[i - 1] in b"\n\r;:"
+
+
+def _dotted_name(tokens, i):
+    """Return the dotted name starting at tokens[i] and the index after it."""
+    parts = []
+    while i < len(tokens) and tokens[i][0] == "name":
+        parts.append(tokens[i][1])
+        if i + 1 < len(tokens) and tokens[i + 1] == ("punct", b"."):
+            i += 2
+        else:
+            i += 1
+            break
+    return b".".join(parts), i
+
+
+def _skip_alias(tokens, i):
+    if i < len(tokens) and tokens[i] == ("name", b"as"):
+        return i + 2
+    return i
+
+
+def _import(tokens, i, found):
+    # import a.b [as c], d ...
+    while True:
+        name, i = _dotted_name(tokens, i)
+        if not name:
+            return i
+        found.add(name)
+        i = _skip_alias(tokens, i)
+        if i < len(tokens) and tokens[i] == ("punct", b","):
+            i += 1
+        else:
+            return i
+
+
+def _from_import(tokens, i, found):
+    # from a.b import (c [as d], e ...) | *
+    if i < len(tokens) and tokens[i] == ("punct", b"."):
+        # Relative: always local
+        return i
+    module, i = _dotted_name(tokens, i)
+    if not module or i >= len(tokens) or tokens[i] != ("name", b"import"):
+        return i
+    i += 1
+    parenthesized = i < len(tokens) and tokens[i][0] == "open"
+    if parenthesized:
+        i += 1
+    if i < len(tokens) and tokens[i] == ("punct", b"*"):
+        found.add(module)
+        return i + 1
+    while i < len(tokens) and tokens[i][0] in ("name", "newline"):
+        if tokens[i][0] == "newline":
+            # Only inside the parentheses, the main loop stops at the others
+            if not parenthesized:
+                break
+            i += 1
+            continue
+        found.add(module + b"." + tokens[i][1])
+        i = _skip_alias(tokens, i + 1)
+        if i < len(tokens) and tokens[i] == ("punct", b","):
+            i += 1
+    if parenthesized and i < len(tokens) and tokens[i][0] == "close":
+        i += 1
+    return i
+
+
+def find_imports(source):
+    """Return the absolute module names source (bytes) imports.
+
+    `import a.b` gives "a.b" and `from a import b` gives "a.b" (b may
+    be a module, a longest-prefix lookup sorts it out), `from a import *`
+    gives "a"; relative imports are left out. Rather than a full parse,
+    this finds the import/from keywords outside strings and comments and
+    tokenizes just the statements they start, wherever they are (functions, `try:` blocks, after a
+    `;`), so it also copes with files that don't parse.
+    """
+    if b"import" not in source:
+        return []
+    found = set()
+    pos = 0
+    while True:
+        m = _SCAN.search(source, pos)
+        if m is None:
+            break
+        pos = m.end()
+        if m.lastgroup == "keyword" and _starts_statement(source, m.start()):
+            tokens, pos = _statement_tokens(source, m.start())
+            (_import if tokens[0][1] == b"import" else _from_import)(tokens, 1, found)
+    return sorted(name.decode("utf-8", "replace") for name in found)
+
+
+def scan_file(path, digest=None):
+    """Return (digest, imports) of the file at path, imports being None
+    when its content still has the given digest."""
+    with open(path, "rb") as f:
+        source = f.read()
+    new_digest = hashlib.blake2b(source, digest_size=16).hexdigest()
+    if new_digest == digest:
+        return new_digest, None
+    return new_digest, find_imports(source)
@@ -21,41 +21,340 @@
 
 # (Modified async-compatiable `pip._internal.network.lazy_wheel`)
 
+import asyncio
 from bisect import bisect_left, bisect_right
 from contextlib import contextmanager
+import struct
 from tempfile import NamedTemporaryFile
-from typing import List, Optional, Tuple, Generator
-from zipfile import ZipFile, BadZipFile
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple, Generator, Union
+from zipfile import ZIP_DEFLATED, ZIP_STORED, ZipFile, BadZipFile
+import zlib
 
 import httpx
 
+import metrics
+from range_cache import RangeCache
+
 CONTENT_CHUNK_SIZE = 8192
+# Enough for the EOCD record and, for most wheels, the whole central directory
+TAIL_SIZE = 64 * 1024
+# Members closer than this are fetched as one range, bytes are cheaper than requests
+MEMBER_GAP = 16 * 1024
+# Ranges asked for in one multi-range request
+MAX_RANGES_PER_REQUEST = 64
 HEADERS = {"Accept-Encoding": "identity"}
+# Hosts that didn't answer a multi-range request with multipart/byteranges,
+# members are fetched from them one merged range at a time
+_SINGLE_RANGE_HOSTS = set()
+
+# See https://pkware.cachefly.net/webdocs/casestudies/APPNOTE.TXT
+_EOCD = struct.Struct("<4s4H2LH")
+_EOCD_SIGNATURE = b"PK\x05\x06"
+_ZIP64_LOCATOR = struct.Struct("<4sLQL")
+_ZIP64_LOCATOR_SIGNATURE = b"PK\x06\x07"
+_ZIP64_EOCD = struct.Struct("<4sQ2H2L4Q")
+_ZIP64_EOCD_SIGNATURE = b"PK\x06\x06"
+_CENTRAL_DIR = struct.Struct("<4s4B4HL2L5H2L")
+_CENTRAL_DIR_SIGNATURE = b"PK\x01\x02"
+_LOCAL_HEADER = struct.Struct("<4s2B4HL2L2H")
+_LOCAL_HEADER_SIGNATURE = b"PK\x03\x04"
+_ZIP64_EXTRA_ID = 0x0001
+
+
+class ZipEntry(NamedTuple):
+    """The parts of a central directory record the scraper cares about."""
+
+    name: str
+    header_offset: int
+    compress_size: int
+    file_size: int
+    compress_type: int
+    flag_bits: int
+    crc: int
+
+
+def _find_central_directory(tail: bytes, tail_offset: int) -> Optional[Tuple[int, int, int]]:
+    """Locate the central directory from the last bytes of a ZIP file.
+
+    Args:
+        tail (bytes): The last bytes of the file
+        tail_offset (int): Offset of the first byte of tail in the file
+
+    Returns the central directory's (offset, size, concat), where concat is
+    the length of any data prepended to the archive, or None if the EOCD
+    (or ZIP64 EOCD) record isn't within tail.
+    """
+    i = tail.rfind(_EOCD_SIGNATURE)
+    while i >= 0:
+        if i + _EOCD.size <= len(tail):
+            eocd = _EOCD.unpack_from(tail, i)
+            if i + _EOCD.size + eocd[-1] == len(tail):
+                break
+        i = tail.rfind(_EOCD_SIGNATURE, 0, i)
+    else:
+        return None
+
+    _, _, _, _, entries, cd_size, cd_offset, _ = eocd
+    location = tail_offset + i
+    if entries == 0xFFFF or 0xFFFFFFFF in (cd_size, cd_offset):
+        j = i - _ZIP64_LOCATOR.size
+        if j < 0:
+            return None
+        signature, _, zip64_offset, _ = _ZIP64_LOCATOR.unpack_from(tail, j)
+        if signature != _ZIP64_LOCATOR_SIGNATURE:
+            raise BadZipFile("Missing ZIP64 end of central directory locator")
+        # Like ZipFile, trust the record preceding the locator over its offset
+        k = j - _ZIP64_EOCD.size
+        if k < 0:
+            return None
+        zip64_eocd = _ZIP64_EOCD.unpack_from(tail, k)
+        if zip64_eocd[0] != _ZIP64_EOCD_SIGNATURE:
+            raise BadZipFile("Missing ZIP64 end of central directory record")
+        cd_size, cd_offset = zip64_eocd[-2:]
+        location = tail_offset + k
+    concat = location - cd_size - cd_offset
+    return cd_offset + concat, cd_size, concat
+
+
+def _parse_central_directory(data: memoryview, concat: int = 0) -> List[ZipEntry]:
+    """Parse the entries of a central directory, without a ZipFile."""
+    entries = []
+    pos = 0
+    while pos + _CENTRAL_DIR.size <= len(data):
+        record = _CENTRAL_DIR.unpack_from(data, pos)
+        if record[0] != _CENTRAL_DIR_SIGNATURE:
+            raise BadZipFile("Bad magic number for central directory")
+        flag_bits, compress_type, crc = record[5], record[6], record[9]
+        compress_size, file_size = record[10], record[11]
+        name_length, extra_length, comment_length = record[12:15]
+        header_offset = record[18]
+        pos += _CENTRAL_DIR.size
+        name = bytes(data[pos:pos + name_length])
+        pos += name_length
+        extra = data[pos:pos + extra_length]
+        pos += extra_length + comment_length
+
+        if 0xFFFFFFFF in (file_size, compress_size, header_offset):
+            file_size, compress_size, header_offset = _apply_zip64_extra(
+                extra, file_size, compress_size, header_offset
+            )
+        # Same as ZipFile/ZipInfo: bit 11 means UTF-8, truncate at NUL
+        decoded = name.decode("utf-8" if flag_bits & 0x800 else "cp437")
+        decoded = decoded.split("\x00", 1)[0]
+        entries.append(
+            ZipEntry(
+                decoded,
+                header_offset + concat,
+                compress_size,
+                file_size,
+                compress_type,
+                flag_bits,
+                crc,
+            )
+        )
+    return entries
+
+
+def _content_range_start(content_range: str) -> int:
+    """Return the first byte of "bytes start-end/length"."""
+    return int(content_range.split()[1].split("-", 1)[0])
+
+
+def _parse_multipart_byteranges(
+    body: bytes, boundary: bytes
+) -> Generator[Tuple[int, memoryview], None, None]:
+    """Yield the (start, data) of every part of a multipart/byteranges body."""
+    delimiter = b"--" + boundary
+    view = memoryview(body)
+    pos = body.find(delimiter)
+    while pos >= 0:
+        pos += len(delimiter)
+        if body[pos:pos + 2] == b"--":
+            return
+        headers_end = body.find(b"\r\n\r\n", pos)
+        if headers_end < 0:
+            raise BadZipFile("Truncated multipart/byteranges response")
+        start = end = None
+        for line in body[pos:headers_end].decode("latin-1").split("\r\n"):
+            key, _, value = line.partition(":")
+            if key.strip().lower() == "content-range":
+                start = _content_range_start(value.strip())
+                end = int(value.split("/", 1)[0].rsplit("-", 1)[1])
+        if start is None:
+            raise BadZipFile("multipart/byteranges part without Content-Range")
+        data_start = headers_end + 4
+        data_end = data_start + end - start + 1
+        yield start, view[data_start:data_end]
+        pos = body.find(delimiter, data_end)
+
+
+def _apply_zip64_extra(
+    extra: memoryview, file_size: int, compress_size: int, header_offset: int
+) -> Tuple[int, int, int]:
+    """Replace the saturated 32-bit fields with their ZIP64 extra values."""
+    pos = 0
+    while pos + 4 <= len(extra):
+        field_id, field_length = struct.unpack_from("<2H", extra, pos)
+        pos += 4
+        if field_id == _ZIP64_EXTRA_ID:
+            values = iter(struct.unpack_from(f"<{field_length // 8}Q", extra, pos))
+            if file_size == 0xFFFFFFFF:
+                file_size = next(values)
+            if compress_size == 0xFFFFFFFF:
+                compress_size = next(values)
+            if header_offset == 0xFFFFFFFF:
+                header_offset = next(values)
+            break
+        pos += field_length
+    return file_size, compress_size, header_offset
+
+
+class RangeNotFetched(Exception):
+    """Raised when reading bytes of an AsyncLazyZipOverHTTP not yet fetched.
+
+    start and end are the interval LazyZipOverHTTP would have downloaded.
+    """
 
+    def __init__(self, url: str, start: int, end: int) -> None:
+        super().__init__(f"{url}: bytes={start}-{end}")
+        self.start, self.end = start, end
 
-class LazyZipOverHTTP:
-    """File-like object mapped to a ZIP file over HTTP.
 
-    This uses HTTP range requests to lazily fetch the file's content,
-    which is supposed to be fed to ZipFile.  If such requests are not
-    supported by the server, raise HTTPRangeRequestUnsupported
-    during initialization.
+class TempFileStore:
+    """Backing store writing fetched bytes into a sparse temporary file."""
+
+    def __init__(self) -> None:
+        self._file = NamedTemporaryFile()
+
+    @property
+    def name(self) -> str:
+        """Path to the underlying file."""
+        return self._file.name
+
+    @property
+    def closed(self) -> bool:
+        return self._file.closed
+
+    def close(self) -> None:
+        self._file.close()
+
+    def truncate(self, size: int) -> int:
+        return self._file.truncate(size)
+
+    def write(self, pos: int, data: bytes) -> None:
+        self._file.seek(pos)
+        self._file.write(data)
+
+    def view(self, start: int, stop: int) -> memoryview:
+        """Return the bytes from start (inclusive) to stop (exclusive)."""
+        self._file.seek(start)
+        return memoryview(self._file.read(stop - start))
+
+
+class SparseMemoryStore:
+    """Backing store keeping only the fetched intervals, in memory.
+
+    Adjacent and overlapping writes are merged, so the intervals mirror
+    the downloaded ones (_left/_right) of the lazy file, and view is a
+    zero-copy memoryview into the interval holding the requested bytes.
+    """
+
+    def __init__(self) -> None:
+        self._starts: List[int] = []
+        self._chunks: List[bytearray] = []
+        self._closed = False
+
+    @property
+    def name(self) -> str:
+        return "<memory>"
+
+    @property
+    def closed(self) -> bool:
+        return self._closed
+
+    def close(self) -> None:
+        self._starts, self._chunks, self._closed = [], [], True
+
+    def truncate(self, size: int) -> int:
+        # Nothing is allocated until it's written
+        return size
+
+    def write(self, pos: int, data: bytes) -> None:
+        end = pos + len(data)
+        first = bisect_right(self._starts, pos) - 1
+        if first < 0 or self._starts[first] + len(self._chunks[first]) < pos:
+            first += 1
+        last = bisect_right(self._starts, end)
+        if first == last:
+            self._starts.insert(first, pos)
+            self._chunks.insert(first, bytearray(data))
+            return
+
+        start = self._starts[first]
+        chunk = self._chunks[first]
+        if last - first == 1 and start + len(chunk) == pos:
+            # The common case: streaming onto the end of an interval
+            try:
+                chunk += data
+            except BufferError:
+                # A view of it is still alive, so leave it be
+                self._chunks[first] = chunk + data
+            return
+
+        new_start = min(start, pos)
+        new_end = max(self._starts[last - 1] + len(self._chunks[last - 1]), end)
+        merged = bytearray(new_end - new_start)
+        for s, c in zip(self._starts[first:last], self._chunks[first:last]):
+            merged[s - new_start:s - new_start + len(c)] = c
+        merged[pos - new_start:end - new_start] = data
+        self._starts[first:last], self._chunks[first:last] = [new_start], [merged]
+
+    def view(self, start: int, stop: int) -> memoryview:
+        """Return the bytes from start (inclusive) to stop (exclusive)."""
+        i = bisect_right(self._starts, start) - 1
+        if i < 0 or self._starts[i] + len(self._chunks[i]) < stop:
+            raise ValueError(f"bytes {start}-{stop - 1} were never written")
+        offset = start - self._starts[i]
+        return memoryview(self._chunks[i])[offset:offset + stop - start]
+
+
+Store = Union[TempFileStore, SparseMemoryStore]
+
+
+class _LazyZipBase:
+    """File-like object over a partially-downloaded ZIP file.
+
+    Subclasses are responsible for fetching byte ranges; this class only
+    keeps track of which intervals have been downloaded.  The bytes live
+    in store: a SparseMemoryStore (the default) holding just those
+    intervals, or a TempFileStore for callers wanting a real file.
     """
 
     def __init__(
-        self, url: str, chunk_size: int = CONTENT_CHUNK_SIZE
+        self,
+        url: str,
+        chunk_size: int = CONTENT_CHUNK_SIZE,
+        tail_size: int = TAIL_SIZE,
+        store: Optional[Store] = None,
+        cache: Optional[RangeCache] = None,
     ) -> None:
-        session = httpx.Client(follow_redirects=True)
-        head = session.head(url, headers=HEADERS)
-        head.raise_for_status()
-        assert head.status_code == 200
-        self._session, self._url, self._chunk_size = session, url, chunk_size
-        self._length = int(head.headers["Content-Length"])
-        self._file = NamedTemporaryFile()
-        self.truncate(self._length)
+        self._url, self._chunk_size, self._tail_size = url, chunk_size, tail_size
+        self._cache = cache
+        self._length = 0
+        self._pos = 0
+        # Every HTTP request made for this file
+        self.request_count = 0
+        # Last-Modified of the file (its upload time on PyPI), unless served from the cache
+        self.last_modified: Optional[str] = None
+        self._central_directory: Optional[Tuple[int, int, int]] = None
+        self._entries: Optional[List[ZipEntry]] = None
+        self._store = SparseMemoryStore() if store is None else store
         self._left: List[int] = []
         self._right: List[int] = []
-        self._check_zip()
+
+    def _set_length(self, length: int) -> None:
+        self._length = length
+        self.truncate(self._length)
 
     @property
     def mode(self) -> str:
@@ -65,7 +364,7 @@ class LazyZipOverHTTP:
     @property
     def name(self) -> str:
         """Path to the underlying file."""
-        return self._file.name
+        return self._store.name
 
     def seekable(self) -> bool:
         """Return whether random access is supported, which is True."""
@@ -73,26 +372,12 @@ class LazyZipOverHTTP:
 
     def close(self) -> None:
         """Close the file."""
-        self._file.close()
+        self._store.close()
 
     @property
     def closed(self) -> bool:
         """Whether the file is closed."""
-        return self._file.closed
-
-    def read(self, size: int = -1) -> bytes:
-        """Read up to size bytes from the object and return them.
-
-        As a convenience, if size is unspecified or -1,
-        all bytes until EOF are returned.  Fewer than
-        size bytes may be returned if EOF is reached.
-        """
-        download_size = max(size, self._chunk_size)
-        start, length = self.tell(), self._length
-        stop = length if size < 0 else min(start + download_size, length)
-        start = max(0, stop - download_size)
-        self._download(start, stop - 1)
-        return self._file.read(size)
+        return self._store.closed
 
     def readable(self) -> bool:
         """Return whether the file is readable, which is True."""
@@ -106,11 +391,20 @@ class LazyZipOverHTTP:
         * 1: Current position - pos may be negative;
         * 2: End of stream - pos usually negative.
         """
-        return self._file.seek(offset, whence)
+        if whence == 1:
+            offset += self._pos
+        elif whence == 2:
+            offset += self._length
+        elif whence != 0:
+            raise ValueError(f"invalid whence ({whence}, should be 0, 1 or 2)")
+        if offset < 0:
+            raise ValueError(f"negative seek position {offset}")
+        self._pos = offset
+        return self._pos
 
     def tell(self) -> int:
         """Return the current position."""
-        return self._file.tell()
+        return self._pos
 
     def truncate(self, size: Optional[int] = None) -> int:
         """Resize the stream to the given size in bytes.
@@ -120,19 +414,27 @@ class LazyZipOverHTTP:
 
         Return the new file size.
         """
-        return self._file.truncate(size)
+        return self._store.truncate(self._pos if size is None else size)
+
+    def view(self, start: int, stop: int) -> memoryview:
+        """Return a zero-copy view of the downloaded bytes start to stop.
+
+        Unlike read, this neither moves the position nor downloads.
+        """
+        return self._store.view(start, stop)
+
+    def _read_stored(self, size: int) -> bytes:
+        start = self._pos
+        stop = self._length if size < 0 else min(start + size, self._length)
+        if stop <= start:
+            return b""
+        self._pos = stop
+        return bytes(self._store.view(start, stop))
 
     def writable(self) -> bool:
         """Return False."""
         return False
 
-    def __enter__(self) -> "LazyZipOverHTTP":
-        self._file.__enter__()
-        return self
-
-    def __exit__(self, *exc) -> None:
-        self._file.__exit__(*exc)
-
     @contextmanager
     def _stay(self) -> Generator[None, None, None]:
         """Return a context manager keeping the position.
@@ -145,30 +447,225 @@ class LazyZipOverHTTP:
         finally:
             self.seek(pos)
 
-    def _check_zip(self) -> None:
-        """Check and download until the file is a valid ZIP."""
-        end = self._length - 1
-        for start in reversed(range(0, end, self._chunk_size)):
-            self._download(start, end)
-            with self._stay():
-                try:
-                    # For read-only ZIP files, ZipFile only needs
-                    # methods read, seek, seekable and tell.
-                    ZipFile(self)  # type: ignore
-                except BadZipFile:
-                    pass
-                else:
-                    break
+    def _read_range(self, size: int) -> Tuple[int, int]:
+        """Return the inclusive interval to download for a read of size."""
+        download_size = max(size, self._chunk_size)
+        start, length = self.tell(), self._length
+        if size < 0:
+            # Everything until EOF, which a sparse store can't fake with zeros
+            return min(start, max(0, length - download_size)), length - 1
+        stop = min(start + download_size, length)
+        start = max(0, stop - download_size)
+        return start, stop - 1
 
-    def _stream_response(
-        self, start: int, end: int, base_headers: dict[str, str] = HEADERS
-    ):
-        """Return HTTP response to a range request from start to end."""
-        headers = base_headers.copy()
-        headers["Range"] = f"bytes={start}-{end}"
-        # TODO: Get range requests to be correctly cached
+    def _range_headers(self, start: int, end: int) -> dict[str, str]:
+        """Return the headers of a range request from start to end."""
+        return self._headers(f"bytes={start}-{end}")
+
+    def _tail_headers(self) -> dict[str, str]:
+        """Return the headers of a suffix range request for the tail."""
+        return self._headers(f"bytes=-{self._tail_size}")
+
+    def _headers(self, byte_range: str) -> dict[str, str]:
+        headers = HEADERS.copy()
+        headers["Range"] = byte_range
+        # HTTP caches don't do ranges well, RangeCache takes care of that
         headers["Cache-Control"] = "no-cache"
-        return self._session.get(self._url, headers=headers)
+        return headers
+
+    def _tail_of(self, response: httpx.Response) -> Tuple[bytes, int]:
+        """Return the content of the tail request and the file's length.
+
+        The total length comes from Content-Range, so no HEAD is needed
+        (a server ignoring Range just sends the whole file).
+        """
+        self.last_modified = response.headers.get("Last-Modified")
+        content = response.content
+        length = len(content)
+        if response.status_code == 206:
+            length = int(response.headers["Content-Range"].rsplit("/", 1)[1])
+        return content, length
+
+    def _cached_tail(self) -> Optional[Tuple[bytes, int]]:
+        """Return the tail and the file's length from the cache, if there.
+
+        Its Last-Modified comes along, a tail cached without one (before
+        it was stored) is fetched again for it.
+        """
+        if self._cache is None:
+            return None
+        info = self._cache.info(self._url)
+        if info is None or info[1] is None:
+            return None
+        length, last_modified = info
+        content = self._cache.get(self._url, max(0, length - self._tail_size), length - 1)
+        if content is None:
+            return None
+        self.last_modified = last_modified or None
+        return content, length
+
+    def _from_cache(self, start: int, end: int) -> Optional[bytes]:
+        if self._cache is None:
+            return None
+        return self._cache.get(self._url, start, end)
+
+    def _fill_from_cache(self, ranges: List[Tuple[int, int]]) -> List[Tuple[int, int]]:
+        """Mark ranges as downloaded, fill in what the cache has and
+        return the intervals still to be fetched."""
+        missing = []
+        for start, end in ranges:
+            for gap_start, gap_end in self._missing(start, end):
+                cached = self._from_cache(gap_start, gap_end)
+                if cached is None:
+                    missing.append((gap_start, gap_end))
+                else:
+                    self._store.write(gap_start, cached)
+        return missing
+
+    def _to_cache(self, start: int, end: int) -> None:
+        """Persist the downloaded bytes from start to end inclusively."""
+        if self._cache is not None:
+            self._cache.put(
+                self._url, self._length, start, self.view(start, end + 1), self.last_modified or ""
+            )
+
+    def _set_tail(self, content: bytes, length: int) -> Optional[Tuple[int, int]]:
+        """Size and fill the file from its last bytes.
+
+        Return the interval of the central directory, or None if its
+        location isn't within the tail.
+        """
+        self._set_length(length)
+        start = length - len(content)
+        self._missing(start, length - 1)
+        self._write_at(start, [content])
+
+        self._central_directory = _find_central_directory(content, start)
+        if self._central_directory is None:
+            return None
+        cd_offset, cd_size, _ = self._central_directory
+        return cd_offset, cd_offset + cd_size - 1
+
+    def entries(self) -> List[ZipEntry]:
+        """Return the central directory entries, without building a ZipFile."""
+        if self._central_directory is None:
+            with self._stay():
+                return [
+                    ZipEntry(
+                        info.filename,
+                        info.header_offset,
+                        info.compress_size,
+                        info.file_size,
+                        info.compress_type,
+                        info.flag_bits,
+                        info.CRC,
+                    )
+                    for info in ZipFile(self).infolist()  # type: ignore
+                ]
+        if self._entries is None:
+            cd_offset, cd_size, concat = self._central_directory
+            self._entries = _parse_central_directory(
+                self.view(cd_offset, cd_offset + cd_size), concat
+            )
+        return self._entries
+
+    def namelist(self) -> List[str]:
+        """Return the member names, like ZipFile.namelist."""
+        return [entry.name for entry in self.entries()]
+
+    def central_directory(self) -> Optional[Tuple[bytes, int]]:
+        """Return the raw central directory and its concat offset.
+
+        This is all _parse_central_directory needs, so the parsing can be
+        shipped off to another process. None if the end record wasn't
+        found in the tail (entries() then falls back to ZipFile).
+        """
+        if self._central_directory is None:
+            return None
+        cd_offset, cd_size, concat = self._central_directory
+        return bytes(self.view(cd_offset, cd_offset + cd_size)), concat
+
+    def _plan_members(
+        self, names: Iterable[str], gap: int
+    ) -> Tuple[List[ZipEntry], List[Tuple[int, int]]]:
+        """Return the entries of names and the merged intervals holding them.
+
+        Each member spans from its local header to the next local header
+        (or the central directory), and members less than gap bytes apart
+        share an interval.
+        """
+        entries = self.entries()
+        by_name = {entry.name: entry for entry in entries}
+        wanted = [by_name[name] for name in names]
+        offsets = sorted(entry.header_offset for entry in entries)
+        end_of_members = (
+            self._length if self._central_directory is None else self._central_directory[0]
+        )
+        ranges: List[Tuple[int, int]] = []
+        for entry in sorted(wanted, key=lambda e: e.header_offset):
+            i = bisect_right(offsets, entry.header_offset)
+            start = entry.header_offset
+            end = (offsets[i] if i < len(offsets) else end_of_members) - 1
+            if ranges and start - ranges[-1][1] <= gap:
+                ranges[-1] = (ranges[-1][0], max(end, ranges[-1][1]))
+            else:
+                ranges.append((start, end))
+        return wanted, ranges
+
+    def _extract(self, entry: ZipEntry) -> bytes:
+        """Return the uncompressed content of an already-downloaded member."""
+        header = _LOCAL_HEADER.unpack(
+            self.view(entry.header_offset, entry.header_offset + _LOCAL_HEADER.size)
+        )
+        if header[0] != _LOCAL_HEADER_SIGNATURE:
+            raise BadZipFile(f"Bad magic number for file header of {entry.name}")
+        if entry.flag_bits & 0x1 or entry.compress_type not in (ZIP_STORED, ZIP_DEFLATED):
+            # Encrypted, bzip2, lzma...: leave it to ZipFile
+            with self._stay():
+                return ZipFile(self).read(entry.name)  # type: ignore
+        start = entry.header_offset + _LOCAL_HEADER.size + header[-2] + header[-1]
+        data = self.view(start, start + entry.compress_size)
+        if entry.compress_type == ZIP_DEFLATED:
+            content = zlib.decompress(data, -15)
+        else:
+            content = bytes(data)
+        if zlib.crc32(content) != entry.crc:
+            raise BadZipFile(f"Bad CRC-32 for file {entry.name}")
+        return content
+
+    def _multirange_headers(self, ranges: List[Tuple[int, int]]) -> dict[str, str]:
+        return self._headers("bytes=" + ",".join(f"{start}-{end}" for start, end in ranges))
+
+    def _multirange(self, batch: List[Tuple[int, int]]) -> bool:
+        """Return whether to fetch batch through one multi-range request."""
+        return len(batch) > 1 and httpx.URL(self._url).host not in _SINGLE_RANGE_HOSTS
+
+    def _is_multipart(self, response: httpx.Response) -> bool:
+        """Return whether a multi-range request got multipart/byteranges.
+
+        Anything else (the whole file, or the ranges merged into one) is
+        left unread for the caller to drop, and the host is remembered
+        as not doing multi-range.
+        """
+        content_type = response.headers.get("Content-Type", "")
+        if response.status_code == 206 and content_type.startswith("multipart/byteranges"):
+            return True
+        _SINGLE_RANGE_HOSTS.add(httpx.URL(self._url).host)
+        metrics.count("zip_multirange_unsupported_total")
+        return False
+
+    def _write_ranges(self, response: httpx.Response) -> List[Tuple[int, int]]:
+        """Store the body of a multipart/byteranges response.
+
+        Return the inclusive intervals that were actually written.
+        """
+        content_type = response.headers["Content-Type"]
+        boundary = content_type.split("boundary=", 1)[1].strip('"')
+        written = []
+        for start, data in _parse_multipart_byteranges(response.content, boundary.encode()):
+            self._write_at(start, [data])
+            written.append((start, start + len(data) - 1))
+        return written
 
     def _merge(
         self, start: int, end: int, left: int, right: int
@@ -192,14 +689,288 @@ class LazyZipOverHTTP:
             yield i, end
         self._left[left:right], self._right[left:right] = [start], [end]
 
+    def _missing(self, start: int, end: int) -> List[Tuple[int, int]]:
+        """Mark start to end as downloaded and return the gaps to fetch."""
+        left = bisect_left(self._right, start)
+        right = bisect_right(self._left, end)
+        return list(self._merge(start, end, left, right))
+
+    def _covered(self, start: int, end: int) -> bool:
+        """Return whether bytes from start to end were all downloaded."""
+        i = bisect_right(self._left, start) - 1
+        return i >= 0 and self._right[i] >= end
+
+    def _write_at(self, start: int, chunks: Iterable[bytes]) -> None:
+        for chunk in chunks:
+            self._store.write(start, chunk)
+            start += len(chunk)
+
+
+class LazyZipOverHTTP(_LazyZipBase):
+    """File-like object mapped to a ZIP file over HTTP.
+
+    This uses HTTP range requests to lazily fetch the file's content,
+    which is supposed to be fed to ZipFile.  If such requests are not
+    supported by the server, raise HTTPRangeRequestUnsupported
+    during initialization.
+    """
+
+    def __init__(
+        self,
+        url: str,
+        chunk_size: int = CONTENT_CHUNK_SIZE,
+        session: Optional[httpx.Client] = None,
+        tail_size: int = TAIL_SIZE,
+        store: Optional[Store] = None,
+        cache: Optional[RangeCache] = None,
+    ) -> None:
+        super().__init__(url, chunk_size, tail_size, store, cache)
+        self._owns_session = session is None
+        if session is None:
+            session = httpx.Client(follow_redirects=True)
+        self._session = session
+        tail = self._cached_tail()
+        fetched = tail is None
+        if fetched:
+            self.request_count += 1
+            with metrics.timed("zip_request_seconds", op="tail"):
+                response = session.get(url, headers=self._tail_headers())
+            response.raise_for_status()
+            tail = self._tail_of(response)
+        central_directory = self._set_tail(*tail)
+        if fetched:
+            self._to_cache(tail[1] - len(tail[0]), tail[1] - 1)
+        if central_directory is None:
+            self._check_zip()
+        else:
+            self._download(*central_directory)
+
+    def close(self) -> None:
+        """Close the file."""
+        super().close()
+        if self._owns_session:
+            self._session.close()
+
+    def read(self, size: int = -1) -> bytes:
+        """Read up to size bytes from the object and return them.
+
+        As a convenience, if size is unspecified or -1,
+        all bytes until EOF are returned.  Fewer than
+        size bytes may be returned if EOF is reached.
+        """
+        self._download(*self._read_range(size))
+        return self._read_stored(size)
+
+    def __enter__(self) -> "LazyZipOverHTTP":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def _check_zip(self) -> None:
+        """Check and download until the file is a valid ZIP."""
+        end = self._length - 1
+        for start in reversed(range(0, end, self._chunk_size)):
+            metrics.count("zip_check_rounds_total")
+            self._download(start, end)
+            with self._stay():
+                try:
+                    # For read-only ZIP files, ZipFile only needs
+                    # methods read, seek, seekable and tell.
+                    ZipFile(self)  # type: ignore
+                except BadZipFile:
+                    pass
+                else:
+                    break
+
+    def _stream_response(self, start: int, end: int):
+        """Return HTTP response to a range request from start to end."""
+        self.request_count += 1
+        with metrics.timed("zip_request_seconds", op="range"):
+            return self._session.get(self._url, headers=self._range_headers(start, end))
+
     def _download(self, start: int, end: int) -> None:
         """Download bytes from start to end inclusively."""
-        with self._stay():
-            left = bisect_left(self._right, start)
-            right = bisect_right(self._left, end)
-            for start, end in self._merge(start, end, left, right):
-                response = self._stream_response(start, end)
+        for start, end in self._missing(start, end):
+            self._fetch(start, end)
+
+    def _fetch(self, start: int, end: int) -> None:
+        """Fetch bytes from start to end inclusively, from cache if possible."""
+        cached = self._from_cache(start, end)
+        if cached is not None:
+            metrics.count("zip_cache_hits_total")
+            self._store.write(start, cached)
+            return
+        response = self._stream_response(start, end)
+        response.raise_for_status()
+        self._write_at(start, response.iter_bytes(self._chunk_size))
+        self._to_cache(start, end)
+
+    def read_members(self, names: Iterable[str], gap: int = MEMBER_GAP) -> Dict[str, bytes]:
+        """Return the uncompressed content of several members at once.
+
+        The members' byte ranges are planned from the central directory,
+        merged when less than gap bytes apart and fetched together through
+        multi-range requests. A server answering those with anything but
+        multipart/byteranges gets the merged ranges one by one instead.
+        """
+        wanted, ranges = self._plan_members(names, gap)
+        missing = self._fill_from_cache(ranges)
+        for i in range(0, len(missing), MAX_RANGES_PER_REQUEST):
+            batch = missing[i:i + MAX_RANGES_PER_REQUEST]
+            if not self._multirange(batch):
+                for start, end in batch:
+                    self._fetch(start, end)
+                continue
+            self.request_count += 1
+            written = []
+            with metrics.timed("zip_request_seconds", op="members"):
+                with self._session.stream(
+                    "GET", self._url, headers=self._multirange_headers(batch)
+                ) as response:
+                    response.raise_for_status()
+                    if self._is_multipart(response):
+                        response.read()
+                        written = self._write_ranges(response)
+            for start, end in batch:
+                if any(s <= start and end <= e for s, e in written):
+                    self._to_cache(start, end)
+                else:
+                    self._fetch(start, end)
+        return {entry.name: self._extract(entry) for entry in wanted}
+
+
+class AsyncLazyZipOverHTTP(_LazyZipBase):
+    """Asynchronous variant of LazyZipOverHTTP sharing a pooled AsyncClient.
+
+    ZipFile can't await, so reads never touch the network: callers fetch
+    what they need up front (the central directory on entering, members
+    through read_members) and reading anything else raises
+    RangeNotFetched.
+
+        async with AsyncLazyZipOverHTTP(url, client) as zf:
+            names = [name for name in zf.namelist() if name.endswith("/__init__.py")]
+            contents = await zf.read_members(names)
+    """
+
+    def __init__(
+        self,
+        url: str,
+        client: httpx.AsyncClient,
+        chunk_size: int = CONTENT_CHUNK_SIZE,
+        tail_size: int = TAIL_SIZE,
+        store: Optional[Store] = None,
+        cache: Optional[RangeCache] = None,
+    ) -> None:
+        super().__init__(url, chunk_size, tail_size, store, cache)
+        self._client = client
+
+    async def __aenter__(self) -> "AsyncLazyZipOverHTTP":
+        try:
+            # The cache is SQLite, so it's kept off the event loop
+            tail = await asyncio.to_thread(self._cached_tail)
+            fetched = tail is None
+            if fetched:
+                self.request_count += 1
+                with metrics.timed("zip_request_seconds", op="tail"):
+                    response = await self._client.get(self._url, headers=self._tail_headers())
+                response.raise_for_status()
+                tail = self._tail_of(response)
+            central_directory = self._set_tail(*tail)
+            if fetched:
+                await asyncio.to_thread(self._to_cache, tail[1] - len(tail[0]), tail[1] - 1)
+            if central_directory is None:
+                await self._check_zip()
+            else:
+                await self.prefetch(*central_directory)
+        except BaseException:
+            self.close()
+            raise
+        return self
+
+    async def __aexit__(self, *exc) -> None:
+        self.close()
+
+    def read(self, size: int = -1) -> bytes:
+        """Read up to size already-fetched bytes from the object."""
+        start = self.tell()
+        stop = self._length if size < 0 else min(start + size, self._length)
+        if stop > start and not self._covered(start, stop - 1):
+            raise RangeNotFetched(self._url, *self._read_range(size))
+        return self._read_stored(size)
+
+    async def prefetch(self, start: int, end: int) -> None:
+        """Download bytes from start to end inclusively."""
+        for start, end in self._missing(start, end):
+            await self._fetch(start, end)
+
+    async def _fetch(self, start: int, end: int) -> None:
+        """Fetch bytes from start to end inclusively, from cache if possible."""
+        cached = await asyncio.to_thread(self._from_cache, start, end)
+        if cached is not None:
+            metrics.count("zip_cache_hits_total")
+            self._store.write(start, cached)
+            return
+        self.request_count += 1
+        with metrics.timed("zip_request_seconds", op="range"):
+            async with self._client.stream(
+                "GET", self._url, headers=self._range_headers(start, end)
+            ) as response:
                 response.raise_for_status()
-                self.seek(start)
-                for chunk in response.iter_bytes(self._chunk_size):
-                    self._file.write(chunk)
+                pos = start
+                async for chunk in response.aiter_bytes(self._chunk_size):
+                    self._store.write(pos, chunk)
+                    pos += len(chunk)
+        await asyncio.to_thread(self._to_cache, start, end)
+
+    async def read_members(self, names: Iterable[str], gap: int = MEMBER_GAP) -> Dict[str, bytes]:
+        """Return the uncompressed content of several members at once.
+
+        See LazyZipOverHTTP.read_members.
+        """
+        wanted, ranges = self._plan_members(names, gap)
+        missing = await asyncio.to_thread(self._fill_from_cache, ranges)
+        for i in range(0, len(missing), MAX_RANGES_PER_REQUEST):
+            batch = missing[i:i + MAX_RANGES_PER_REQUEST]
+            if not self._multirange(batch):
+                for start, end in batch:
+                    await self._fetch(start, end)
+                continue
+            self.request_count += 1
+            written = []
+            with metrics.timed("zip_request_seconds", op="members"):
+                async with self._client.stream(
+                    "GET", self._url, headers=self._multirange_headers(batch)
+                ) as response:
+                    response.raise_for_status()
+                    if self._is_multipart(response):
+                        await response.aread()
+                        written = self._write_ranges(response)
+            for start, end in batch:
+                if any(s <= start and end <= e for s, e in written):
+                    await asyncio.to_thread(self._to_cache, start, end)
+                else:
+                    await self._fetch(start, end)
+        return {entry.name: self._extract(entry) for entry in wanted}
+
+    async def _check_zip(self) -> None:
+        """Check and download until the file is a valid ZIP.
+
+        Whatever ZipFile tried to read past the fetched bytes is fetched
+        before retrying, which is what LazyZipOverHTTP.read does inline.
+        """
+        end = self._length - 1
+        for start in reversed(range(0, end, self._chunk_size)):
+            metrics.count("zip_check_rounds_total")
+            await self.prefetch(start, end)
+            while True:
+                with self._stay():
+                    try:
+                        ZipFile(self)  # type: ignore
+                    except RangeNotFetched as e:
+                        await self.prefetch(e.start, e.end)
+                        continue
+                    except BadZipFile:
+                        break
+                    else:
+                        return
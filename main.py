@@ -1,81 +1,199 @@
+import asyncio
+import os
 import pathlib
-from concurrent.futures import ThreadPoolExecutor
 
+from cpu_pool import CpuPool
+import metrics
 from package_database import PackageDatabase
-from pypi_scraper import PyPIScraper
-
-def _chunked(iterable, n):
-    chunk = []
-    for item in iterable:
-        chunk.append(item)
-        if len(chunk) == n:
-            yield chunk
-            chunk = []
-
-    if chunk:  # Yield the last chunk if it's not empty
-        yield chunk
-
-def process_package(db, scraper, package_name, package_pos):
-    print(package_name)
-    result = scraper.scrape_package(package_name)
-    if result:
-        wheel_info, filepaths = result
-        db.insert_package(**wheel_info, package_pos=package_pos, filepaths=filepaths)
-        print(f"Finished processing {package_name}")
-    else:
-        print(f"No suitable package found for {package_name}")
+from pipeline import Pipeline
+from pypi_scraper import GH_RELEASES_URL, PYPI_SIMPLE_URL, AsyncPyPIScraper
+from range_cache import RangeCache, cache_key
+from shards import shard_of, shard_path
 
-def process_duplicates(db, scraper, package_name, url, filepaths):
-    print(url, len(filepaths))
-    namespaces = set(scraper.is_explicit_namespace_package(url, filepaths))
-    for filepath in filepaths:
-        db.check_and_store_namespace_package(package_name, filepath, filepath in namespaces)
+# How many packages/wheels are in flight at once (also the HTTP pool size);
+# per-host limits on top of that are in http_scheduler.HOST_LIMITS
+CONCURRENCY = int(os.getenv("CONCURRENCY", "200"))
+# Where fetched wheel byte ranges are kept between runs ("" disables it)
+RANGE_CACHE = os.getenv("RANGE_CACHE", "range_cache.sqlite")
+RANGE_CACHE_MAX_BYTES = int(os.getenv("RANGE_CACHE_MAX_BYTES", str(2 * 1024 ** 3)))
+# Worker processes for zip parsing, namespace scanning and prefixes (0 runs them inline)
+CPU_WORKERS = int(os.getenv("CPU_WORKERS", "0"))
+# Recheck every package, not just the missing ones, and redo the later stages only where something changed
+REFRESH = os.getenv("REFRESH", "") not in ("", "0")
+# Only crawl the packages whose crawl failed before (see the failed_packages table)
+RETRY_FAILED = os.getenv("RETRY_FAILED", "") not in ("", "0")
+DB_PATH = os.getenv("DB_PATH", "package_database.sqlite")
+# Crawl only shard SHARD (0 to SHARDS - 1) of packages.txt into its own DB, see shards.py
+SHARDS = int(os.getenv("SHARDS", "0"))
+SHARD = int(os.getenv("SHARD", "0"))
+# Create a new DB with normalized filepaths (see PackageDatabase), an existing one keeps its layout
+COMPACT_FILEPATHS = os.getenv("COMPACT_FILEPATHS", "") not in ("", "0")
+# The simple index to crawl (e.g. a mirror, or bench_offline.py's fake one) and the GitHub releases fallback
+INDEX_URL = os.getenv("INDEX_URL", PYPI_SIMPLE_URL)
+GH_RELEASES_URL = os.getenv("GH_RELEASES_URL", GH_RELEASES_URL)
+# Append a metrics snapshot (see metrics.py) to this JSON-lines file every METRICS_INTERVAL
+# seconds, and serve them to Prometheus on 127.0.0.1:METRICS_PORT ("" and 0 disable them)
+METRICS_FILE = os.getenv("METRICS_FILE", "")
+METRICS_INTERVAL = float(os.getenv("METRICS_INTERVAL", "10"))
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
 
-# @TODO: Lowest common ancestor
-def find_nested_common_prefixes(paths):
-    parents = set((path.parent if path.stem == "__init__" else path.with_suffix("")) for path in paths)
-    for parent in sorted(parents, key=lambda p: len(p.parts)):
-        for ancestor in parent.parents:
-            if ancestor in parents:
-                parents.remove(parent)
-                break
+async def _work_queue(fn, items, workers, on_error):
+    """Run fn on every item with `workers` tasks taking the next item as soon
+    as they're free, so a slow item only ever holds up its own worker.
 
-    return sorted(parents)
+    An item failing is handed to on_error(item, error) instead of ending the run.
+    """
+    # The iterator is the queue: next() never awaits, so no two workers get the same item
+    items = iter(items)
+    in_flight = 0
 
-def main():
-    db = PackageDatabase()
+    async def worker():
+        nonlocal in_flight
+        for item in items:
+            in_flight += 1
+            metrics.gauge("crawl_in_flight", in_flight)
+            try:
+                await fn(item)
+            except Exception as e:
+                on_error(item, e)
+            finally:
+                in_flight -= 1
+                metrics.gauge("crawl_in_flight", in_flight)
+
+    await asyncio.gather(*(worker() for _ in range(workers)))
+
+def _dead_letters(db, stage, failed):
+    """Return on_error and on_success callbacks keeping failed_packages up to date."""
+    def on_error(package_name, error):
+        print(f"Failed {stage} of {package_name}: {error!r}")
+        metrics.count("failures_total", stage=stage)
+        db.record_failure(package_name, stage, repr(error))
+
+    def on_success(package_name):
+        if package_name in failed:
+            db.clear_failure(package_name, stage)
+
+    return on_error, on_success
+
+def _same_wheel(wheel_url, url, sha256):
+    bare_url, key = cache_key(wheel_url)
+    if key and sha256:
+        return key == f"sha256={sha256}"
+    return bare_url == url
+
+async def process_package(db, scraper, package_name, package_pos, state, pipeline):
+    url, sha256, etag, last_modified = state or (None, None, None, None)
+    wheel_files, etag, last_modified = await scraper.get_simple_page(package_name, etag, last_modified)
+    if wheel_files is None:
+        metrics.count("packages_total", outcome="unchanged_page")
+        return
+    wheel_url = await scraper.pick_wheel_url(package_name, wheel_files)
+    if wheel_url is None:
+        print(f"No suitable package found for {package_name}")
+        metrics.count("packages_total", outcome="no_wheel")
+    elif _same_wheel(wheel_url, url, sha256):
+        metrics.count("packages_total", outcome="unchanged_wheel")
+    else:
+        wheel_info, filepaths = await scraper.scrape_wheel(wheel_url)
+        db.insert_package(**wheel_info, package_pos=package_pos, filepaths=filepaths)
+        if pipeline is not None:
+            pipeline.add_package(wheel_info["package_name"], wheel_info["url"], filepaths)
+        metrics.count("packages_total", outcome="stored")
+    # Only once the wheel is stored, so a failed scrape is retried next run
+    db.set_simple_page(package_name, etag, last_modified)
+
+async def amain():
+    sharded = SHARDS > 1
+    db = PackageDatabase(shard_path(DB_PATH, SHARD, SHARDS) if sharded else DB_PATH, compact=COMPACT_FILEPATHS)
     db.create_tables()
-    scraper = PyPIScraper()
+    cache = RangeCache(RANGE_CACHE, RANGE_CACHE_MAX_BYTES) if RANGE_CACHE else None
+    cpu = CpuPool(CPU_WORKERS)
+    scraper = AsyncPyPIScraper(
+        max_connections=CONCURRENCY, cache=cache, cpu=cpu, index_url=INDEX_URL, gh_releases_url=GH_RELEASES_URL,
+    )
 
-    with ThreadPoolExecutor(max_workers=20) as executor:
-        packages = pathlib.Path("packages.txt").read_text().splitlines()
-        packages = [scraper.normalize(pkg) for pkg in packages]
-        pos_by_pkg = {pkg: i+1 for i, pkg in enumerate(packages)}
-        missing_packages = db.get_missing_packages(packages)
+    with cpu, db.writer():
+        try:
+            packages = pathlib.Path("packages.txt").read_text().splitlines()
+            packages = [scraper.normalize(pkg) for pkg in packages]
+            pos_by_pkg = {pkg: i+1 for i, pkg in enumerate(packages)}
+            # A shard keeps the positions in the full list, the merge relies on them
+            wanted = [pkg for pkg in packages if shard_of(pkg, SHARDS) == SHARD] if sharded else packages
+            failed = set(db.get_failed_packages("crawl"))
+            if RETRY_FAILED:
+                targets = [pkg for pkg in wanted if pkg in failed]
+            else:
+                targets = wanted if REFRESH else db.get_missing_packages(wanted)
+            states = db.get_package_states(targets)
 
-        print(f"launching {len(missing_packages)} tasks")
-        for chunk in _chunked(missing_packages, 100):
-            list(executor.map(lambda pkg: process_package(db, scraper, pkg, pos_by_pkg[pkg]), chunk))
+            # Namespace checks (no RETRY_FAILED needed for those, what failed is
+            # still missing next run) and prefixes run as the crawl goes; a
+            # shard only crawls, they need every shard's packages
+            pipeline = None
+            # With nothing to crawl and no namespace check left in the journal, there's nothing to seed
+            seeded = bool(targets) or not db.stage_finished("namespace")
+            if not sharded:
+                pipeline = Pipeline(db, scraper, cpu, *_dead_letters(db, "namespace", set(db.get_failed_packages("namespace"))))
+                if seeded:
+                    pipeline.seed()
+                pipeline.start(CONCURRENCY)
+            on_error, on_success = _dead_letters(db, "crawl", failed)
 
-        # =====
+            async def crawl(pkg):
+                await process_package(db, scraper, pkg, pos_by_pkg[pkg], states.get(pkg), pipeline)
+                on_success(pkg)
+                # The writes queue up without blocking the loop, the crawl waits for the writer here
+                await db.writer_room()
 
-        duplicate_filepaths = db.get_duplicate_dunder_inits()
-        print(len(duplicate_filepaths))
-        filepaths_by_url = db.get_missing_dup_filepaths_by_url(duplicate_filepaths)
-        for chunk in _chunked(filepaths_by_url.items(), 10):
-            list(executor.map(lambda x: process_duplicates(db, scraper, x[0][0], x[0][1], x[1]), chunk))
+            print(f"launching {len(targets)} tasks")
+            metrics.gauge("crawl_targets", len(targets))
+            with metrics.timed("stage_seconds", stage="crawl"):
+                await _work_queue(crawl, targets, CONCURRENCY, on_error)
+            print(f"requests per wheel: {dict(sorted(scraper.requests_per_wheel.items()))}")
+            if pipeline is not None:
+                with metrics.timed("stage_seconds", stage="pipeline_drain"):
+                    await pipeline.finish()
+                if seeded:
+                    # Every check the DB was missing went through this run
+                    db.finish_stage("namespace")
+            if scraper.scheduler is not None:
+                print(scraper.scheduler.report())
+        finally:
+            await scraper.aclose()
 
         # =====
-        prefixes = {}
-        for package, filepaths in db.iterate_filepaths():
-            filepaths = [
-                filepath for filepath in filepaths
-                if not any(filepath.startswith(prefix) for prefix in ("test/", "tests/", "doc/", "docs/", "example/", "examples/", "benchmark/", "benchmarks/", "script/", "scripts/", "bin/", "samples/"))
-            ]
-            prefixes[package] = list(map(str, find_nested_common_prefixes(list(map(pathlib.Path, filepaths)))))
-
-        for package, prefix_list in prefixes.items():
-            db.insert_package_prefixes(package, prefix_list)
+        if pipeline is None:
+            print(f"crawled shard {SHARD} of {SHARDS} into {db.db_path}, the rest waits for shards.py merge")
+        else:
+            if seeded:
+                with metrics.timed("stage_seconds", stage="namespace_prune"):
+                    db.prune_namespace_packages()
+            await asyncio.to_thread(db.flush)
+            # Whatever the journal has left: packages stored or with new namespace
+            # results since their prefixes, and those cut short by a crash
+            pending = db.get_open_units("prefixes")
+            print(f"recomputing prefixes of {len(pending)} packages")
+            filepaths = db.iterate_filepaths(packages=pending) if pending else ()
+            with metrics.timed("stage_seconds", stage="prefixes"):
+                done = set()
+                for package, prefix_list in cpu.package_prefixes(filepaths):
+                    db.insert_package_prefixes(package, prefix_list)
+                    done.add(package)
+                # No files left once the namespace `__init__.py`s are out, so no prefixes either
+                for package in set(pending) - done:
+                    db.insert_package_prefixes(package, [])
+        # Committed off the loop, so closing the writer has nothing left to wait for
+        await asyncio.to_thread(db.flush)
+
+    db.close()
+
+def main():
+    if METRICS_FILE or METRICS_PORT:
+        metrics.configure(METRICS_FILE, METRICS_INTERVAL, METRICS_PORT)
+    try:
+        asyncio.run(amain())
+    finally:
+        metrics.close()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,265 @@
+"""Counters, gauges and latency histograms, off unless configure()d.
+
+    metrics.count("http_requests_total", host="pypi.org", status="200")
+    metrics.observe("http_request_seconds", 0.12, host="pypi.org")
+    metrics.gauge("crawl_in_flight", 180)
+    with metrics.timed("stage_seconds", stage="crawl"):
+        ...
+
+Until configure() is called every one of these returns right away, so
+instrumented code costs a function call per event. Once configured, the
+values are kept per (name, labels) series. Every interval seconds a
+snapshot is appended to a JSON-lines file, and a Prometheus text
+endpoint can be served on a local port.
+"""
+from bisect import bisect_left
+import functools
+import inspect
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Upper bounds (seconds) of the histogram buckets, the last one catches the rest
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, float("inf"))
+QUANTILES = (0.5, 0.9, 0.99)
+
+_registry = None
+
+
+def _series(name, labels):
+    if not labels:
+        return name
+    return name + "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+
+class _Histogram:
+    __slots__ = ("counts", "count", "sum")
+
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(BUCKETS, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        """The upper bound of the bucket the q-quantile falls in."""
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(BUCKETS, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return BUCKETS[-1]
+
+
+class Registry:
+    """Every series so far. Safe to update from any thread."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+
+    def count(self, name, value, labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def gauge(self, name, value, labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.gauges[key] = value
+
+    def observe(self, name, value, labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = _Histogram()
+            histogram.observe(value)
+
+    def snapshot(self):
+        """Return the current values as a JSON-able dict."""
+        with self._lock:
+            histograms = {
+                _series(name, labels): {
+                    "count": histogram.count,
+                    "sum": round(histogram.sum, 6),
+                    **{f"p{round(q * 100)}": histogram.quantile(q) for q in QUANTILES},
+                }
+                for (name, labels), histogram in self.histograms.items()
+            }
+            return {
+                "time": time.time(),
+                "counters": {_series(*key): value for key, value in self.counters.items()},
+                "gauges": {_series(*key): value for key, value in self.gauges.items()},
+                "histograms": histograms,
+            }
+
+    def prometheus(self):
+        """Return the current values in the Prometheus text format."""
+        lines = []
+        with self._lock:
+            for kind, series in (("counter", self.counters), ("gauge", self.gauges)):
+                typed = set()
+                for (name, labels), value in sorted(series.items()):
+                    if name not in typed:
+                        typed.add(name)
+                        lines.append(f"# TYPE {name} {kind}")
+                    lines.append(f"{_series(name, labels)} {value}")
+            typed = set()
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                if name not in typed:
+                    typed.add(name)
+                    lines.append(f"# TYPE {name} histogram")
+                cumulative = 0
+                for bound, count in zip(BUCKETS, histogram.counts):
+                    cumulative += count
+                    le = "+Inf" if bound == float("inf") else repr(bound)
+                    lines.append(f"{_series(name + '_bucket', labels + (('le', le),))} {cumulative}")
+                lines.append(f"{_series(name + '_sum', labels)} {histogram.sum}")
+                lines.append(f"{_series(name + '_count', labels)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+
+class _Timer:
+    __slots__ = ("name", "labels", "started")
+
+    def __init__(self, name, labels):
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        if _registry is not None:
+            _registry.observe(self.name, time.perf_counter() - self.started, self.labels)
+
+
+class _NullTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+
+_NULL_TIMER = _NullTimer()
+
+
+def count(name, value=1, **labels):
+    if _registry is not None:
+        _registry.count(name, value, labels)
+
+
+def gauge(name, value, **labels):
+    if _registry is not None:
+        _registry.gauge(name, value, labels)
+
+
+def observe(name, value, **labels):
+    if _registry is not None:
+        _registry.observe(name, value, labels)
+
+
+def timed(name, **labels):
+    """Context manager observing how long its block took, in seconds."""
+    if _registry is None:
+        return _NULL_TIMER
+    return _Timer(name, labels)
+
+
+def timed_calls(name, **labels):
+    """Decorator timing every call of a function (or coroutine function) with timed()."""
+    def decorate(fn):
+        if inspect.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def wrapper(*args, **kwargs):
+                with timed(name, **labels):
+                    return await fn(*args, **kwargs)
+        else:
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                with timed(name, **labels):
+                    return fn(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+class _Reporter(threading.Thread):
+    """Appends a snapshot to path every interval seconds, and once more when stopped."""
+
+    def __init__(self, registry, path, interval):
+        super().__init__(name="MetricsReporter", daemon=True)
+        self.registry = registry
+        self.path = path
+        self.interval = interval
+        self._stopped = threading.Event()
+
+    def run(self):
+        with open(self.path, "a") as f:
+            while not self._stopped.wait(self.interval):
+                self._write(f)
+            self._write(f)
+
+    def _write(self, f):
+        f.write(json.dumps(self.registry.snapshot()) + "\n")
+        f.flush()
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+
+
+class _PrometheusHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        body = self.server.registry.prometheus().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+_reporter = None
+_server = None
+
+
+def configure(path=None, interval=10.0, port=None):
+    """Start recording; snapshot to the JSON-lines file at path and serve
+    /metrics on 127.0.0.1:port, for those given."""
+    global _registry, _reporter, _server
+    _registry = Registry()
+    if path:
+        _reporter = _Reporter(_registry, path, interval)
+        _reporter.start()
+    if port:
+        _server = ThreadingHTTPServer(("127.0.0.1", port), _PrometheusHandler)
+        _server.daemon_threads = True
+        _server.registry = _registry
+        threading.Thread(target=_server.serve_forever, name="MetricsServer", daemon=True).start()
+    return _registry
+
+
+def close():
+    """Write the last snapshot and stop recording."""
+    global _registry, _reporter, _server
+    if _reporter is not None:
+        _reporter.stop()
+        _reporter = None
+    if _server is not None:
+        _server.shutdown()
+        _server.server_close()
+        _server = None
+    _registry = None
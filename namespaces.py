@@ -0,0 +1,27 @@
+"""Spot the `__init__.py`s declaring a pkg_resources/pkgutil namespace.
+
+Kept free of the crawler's dependencies, so the CPU pool's worker
+processes can import it cheaply.
+"""
+import re
+
+WS = "\\s*"
+EXPLICIT_NS_PKG = re.compile(
+    "|".join(
+        [
+            f"(^.+extend_path\\(__path__,{WS}__name__\\))",
+            f"(^.+declare_namespace\\(__name__\\))",
+        ]
+    ),
+    flags=re.MULTILINE
+)
+
+
+def find_explicit_namespaces(members):
+    """Return the filepaths of the (filepath, raw bytes) members declaring a namespace."""
+    result = []
+    for filepath, content in members:
+        content = content.decode("utf-8").replace("\r", "")
+        if re.search(EXPLICIT_NS_PKG, content):
+            result.append(filepath)
+    return result
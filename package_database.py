@@ -1,35 +1,320 @@
+import asyncio
+from contextlib import closing, contextmanager
+from itertools import chain, groupby
+from operator import itemgetter
+import os
 from pathlib import PurePath
+import queue
 import re
 import sqlite3
+import threading
+import time
 from collections import defaultdict
 
+import metrics
+
 def _valid_modname(s):
     return re.match(r"^[a-zA-Z_][a-zA-Z0-9_]*$", s)
 
+def indexed_filepaths(filepaths):
+    """Return the filepaths insert_package stores: modules, minus wheel .data files."""
+    return [
+        filepath for filepath in filepaths
+        if any(
+            filepath.endswith(suffix) for suffix in (
+                ".py", ".so", ".dylib", ".pyd"
+            )
+        ) and ".data/" not in filepath
+    ]
+
+def _split_filepath(filepath):
+    """Split a filepath into its directory (up to and including the last "/",
+    "" at the top level) and basename, so that dir + basename == filepath."""
+    i = filepath.rfind("/") + 1
+    return filepath[:i], filepath[i:]
+
+def _connect(db_path, **kwargs):
+    db = sqlite3.connect(db_path, timeout=60, **kwargs)
+    db.execute("PRAGMA journal_mode=WAL")
+    # WAL makes NORMAL durable across app crashes, only an OS crash can lose the last commits
+    db.execute("PRAGMA synchronous=NORMAL")
+    db.execute("PRAGMA temp_store=MEMORY")
+    db.execute("PRAGMA cache_size=-65536")
+    db.execute("PRAGMA mmap_size=1073741824")
+    return db
+
+def _connect_read_only(db_path, **kwargs):
+    # No journal_mode change: that would rewrite the file (e.g. a published DB) on open
+    db = sqlite3.connect(f"{PurePath(os.path.abspath(db_path)).as_uri()}?mode=ro", uri=True, timeout=60, **kwargs)
+    db.execute("PRAGMA temp_store=MEMORY")
+    db.execute("PRAGMA cache_size=-65536")
+    db.execute("PRAGMA mmap_size=1073741824")
+    return db
+
+def _on_event_loop():
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return False
+    return True
+
+def _resolve(future):
+    if not future.done():
+        future.set_result(None)
+
+class DatabaseWriter(threading.Thread):
+    """The one thread writing to the DB, in batched transactions.
+
+    Workers submit units of work (a list of (sql, rows) executemany calls)
+    through a queue; the writer commits whenever batch_rows rows are
+    pending or max_delay seconds have passed since the first of them. A
+    unit is never split across transactions.
+
+    Once max_pending units are queued, submitting waits for the writer,
+    except on an event loop: there it never blocks, and the coroutines
+    producing the writes await room() instead.
+    """
+
+    def __init__(self, db_path, batch_rows=10_000, max_delay=1.0, max_pending=10_000):
+        super().__init__(name="DatabaseWriter", daemon=True)
+        self.db_path = db_path
+        self.batch_rows = batch_rows
+        self.max_delay = max_delay
+        self.max_pending = max_pending
+        self._queue = queue.Queue()
+        # Callbacks of whoever waits for the queue to shrink
+        self._room_waiters = []
+        self._room_lock = threading.Lock()
+        self._error = None
+        self.rows = 0
+        self.transactions = 0
+        self.busy_seconds = 0.0
+        self._started_at = time.monotonic()
+
+    def _check(self):
+        if self._error is not None:
+            raise RuntimeError("the database writer failed, see above") from self._error
+
+    def _full(self, wake):
+        """Return whether max_pending units are queued, and if so have wake()
+        called once the writer takes one."""
+        with self._room_lock:
+            if self._queue.qsize() < self.max_pending or not self.is_alive():
+                return False
+            self._room_waiters.append(wake)
+            return True
+
+    def submit(self, unit):
+        self._check()
+        if not _on_event_loop():
+            room = threading.Event()
+            while self._full(room.set):
+                room.wait()
+                room.clear()
+                self._check()
+        self._queue.put(unit)
+
+    async def room(self):
+        """Wait until fewer than max_pending units are queued."""
+        loop = asyncio.get_running_loop()
+        while True:
+            self._check()
+            waiter = loop.create_future()
+            if not self._full(lambda: loop.call_soon_threadsafe(_resolve, waiter)):
+                return
+            await waiter
+
+    def _wake(self):
+        # Called on every get, like a bounded queue.Queue; mostly nobody waits
+        if not self._room_waiters:
+            return
+        with self._room_lock:
+            waiters, self._room_waiters = self._room_waiters, []
+        for wake in waiters:
+            try:
+                wake()
+            except RuntimeError:
+                # Its loop is closed, no one is waiting any more
+                pass
+
+    def flush(self):
+        """Block until everything submitted so far is committed."""
+        done = threading.Event()
+        self._queue.put(done)
+        done.wait()
+        self._check()
+
+    def close(self):
+        self._queue.put(None)
+        self.join()
+        print(self.report())
+        self._check()
+
+    def report(self):
+        elapsed = time.monotonic() - self._started_at
+        return (
+            f"db writer: {self.rows} rows in {self.transactions} transactions, "
+            f"{self.rows / max(elapsed, 1e-9):.0f} rows/s overall, "
+            f"{self.rows / max(self.busy_seconds, 1e-9):.0f} rows/s while writing"
+        )
+
+    def run(self):
+        db = _connect(self.db_path)
+        try:
+            stopping = False
+            while not stopping:
+                item = self._queue.get()
+                self._wake()
+                batch, waiters, rows = [], [], 0
+                deadline = time.monotonic() + self.max_delay
+                while True:
+                    if item is None:
+                        stopping = True
+                    elif isinstance(item, threading.Event):
+                        waiters.append(item)
+                    else:
+                        batch.append(item)
+                        rows += sum(len(params) for _, params in item)
+                    if stopping or waiters or rows >= self.batch_rows:
+                        break
+                    try:
+                        item = self._queue.get(timeout=max(0, deadline - time.monotonic()))
+                    except queue.Empty:
+                        break
+                    self._wake()
+                if batch:
+                    self._commit(db, batch, rows)
+                for waiter in waiters:
+                    waiter.set()
+        finally:
+            db.close()
+            self._wake()
+
+    def _commit(self, db, batch, rows):
+        if self._error is not None:
+            return
+        started = time.monotonic()
+        try:
+            with db:
+                for unit in batch:
+                    for sql, params in unit:
+                        db.executemany(sql, params)
+        except sqlite3.Error as e:
+            e.add_note(f"while writing a batch of {len(batch)} units")
+            self._error = e
+            return
+        elapsed = time.monotonic() - started
+        self.busy_seconds += elapsed
+        self.rows += rows
+        self.transactions += 1
+        metrics.observe("db_transaction_seconds", elapsed)
+        metrics.count("db_rows_total", rows)
+        metrics.count("db_transactions_total")
+        metrics.gauge("db_write_queue", self._queue.qsize())
+
 class PackageDatabase:
-    def __init__(self, db_path="package_database.sqlite"):
+    """The package DB.
+
+    With compact=True a new DB stores filepaths normalized: packages get
+    integer ids, directories and basenames are interned in the dirs and
+    segments tables, and each file is a (package_id, dir_id, basename_id)
+    row of files. A `filepaths` view with the usual (package_name,
+    filepath) columns is kept for readers. An existing DB keeps the layout
+    it was created with.
+
+    With read_only=True the file is only ever opened read-only (for the
+    readers of a finished, possibly published, DB), and left as it is.
+    """
+
+    def __init__(self, db_path="package_database.sqlite", compact=False, read_only=False):
         self.db_path = db_path
+        self.compact = compact
+        self.read_only = read_only
+        self._writer = None
+        self._reader = None
+        self._reader_lock = threading.Lock()
+
+    @contextmanager
+    def writer(self, **kwargs):
+        """Route every write through a DatabaseWriter while in the block."""
+        self._writer = DatabaseWriter(self.db_path, **kwargs)
+        self._writer.start()
+        try:
+            yield self._writer
+        finally:
+            writer, self._writer = self._writer, None
+            writer.close()
+
+    def flush(self):
+        """Make the writes submitted so far visible to readers."""
+        if self._writer is not None:
+            self._writer.flush()
+
+    async def writer_room(self):
+        """Wait, without blocking the event loop, while the DatabaseWriter
+        (if any) is max_pending units behind."""
+        if self._writer is not None:
+            await self._writer.room()
+
+    def _write(self, unit):
+        if self._writer is not None:
+            self._writer.submit(unit)
+            return
+        with closing(_connect(self.db_path)) as db, db:
+            for sql, params in unit:
+                db.executemany(sql, params)
+
+    def _reader_connection(self):
+        # One long-lived connection shared by every reader, used under _reader_lock
+        if self._reader is None:
+            # Autocommit, so filling temp tables doesn't pin a stale read snapshot
+            connect = _connect_read_only if self.read_only else _connect
+            self._reader = connect(self.db_path, check_same_thread=False, isolation_level=None)
+        return self._reader
+
+    def _read(self, query, params=()):
+        waiting = time.perf_counter()
+        with self._reader_lock:
+            metrics.observe("db_reader_lock_wait_seconds", time.perf_counter() - waiting)
+            with metrics.timed("db_read_seconds"):
+                return self._reader_connection().execute(query, params).fetchall()
 
     def create_tables(self):
-        with sqlite3.connect(self.db_path) as db:
-            # FIXME: Add date of URL upload (how recent)
+        with closing(_connect(self.db_path)) as db, db:
             db.execute("""
                 CREATE TABLE IF NOT EXISTS packages (
                     package_name TEXT PRIMARY KEY,
                     package_version TEXT,
                     package_pos UNSIGNED INT,
-                    url TEXT
+                    url TEXT,
+                    upload_time TEXT,
+                    sha256 TEXT
                 )
             """)
+            self._add_missing_columns(db, "packages", {"upload_time": "TEXT", "sha256": "TEXT"})
+            # Validators of each package's simple index page, for conditional requests
             db.execute("""
-                CREATE TABLE IF NOT EXISTS filepaths (
-                    package_name TEXT,
-                    filepath TEXT,
-                    PRIMARY KEY (package_name, filepath),
-                    FOREIGN KEY (package_name) REFERENCES packages (package_name)
+                CREATE TABLE IF NOT EXISTS simple_pages (
+                    package_name TEXT PRIMARY KEY,
+                    etag TEXT,
+                    last_modified TEXT
                 )
             """)
-            db.execute("CREATE INDEX IF NOT EXISTS idx_filepaths_filepath ON filepaths(filepath)")
+            layout = db.execute("SELECT type FROM sqlite_master WHERE name = 'filepaths'").fetchone()
+            if layout is not None:
+                self.compact = layout[0] == "view"
+            if self.compact:
+                self._create_compact_filepaths(db)
+            else:
+                db.execute("""
+                    CREATE TABLE IF NOT EXISTS filepaths (
+                        package_name TEXT,
+                        filepath TEXT,
+                        PRIMARY KEY (package_name, filepath),
+                        FOREIGN KEY (package_name) REFERENCES packages (package_name)
+                    )
+                """)
+                db.execute("CREATE INDEX IF NOT EXISTS idx_filepaths_filepath ON filepaths(filepath)")
             db.execute("""
                 CREATE TABLE IF NOT EXISTS namespace_packages (
                     package_name TEXT,
@@ -49,108 +334,597 @@ class PackageDatabase:
                 )
             """)
             db.execute("CREATE INDEX IF NOT EXISTS idx_package_prefixes_prefix ON package_prefixes(prefix)")
+            # Dead letters: what failed in which stage, to retry without redoing the rest
+            db.execute("""
+                CREATE TABLE IF NOT EXISTS failed_packages (
+                    package_name TEXT,
+                    stage TEXT,
+                    error TEXT,
+                    attempts INTEGER,
+                    failed_at REAL,
+                    PRIMARY KEY (package_name, stage)
+                )
+            """)
+            self._create_dunder_init_counts(db)
+            self._create_stage_progress(db)
+
+    def _add_missing_columns(self, db, table, columns):
+        # For DBs created before the columns existed
+        existing = {row[1] for row in db.execute(f"PRAGMA table_info({table})")}
+        for name, type_ in columns.items():
+            if name not in existing:
+                db.execute(f"ALTER TABLE {table} ADD COLUMN {name} {type_}")
+
+    def _create_compact_filepaths(self, db):
+        db.execute("""
+            CREATE TABLE IF NOT EXISTS package_ids (
+                package_id INTEGER PRIMARY KEY,
+                package_name TEXT UNIQUE
+            )
+        """)
+        # Up to and including the last "/", "" for the top level
+        db.execute("""
+            CREATE TABLE IF NOT EXISTS dirs (
+                dir_id INTEGER PRIMARY KEY,
+                path TEXT UNIQUE
+            )
+        """)
+        db.execute("""
+            CREATE TABLE IF NOT EXISTS segments (
+                segment_id INTEGER PRIMARY KEY,
+                segment TEXT UNIQUE
+            )
+        """)
+        db.execute("""
+            CREATE TABLE IF NOT EXISTS files (
+                package_id INTEGER,
+                dir_id INTEGER,
+                basename_id INTEGER,
+                PRIMARY KEY (package_id, dir_id, basename_id)
+            ) WITHOUT ROWID
+        """)
+        db.execute("CREATE INDEX IF NOT EXISTS idx_files_path ON files(dir_id, basename_id)")
+        db.execute("""
+            CREATE VIEW IF NOT EXISTS filepaths AS
+            SELECT pi.package_name, d.path || s.segment AS filepath
+            FROM files f
+            JOIN package_ids pi ON pi.package_id = f.package_id
+            JOIN dirs d ON d.dir_id = f.dir_id
+            JOIN segments s ON s.segment_id = f.basename_id
+        """)
+
+    def _create_dunder_init_counts(self, db):
+        # How many packages own each `__init__.py`, kept up to date by triggers on
+        # filepaths so finding duplicates is a lookup in the partial index, not a scan
+        exists = db.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'dunder_init_counts'"
+        ).fetchone()
+        db.execute("""
+            CREATE TABLE IF NOT EXISTS dunder_init_counts (
+                filepath TEXT PRIMARY KEY,
+                owners INTEGER
+            )
+        """)
+        db.execute("CREATE INDEX IF NOT EXISTS idx_dunder_init_counts_dups ON dunder_init_counts(filepath) WHERE owners > 1")
+        recount = not exists
+        old_trigger = db.execute(
+            "SELECT sql FROM sqlite_master WHERE type = 'trigger' AND name = 'filepaths_count_dunder_inits'"
+        ).fetchone()
+        if old_trigger is not None and "LIKE" in old_trigger[0]:
+            # LIKE matched case-insensitively and `_` as any character, unlike
+            # the compact triggers and the pipeline, so the counts are redone
+            db.execute("DROP TRIGGER filepaths_count_dunder_inits")
+            db.execute("DROP TRIGGER IF EXISTS filepaths_uncount_dunder_inits")
+            db.execute("DELETE FROM dunder_init_counts")
+            recount = True
+        if self.compact:
+            # Same as below: a top-level __init__.py (dir "") doesn't count
+            db.execute("""
+                CREATE TRIGGER IF NOT EXISTS files_count_dunder_inits AFTER INSERT ON files
+                WHEN NEW.basename_id = (SELECT segment_id FROM segments WHERE segment = '__init__.py')
+                BEGIN
+                    INSERT INTO dunder_init_counts (filepath, owners)
+                    SELECT path || '__init__.py', 1 FROM dirs WHERE dir_id = NEW.dir_id AND path != ''
+                    ON CONFLICT (filepath) DO UPDATE SET owners = owners + 1;
+                END
+            """)
+            db.execute("""
+                CREATE TRIGGER IF NOT EXISTS files_uncount_dunder_inits AFTER DELETE ON files
+                WHEN OLD.basename_id = (SELECT segment_id FROM segments WHERE segment = '__init__.py')
+                BEGIN
+                    UPDATE dunder_init_counts SET owners = owners - 1
+                    WHERE filepath = (SELECT path || '__init__.py' FROM dirs WHERE dir_id = OLD.dir_id);
+                END
+            """)
+        else:
+            db.execute("""
+                CREATE TRIGGER IF NOT EXISTS filepaths_count_dunder_inits AFTER INSERT ON filepaths
+                WHEN substr(NEW.filepath, -12) = '/__init__.py'
+                BEGIN
+                    INSERT INTO dunder_init_counts (filepath, owners) VALUES (NEW.filepath, 1)
+                    ON CONFLICT (filepath) DO UPDATE SET owners = owners + 1;
+                END
+            """)
+            db.execute("""
+                CREATE TRIGGER IF NOT EXISTS filepaths_uncount_dunder_inits AFTER DELETE ON filepaths
+                WHEN substr(OLD.filepath, -12) = '/__init__.py'
+                BEGIN
+                    UPDATE dunder_init_counts SET owners = owners - 1 WHERE filepath = OLD.filepath;
+                END
+            """)
+        if recount:
+            # A DB from before the table (or the exact match) existed
+            db.execute("""
+                INSERT INTO dunder_init_counts (filepath, owners)
+                SELECT filepath, COUNT(*) FROM filepaths
+                WHERE substr(filepath, -12) = '/__init__.py'
+                GROUP BY filepath
+            """)
+
+    def _create_stage_progress(self, db):
+        # The journal of the later stages: a row per package with work to do
+        # in a stage (pending), being done (in_flight), done or failed. Each
+        # is written in the same transaction as the change that causes it,
+        # so it's right after any crash.
+        exists = db.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'stage_progress'"
+        ).fetchone()
+        db.execute("""
+            CREATE TABLE IF NOT EXISTS stage_progress (
+                stage TEXT,
+                package_name TEXT,
+                state TEXT,
+                updated_at REAL,
+                PRIMARY KEY (stage, package_name)
+            )
+        """)
+        # What's left of a stage is a lookup in here, however big the DB
+        db.execute("CREATE INDEX IF NOT EXISTS idx_stage_progress_open ON stage_progress(stage) WHERE state != 'done'")
+        if not exists:
+            # A DB from before the journal: the prefixes never computed and the
+            # duplicates never checked are what's left
+            db.execute("""
+                INSERT INTO stage_progress (stage, package_name, state, updated_at)
+                SELECT 'prefixes', p.package_name, 'pending', ?
+                FROM packages p
+                WHERE NOT EXISTS (SELECT 1 FROM package_prefixes pp WHERE pp.package_name = p.package_name)
+            """, (time.time(),))
+            db.execute(*self._unchecked_duplicates())
+
+    def _unchecked_duplicates(self):
+        """Return the statement marking the namespace stage pending for every
+        owner of a duplicate `__init__.py` it has no result for."""
+        return (f"""
+            INSERT OR REPLACE INTO stage_progress (stage, package_name, state, updated_at)
+            SELECT DISTINCT 'namespace', f.package_name, 'pending', ?
+            FROM dunder_init_counts c
+            {self._dunder_init_files("c.filepath")}
+            WHERE c.owners > 1 AND NOT EXISTS (
+                SELECT 1 FROM namespace_packages np
+                WHERE np.package_name = f.package_name AND np.filepath = c.filepath
+            )
+        """, (time.time(),))
+
+    def _progress(self, stage, package_names, state):
+        return ("""
+            INSERT OR REPLACE INTO stage_progress (stage, package_name, state, updated_at)
+            VALUES (?, ?, ?, ?)
+        """, [(stage, package_name, state, time.time()) for package_name in package_names])
+
+    def set_progress(self, stage, package_names, state):
+        self._write([self._progress(stage, package_names, state)])
+
+    def finish_stage(self, stage):
+        """Mark every pending or in-flight unit of stage done, once a run has
+        done all of it; failed ones stay failed."""
+        self._write([(
+            "UPDATE stage_progress SET state = 'done', updated_at = ? WHERE stage = ? AND state IN ('pending', 'in_flight')",
+            [(time.time(), stage)]
+        )])
+
+    def stage_finished(self, stage):
+        return not self._read(
+            "SELECT 1 FROM stage_progress WHERE stage = ? AND state != 'done' LIMIT 1", (stage,)
+        )
+
+    def get_open_units(self, stage):
+        """Return the packages with work left in stage: pending, failed, or
+        in flight when the last run stopped."""
+        query = "SELECT package_name FROM stage_progress WHERE stage = ? AND state != 'done'"
+        return [row[0] for row in self._read(query, (stage,))]
+
+    def _load_temp_set(self, db, table, values):
+        """Fill the temp table `table` with values, to join against instead of
+        binding one `?` per value."""
+        db.execute(f"CREATE TEMP TABLE IF NOT EXISTS {table} (value TEXT PRIMARY KEY)")
+        db.execute(f"DELETE FROM temp.{table}")
+        db.executemany(f"INSERT OR IGNORE INTO temp.{table} (value) VALUES (?)", ((value,) for value in values))
 
     def get_missing_packages(self, package_names):
-        with sqlite3.connect(self.db_path) as db:
-            placeholders = ','.join('?' for _ in package_names)
-            query = f"SELECT package_name FROM packages WHERE package_name IN ({placeholders})"
-            cursor = db.execute(query, package_names)
-            existing_packages = set(row[0] for row in cursor.fetchall())
+        with self._reader_lock:
+            db = self._reader_connection()
+            self._load_temp_set(db, "wanted_packages", package_names)
+            cursor = db.execute("""
+                SELECT p.package_name
+                FROM temp.wanted_packages w
+                CROSS JOIN packages p ON p.package_name = w.value
+            """)
+            existing_packages = set(row[0] for row in cursor)
         return [pkg for pkg in package_names if pkg not in existing_packages]
 
-    def insert_package(self, package_name, package_version, url, package_pos, filepaths):
-        filepaths = [
-            filepath for filepath in filepaths
-            if any(
-                filepath.endswith(suffix) for suffix in (
-                    ".py", ".so", ".dylib", ".pyd"
+    def get_package_states(self, package_names):
+        """Return {package: (url, sha256, etag, last_modified)} of the known package_names.
+
+        Either pair may be all None: a package without a suitable wheel has
+        validators but no wheel, and one from before the validators were
+        stored has no validators.
+        """
+        with self._reader_lock:
+            db = self._reader_connection()
+            self._load_temp_set(db, "known_packages", package_names)
+            cursor = db.execute("""
+                SELECT w.value, p.url, p.sha256, s.etag, s.last_modified
+                FROM temp.known_packages w
+                LEFT JOIN packages p ON p.package_name = w.value
+                LEFT JOIN simple_pages s ON s.package_name = w.value
+                WHERE p.package_name IS NOT NULL OR s.package_name IS NOT NULL
+            """)
+            return {row[0]: row[1:] for row in cursor}
+
+    def set_simple_page(self, package_name, etag, last_modified):
+        self._write([("""
+            INSERT OR REPLACE INTO simple_pages (package_name, etag, last_modified)
+            VALUES (?, ?, ?)
+        """, [(package_name, etag, last_modified)])])
+
+    def insert_package(self, package_name, package_version, url, package_pos, filepaths, upload_time=None, sha256=None):
+        """Store a package's wheel and files, replacing whatever was stored for it.
+
+        The namespace results, prefixes and stage_progress rows of a replaced
+        package are dropped with its old files, so the later stages redo just
+        this package.
+        """
+        filepaths = indexed_filepaths(filepaths)
+        now = time.time()
+        try:
+            self._write([
+                *self._delete_filepaths(package_name),
+                ("DELETE FROM namespace_packages WHERE package_name = ?", [(package_name,)]),
+                ("DELETE FROM package_prefixes WHERE package_name = ?", [(package_name,)]),
+                # Every stage spelled out, so it's a primary key lookup rather than a scan
+                ("DELETE FROM stage_progress WHERE stage IN ('namespace', 'prefixes') AND package_name = ?", [(package_name,)]),
+                ("""
+                    INSERT OR REPLACE INTO packages (package_name, package_version, package_pos, url, upload_time, sha256)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                """, [(package_name, package_version, package_pos, url, upload_time, sha256)]),
+                *self._insert_filepaths(package_name, filepaths),
+                self._progress("prefixes", [package_name], "pending"),
+                # Whichever of its `__init__.py`s are now duplicates, after the count triggers above
+                ("""
+                    INSERT OR REPLACE INTO stage_progress (stage, package_name, state, updated_at)
+                    SELECT 'namespace', ?, 'pending', ? FROM dunder_init_counts WHERE filepath = ? AND owners > 1
+                """, [(package_name, now, filepath) for filepath in filepaths if filepath.endswith("/__init__.py")]),
+            ])
+        except sqlite3.Error as e:
+            e.add_note(f"{package_name=}, {package_version=}, {url=}, {filepaths=}")
+            raise
+
+    def _delete_filepaths(self, package_name):
+        # Deleted row by row, so the count triggers see the old files go
+        if self.compact:
+            return [(
+                "DELETE FROM files WHERE package_id = (SELECT package_id FROM package_ids WHERE package_name = ?)",
+                [(package_name,)]
+            )]
+        return [("DELETE FROM filepaths WHERE package_name = ?", [(package_name,)])]
+
+    def _insert_filepaths(self, package_name, filepaths):
+        # Not OR REPLACE: replacing deletes first, which the count triggers wouldn't see
+        if not self.compact:
+            return [(
+                "INSERT OR IGNORE INTO filepaths (package_name, filepath) VALUES (?, ?)",
+                [(package_name, filepath) for filepath in filepaths]
+            )]
+        split = [_split_filepath(filepath) for filepath in filepaths]
+        return [
+            ("INSERT OR IGNORE INTO package_ids (package_name) VALUES (?)", [(package_name,)]),
+            ("INSERT OR IGNORE INTO dirs (path) VALUES (?)", [(path,) for path in {path for path, _ in split}]),
+            ("INSERT OR IGNORE INTO segments (segment) VALUES (?)", [(name,) for name in {name for _, name in split}]),
+            ("""
+                INSERT OR IGNORE INTO files (package_id, dir_id, basename_id) VALUES (
+                    (SELECT package_id FROM package_ids WHERE package_name = ?),
+                    (SELECT dir_id FROM dirs WHERE path = ?),
+                    (SELECT segment_id FROM segments WHERE segment = ?)
                 )
-            ) and ".data/" not in filepath
+            """, [(package_name, path, name) for path, name in split]),
         ]
-        with sqlite3.connect(self.db_path) as db:
-            try:
-                db.execute("""
-                    INSERT OR REPLACE INTO packages (package_name, package_version, package_pos, url)
-                    VALUES (?, ?, ?, ?)
-                """, (package_name, package_version, package_pos, url))
-                db.executemany(
-                    "INSERT OR REPLACE INTO filepaths (package_name, filepath) VALUES (?, ?)",
-                    [(package_name, filepath) for filepath in filepaths]
-                )
-            except sqlite3.Error as e:
-                e.add_note(f"{package_name=}, {package_version=}, {url=}, {filepaths=}")
-                raise
 
+    def record_failure(self, package_name, stage, error):
+        self._write([("""
+            INSERT INTO failed_packages (package_name, stage, error, attempts, failed_at)
+            VALUES (?, ?, ?, 1, ?)
+            ON CONFLICT (package_name, stage) DO UPDATE SET
+                error = excluded.error,
+                attempts = attempts + 1,
+                failed_at = excluded.failed_at
+        """, [(package_name, stage, error, time.time())])])
 
-    def get_duplicate_dunder_inits(self):
-        with sqlite3.connect(self.db_path) as db:
-            query = """
-                SELECT filepath
-                FROM filepaths
-                GROUP BY filepath
-                HAVING COUNT(filepath) > 1
-                AND filepath LIKE "%/__init__.py"
-            """
-            cursor = db.execute(query)
-            return [row[0] for row in cursor.fetchall()]
-
-    def get_missing_dup_filepaths_by_url(self, dup_filepaths):
-        with sqlite3.connect(self.db_path) as db:
-            placeholders = ','.join('?' for _ in dup_filepaths)
-            query = f"""
-                SELECT p.package_name, p.url, f.filepath
-                FROM filepaths f
-                JOIN packages p ON f.package_name = p.package_name
-                WHERE f.filepath IN ({placeholders})
-                AND f.filepath NOT IN (
-                    SELECT filepath FROM namespace_packages
-                )
-            """
-            result = defaultdict(list)
-            cursor = db.execute(query, dup_filepaths)
-            rows = cursor.fetchall()
-            for row in rows:
-                result[(row[0], row[1])].append(row[2])
-            return result
+    def clear_failure(self, package_name, stage):
+        self._write([(
+            "DELETE FROM failed_packages WHERE package_name = ? AND stage = ?",
+            [(package_name, stage)]
+        )])
+
+    def get_failed_packages(self, stage):
+        query = "SELECT package_name FROM failed_packages WHERE stage = ?"
+        return [row[0] for row in self._read(query, (stage,))]
+
+    def prune_namespace_packages(self):
+        """Drop the namespace results of files no longer owned by several
+        packages, and return the packages they belonged to."""
+        rows = self._read("""
+            SELECT np.package_name, np.filepath
+            FROM dunder_init_counts c
+            JOIN namespace_packages np ON np.filepath = c.filepath
+            WHERE c.owners <= 1
+        """)
+        packages = {row[0] for row in rows}
+        self._write([
+            ("DELETE FROM namespace_packages WHERE package_name = ? AND filepath = ?", rows),
+            self._progress("prefixes", packages, "pending"),
+        ])
+        return packages
+
+
+    def _dunder_init_files(self, filepath):
+        """Return a FROM clause joining the packages with a file at the
+        `__init__.py` path expression filepath, as f.package_name.
+
+        CROSS JOIN pins the join order: left to itself, the planner may scan
+        all of the filepaths instead of looking each path up.
+        """
+        if not self.compact:
+            return f"CROSS JOIN filepaths f ON f.filepath = {filepath}"
+        # The view can't use the indexes, so go through the dictionary tables by hand
+        return f"""
+            CROSS JOIN dirs d ON d.path = substr({filepath}, 1, length({filepath}) - length('__init__.py'))
+            CROSS JOIN files fi ON fi.dir_id = d.dir_id
+                AND fi.basename_id = (SELECT segment_id FROM segments WHERE segment = '__init__.py')
+            CROSS JOIN package_ids f ON f.package_id = fi.package_id
+        """
+
+    def get_dunder_init_owners(self):
+        """Return (filepath, package, url) for every `__init__.py` of every package."""
+        return self._read(f"""
+            SELECT c.filepath, f.package_name, p.url
+            FROM dunder_init_counts c
+            {self._dunder_init_files("c.filepath")}
+            JOIN packages p ON p.package_name = f.package_name
+            WHERE c.owners > 0
+        """)
+
+    def get_checked_namespace_pairs(self):
+        """Return the (package, filepath) pairs the namespace stage has results for."""
+        return set(self._read("SELECT package_name, filepath FROM namespace_packages"))
 
     def check_and_store_namespace_package(self, package_name, filepath, is_namespace):
-        with sqlite3.connect(self.db_path) as db:
-            db.execute("""
-                INSERT INTO namespace_packages (package_name, filepath, is_namespace)
+        self._write([
+            ("""
+                INSERT OR REPLACE INTO namespace_packages (package_name, filepath, is_namespace)
                 VALUES (?, ?, ?)
-            """, (package_name, filepath, is_namespace))
-
-    def iterate_filepaths(self, batch_size=1000):
-        with sqlite3.connect(self.db_path) as db:
-            query = """
-                SELECT
-                    package_name,
-                    GROUP_CONCAT(filepath, '|') AS filepaths
-                FROM (
-                    SELECT f.package_name, f.filepath
-                    FROM filepaths f
-                    LEFT JOIN namespace_packages np ON f.package_name = np.package_name AND f.filepath = np.filepath
-                    WHERE np.package_name IS NULL OR np.is_namespace = FALSE
-                )
-                GROUP BY package_name;
-            """
+            """, [(package_name, filepath, is_namespace)]),
+            # Its prefixes leave out its namespace `__init__.py`s
+            self._progress("prefixes", [package_name], "pending"),
+        ])
+
+    def _stream(self, query, batch_size, prepare=None):
+        """Yield the rows of query a batch (list) at a time."""
+        # The lock is only held per batch, so other readers can interleave
+        with self._reader_lock:
+            db = self._reader_connection()
+            if prepare is not None:
+                prepare(db)
             cursor = db.execute(query)
-            while True:
+        while True:
+            with self._reader_lock, metrics.timed("db_read_seconds"):
                 rows = cursor.fetchmany(batch_size)
-                if not rows:
-                    break
-                for row in rows:
-                    package_name, filepaths_str = row
-                    filepaths = filepaths_str.split('|')
-                    yield package_name, filepaths
+            if not rows:
+                break
+            yield rows
+
+    def iterate_filepaths(self, batch_size=10_000, packages=None):
+        """Yield (package, filepaths) minus the namespace `__init__.py`s,
+        for every package or just those in packages.
+
+        The rows are streamed in package order and grouped here, so at most
+        one package's filepaths are held at a time.
+        """
+        prepare = None
+        if packages is not None:
+            prepare = lambda db: self._load_temp_set(db, "prefix_packages", packages)
+        if self.compact:
+            yield from self._iterate_compact_filepaths(batch_size, packages is not None, prepare)
+            return
+        source = "filepaths f"
+        if packages is not None:
+            source = "temp.prefix_packages w CROSS JOIN filepaths f ON f.package_name = w.value"
+        batches = self._stream(f"""
+            SELECT f.package_name, f.filepath
+            FROM {source}
+            LEFT JOIN namespace_packages np ON f.package_name = np.package_name AND f.filepath = np.filepath
+            WHERE np.package_name IS NULL OR np.is_namespace = FALSE
+            ORDER BY f.package_name
+        """, batch_size, prepare)
+        for package_name, group in groupby(chain.from_iterable(batches), key=itemgetter(0)):
+            yield package_name, [filepath for _, filepath in group]
+
+    def _iterate_compact_filepaths(self, batch_size, filtered, prepare):
+        # Only ids come out of the scan, the paths are rebuilt from the
+        # dictionary tables (read once) as the rows go by
+        source = "files f"
+        if filtered:
+            source = """
+                temp.prefix_packages w
+                CROSS JOIN package_ids pi ON pi.package_name = w.value
+                CROSS JOIN files f ON f.package_id = pi.package_id
+            """
+        names = dict(self._read("SELECT package_id, package_name FROM package_ids"))
+        dirs = dict(self._read("SELECT dir_id, path FROM dirs"))
+        segments = dict(self._read("SELECT segment_id, segment FROM segments"))
+        namespaces = defaultdict(set)
+        for package_name, filepath in self._read("SELECT package_name, filepath FROM namespace_packages WHERE is_namespace"):
+            namespaces[package_name].add(filepath)
+
+        def package(package_id, filepaths):
+            package_name = names[package_id]
+            if package_name in namespaces:
+                filepaths = [filepath for filepath in filepaths if filepath not in namespaces[package_name]]
+            return package_name, filepaths
+
+        query = f"SELECT f.package_id, f.dir_id, f.basename_id FROM {source} ORDER BY f.package_id"
+        current, filepaths = None, []
+        for rows in self._stream(query, batch_size, prepare):
+            for package_id, dir_id, basename_id in rows:
+                if package_id != current:
+                    if filepaths:
+                        yield package(current, filepaths)
+                    current, filepaths = package_id, []
+                filepaths.append(dirs[dir_id] + segments[basename_id])
+        if filepaths:
+            yield package(current, filepaths)
+
+    def iterate_ranked_prefixes(self, batch_size=10_000):
+        """Yield (prefix, package, package_pos) for every prefix, by package_pos."""
+        return chain.from_iterable(self._stream("""
+            SELECT pp.prefix, pp.package_name, p.package_pos
+            FROM package_prefixes pp
+            JOIN packages p ON p.package_name = pp.package_name
+            ORDER BY p.package_pos, pp.prefix
+        """, batch_size))
+
+    def get_namespace_filepaths(self):
+        """Return the `__init__.py`s declaring a namespace in any package."""
+        return {filepath for filepath, in self._read("SELECT DISTINCT filepath FROM namespace_packages WHERE is_namespace")}
 
     def insert_package_prefixes(self, package_name, prefixes):
-        with sqlite3.connect(self.db_path) as db:
-            try:
-                db.executemany("""
+        try:
+            self._write([
+                # Replaces the package's prefixes, including ones it no longer has
+                ("DELETE FROM package_prefixes WHERE package_name = ?", [(package_name,)]),
+                ("""
                     INSERT OR REPLACE INTO package_prefixes (package_name, prefix)
                     VALUES (?, ?)
-                """, [(package_name, prefix) for prefix in prefixes])
-            except sqlite3.Error as e:
-                e.add_note(f"{package_name=}, {prefixes=}")
-                raise
+                """, [(package_name, prefix) for prefix in prefixes]),
+                self._progress("prefixes", [package_name], "done"),
+            ])
+        except sqlite3.Error as e:
+            e.add_note(f"{package_name=}, {prefixes=}")
+            raise
+
+    def merge_shard(self, shard_path):
+        """Copy in the crawl of the DB at shard_path (same filepaths layout),
+        replacing whatever this DB has for the packages it has.
+
+        All in SQLite, a table at a time (INSERT ... SELECT through an
+        ATTACH), so nothing is held in memory. Namespace results come along,
+        they only depend on the package's own files; prefixes don't, they
+        depend on every shard and are recomputed after the merge.
+        """
+        db = _connect(self.db_path, isolation_level=None)
+        try:
+            db.execute("ATTACH DATABASE ? AS shard", (shard_path,))
+            layout = db.execute("SELECT type FROM shard.sqlite_master WHERE name = 'filepaths'").fetchone()
+            if layout is None or (layout[0] == "view") != self.compact:
+                raise ValueError(f"{shard_path} doesn't have the filepaths layout of {self.db_path}")
+            shard_packages = "SELECT package_name FROM shard.packages"
+            db.execute("BEGIN")
+            # Row by row, so the count triggers see the old files go
+            if self.compact:
+                db.execute(f"""
+                    DELETE FROM files WHERE package_id IN (
+                        SELECT package_id FROM package_ids WHERE package_name IN ({shard_packages})
+                    )
+                """)
+            else:
+                db.execute(f"DELETE FROM filepaths WHERE package_name IN ({shard_packages})")
+            db.execute(f"DELETE FROM namespace_packages WHERE package_name IN ({shard_packages})")
+            db.execute(f"DELETE FROM package_prefixes WHERE package_name IN ({shard_packages})")
+            db.execute(f"DELETE FROM failed_packages WHERE package_name IN ({shard_packages})")
+            db.execute(f"DELETE FROM stage_progress WHERE package_name IN ({shard_packages})")
+            db.execute("""
+                INSERT OR REPLACE INTO packages (package_name, package_version, package_pos, url, upload_time, sha256)
+                SELECT package_name, package_version, package_pos, url, upload_time, sha256 FROM shard.packages
+            """)
+            if self.compact:
+                # New ids in the shard's id order, so merging the same shards in the same order gives the same DB
+                db.execute("INSERT OR IGNORE INTO package_ids (package_name) SELECT package_name FROM shard.package_ids ORDER BY package_id")
+                db.execute("INSERT OR IGNORE INTO dirs (path) SELECT path FROM shard.dirs ORDER BY dir_id")
+                db.execute("INSERT OR IGNORE INTO segments (segment) SELECT segment FROM shard.segments ORDER BY segment_id")
+                db.execute("""
+                    INSERT OR IGNORE INTO files (package_id, dir_id, basename_id)
+                    SELECT pi.package_id, d.dir_id, s.segment_id
+                    FROM shard.files f
+                    JOIN shard.package_ids spi ON spi.package_id = f.package_id
+                    JOIN package_ids pi ON pi.package_name = spi.package_name
+                    JOIN shard.dirs sd ON sd.dir_id = f.dir_id
+                    JOIN dirs d ON d.path = sd.path
+                    JOIN shard.segments ss ON ss.segment_id = f.basename_id
+                    JOIN segments s ON s.segment = ss.segment
+                """)
+            else:
+                db.execute("""
+                    INSERT OR IGNORE INTO filepaths (package_name, filepath)
+                    SELECT package_name, filepath FROM shard.filepaths
+                """)
+            db.execute("""
+                INSERT OR REPLACE INTO namespace_packages (package_name, filepath, is_namespace)
+                SELECT package_name, filepath, is_namespace FROM shard.namespace_packages
+            """)
+            db.execute("""
+                INSERT OR REPLACE INTO simple_pages (package_name, etag, last_modified)
+                SELECT package_name, etag, last_modified FROM shard.simple_pages
+            """)
+            db.execute("""
+                INSERT OR REPLACE INTO failed_packages (package_name, stage, error, attempts, failed_at)
+                SELECT package_name, stage, error, attempts, failed_at FROM shard.failed_packages
+            """)
+            # Copied as is, then the prefixes of everything merged are redone, and the
+            # namespace stage picks up the duplicates the shards couldn't see
+            db.execute("""
+                INSERT OR REPLACE INTO stage_progress (stage, package_name, state, updated_at)
+                SELECT stage, package_name, state, updated_at FROM shard.stage_progress
+            """)
+            db.execute("""
+                INSERT OR REPLACE INTO stage_progress (stage, package_name, state, updated_at)
+                SELECT 'prefixes', package_name, 'pending', ? FROM shard.packages
+            """, (time.time(),))
+            db.execute(*self._unchecked_duplicates())
+            merged = db.execute("SELECT COUNT(*) FROM shard.packages").fetchone()[0]
+            db.execute("COMMIT")
+        except BaseException:
+            if db.in_transaction:
+                db.execute("ROLLBACK")
+            raise
+        finally:
+            db.close()
+        return merged
+
+    def close(self):
+        """Close the reader, and leave a DB written to in rollback journal
+        mode: a WAL file can't be opened read-only from a read-only
+        directory, which is where a published DB may well end up."""
+        with self._reader_lock:
+            if self._reader is not None:
+                self._reader.close()
+                self._reader = None
+        if self.read_only or not os.path.exists(self.db_path):
+            return
+        db = _connect(self.db_path)
+        try:
+            db.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchall()
+            db.execute("PRAGMA journal_mode=DELETE")
+        except sqlite3.OperationalError as e:
+            # Only possible with no other connection open, the next close will do
+            print(f"{self.db_path} left in WAL mode: {e}")
+        finally:
+            db.close()
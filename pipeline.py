@@ -0,0 +1,196 @@
+import asyncio
+from collections import Counter, defaultdict
+
+import metrics
+from package_database import indexed_filepaths
+
+# Only these count as duplicates, like the dunder_init_counts triggers (substr(filepath, -12) = '/__init__.py')
+DUNDER_INIT = "/__init__.py"
+
+
+class DunderInitIndex:
+    """Which packages own each `__init__.py`, kept in memory as packages come in."""
+
+    def __init__(self):
+        # filepath -> {package: url}
+        self.owners = defaultdict(dict)
+        self._by_package = defaultdict(list)
+
+    def seed(self, rows):
+        """Load the (filepath, package, url) rows of what's already in the DB."""
+        for filepath, package, url in rows:
+            self.owners[filepath][package] = url
+            self._by_package[package].append(filepath)
+
+    def paths_of(self, package):
+        return self._by_package.get(package, [])
+
+    def add(self, package, url, filepaths):
+        """Replace the `__init__.py`s package owns with those in filepaths, and
+        return the ones now owned by more than one package."""
+        self.remove(package)
+        duplicates = []
+        for filepath in filepaths:
+            if filepath.endswith(DUNDER_INIT):
+                owners = self.owners[filepath]
+                owners[package] = url
+                self._by_package[package].append(filepath)
+                if len(owners) > 1:
+                    duplicates.append(filepath)
+        return duplicates
+
+    def remove(self, package):
+        for filepath in self._by_package.pop(package, ()):
+            owners = self.owners[filepath]
+            owners.pop(package, None)
+            if not owners:
+                del self.owners[filepath]
+
+
+class Pipeline:
+    """Namespace checks and prefixes, run while the crawl is still going.
+
+    Every crawled package is added to a DunderInitIndex; as soon as an
+    `__init__.py` has a second owner, a check is queued for every owner
+    not checked yet (a later owner only queues itself). Checks are queued
+    per package, so the paths piling up while it waits are checked with
+    one archive open. Once a crawled package has no check left, its
+    prefixes are computed from the filepaths it was added with.
+
+    A package whose prefixes can't be computed like that (it was already
+    in the DB, or was done before one of its paths became a duplicate)
+    is left pending in the DB's stage_progress journal by its namespace
+    results, for the prefix stage to redo once finish()ed. The checks are
+    journaled too: pending once queued, then in_flight, done or failed.
+    """
+
+    def __init__(self, db, scraper, cpu, on_error, on_success):
+        self.db = db
+        self.scraper = scraper
+        self.cpu = cpu
+        self.on_error = on_error
+        self.on_success = on_success
+        self.index = DunderInitIndex()
+        # (package, filepath) pairs with a namespace result, or one on the way
+        self._checked = set()
+        self._queue = asyncio.Queue()
+        # (package, url) -> filepaths waiting for a check
+        self._pending = {}
+        # package -> how many of its filepaths are waiting or being checked
+        self._waiting = Counter()
+        self._namespaces = defaultdict(set)
+        # Crawled package -> its filepaths, until its prefixes are computed
+        self._files = {}
+        self._prefix_tasks = set()
+        # package -> bumped whenever its files or checks change, so a prefix
+        # computation that started before is dropped instead of stored
+        self._generation = Counter()
+        self._workers = []
+
+    def seed(self):
+        """Load what the DB already has, and queue the checks it's missing."""
+        self.index.seed(self.db.get_dunder_init_owners())
+        self._checked = self.db.get_checked_namespace_pairs()
+        for filepath, owners in self.index.owners.items():
+            if len(owners) > 1:
+                self._check(filepath)
+
+    def start(self, workers):
+        self._workers = [asyncio.ensure_future(self._worker()) for _ in range(workers)]
+
+    async def finish(self):
+        """Wait for every queued check and prefix computation."""
+        await self._queue.join()
+        for _ in self._workers:
+            self._queue.put_nowait(None)
+        await asyncio.gather(*self._workers)
+        while self._prefix_tasks:
+            await asyncio.gather(*self._prefix_tasks)
+
+    def add_package(self, package, url, filepaths):
+        """Take in a package just stored by insert_package (which dropped its
+        old namespace results)."""
+        for filepath in self.index.paths_of(package):
+            self._checked.discard((package, filepath))
+        self._namespaces.pop(package, None)
+        self._generation[package] += 1
+        self._files[package] = indexed_filepaths(filepaths)
+        for filepath in self.index.add(package, url, filepaths):
+            self._check(filepath)
+        self._settle(package)
+
+    def _check(self, filepath):
+        queued = []
+        for package, url in self.index.owners[filepath].items():
+            if (package, filepath) in self._checked:
+                continue
+            self._checked.add((package, filepath))
+            key = (package, url)
+            if key not in self._pending:
+                self._pending[key] = set()
+                self._queue.put_nowait(key)
+            self._pending[key].add(filepath)
+            self._waiting[package] += 1
+            self._generation[package] += 1
+            queued.append(package)
+        if queued:
+            self.db.set_progress("namespace", queued, "pending")
+        metrics.gauge("namespace_queue_depth", self._queue.qsize())
+
+    async def _worker(self):
+        while True:
+            key = await self._queue.get()
+            try:
+                if key is None:
+                    return
+                package, url = key
+                filepaths = sorted(self._pending.pop(key))
+                self.db.set_progress("namespace", [package], "in_flight")
+                try:
+                    await self._check_namespaces(package, url, filepaths)
+                except Exception as e:
+                    self.db.set_progress("namespace", [package], "failed")
+                    self.on_error(package, e)
+                else:
+                    self.db.set_progress("namespace", [package], "done")
+                    self.on_success(package)
+                self._waiting[package] -= len(filepaths)
+                self._settle(package)
+            finally:
+                self._queue.task_done()
+
+    def _owns(self, package, url, filepath):
+        return self.index.owners.get(filepath, {}).get(package) == url
+
+    async def _check_namespaces(self, package, url, filepaths):
+        # A package re-crawled since the check was queued drops what it no longer owns
+        filepaths = [filepath for filepath in filepaths if self._owns(package, url, filepath)]
+        if not filepaths:
+            return
+        metrics.count("namespace_checks_total")
+        metrics.count("namespace_check_filepaths_total", len(filepaths))
+        namespaces = set(await self.scraper.is_explicit_namespace_package(url, filepaths))
+        for filepath in filepaths:
+            if self._owns(package, url, filepath):
+                self.db.check_and_store_namespace_package(package, filepath, filepath in namespaces)
+        self._namespaces[package] |= namespaces
+
+    def _settle(self, package):
+        if self._waiting[package] or package not in self._files:
+            return
+        self._waiting.pop(package, None)
+        filepaths = self._files.pop(package)
+        namespaces = self._namespaces.pop(package, set())
+        task = asyncio.ensure_future(self._store_prefixes(package, self._generation[package], [
+            filepath for filepath in filepaths if filepath not in namespaces
+        ]))
+        self._prefix_tasks.add(task)
+        task.add_done_callback(self._prefix_tasks.discard)
+        metrics.gauge("prefix_tasks", len(self._prefix_tasks))
+
+    async def _store_prefixes(self, package, generation, filepaths):
+        prefixes = await self.cpu.prefixes(filepaths)
+        # A check queued meanwhile leaves the package pending in the journal
+        # (by its result), for the prefix stage to redo with it
+        if self._generation[package] == generation:
+            self.db.insert_package_prefixes(package, prefixes)
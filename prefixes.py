@@ -0,0 +1,82 @@
+# Top-level directories that aren't importable code, wherever a package puts them
+EXCLUDED_TOP_LEVEL = frozenset((
+    "test", "tests", "doc", "docs", "example", "examples", "benchmark", "benchmarks",
+    "script", "scripts", "bin", "samples",
+))
+
+# Key marking a node of the trie as a module (segments are always strings)
+_MODULE = None
+
+
+def _module_parts(filepath):
+    """Return the path segments of the module filepath defines.
+
+    Same as `path.parent if path.stem == "__init__" else path.with_suffix("")`
+    on a PurePosixPath, without allocating one. The first segment is the
+    anchor: "" for a relative path, "/" (or "//") for an absolute one.
+    """
+    anchor = ""
+    if filepath.startswith("/"):
+        anchor = "//" if filepath.startswith("//") and not filepath.startswith("///") else "/"
+    parts = [part for part in filepath.split("/") if part and part != "."]
+    if not parts:
+        return None
+    name = parts[-1]
+    i = name.rfind(".")
+    stem = name[:i] if 0 < i < len(name) - 1 else name
+    if stem == "__init__":
+        parts.pop()
+    else:
+        parts[-1] = stem
+    parts.insert(0, anchor)
+    return parts
+
+
+def _sort_key(parts):
+    # pathlib orders paths by their parts, where a relative path has no anchor part
+    return parts[1:] if parts[0] == "" else parts
+
+
+def _path(parts):
+    anchor, *rest = parts
+    if anchor == "":
+        return "/".join(rest) or "."
+    return anchor + "/".join(rest)
+
+
+def package_prefixes(filepaths, excluded=EXCLUDED_TOP_LEVEL):
+    """Return the minimal set of module prefixes covering a package's files.
+
+    Every file is inserted into a trie of path segments (an `__init__`
+    marks its directory, anything else its suffix-less path), skipping the
+    branches whose raw top-level directory is excluded. The prefixes are
+    the module nodes with no module above them, in pathlib's sort order,
+    which is what the former pathlib implementation returned.
+    """
+    root = {}
+    for filepath in filepaths:
+        head, sep, _ = filepath.partition("/")
+        if sep and head in excluded:
+            continue
+        parts = _module_parts(filepath)
+        if parts is None:
+            continue
+        node = root
+        for part in parts:
+            if _MODULE in node:
+                # Already covered by a shorter prefix
+                break
+            node = node.setdefault(part, {})
+        else:
+            node.clear()
+            node[_MODULE] = True
+
+    result = []
+    stack = [(node, (anchor,)) for anchor, node in root.items()]
+    while stack:
+        node, parts = stack.pop()
+        if _MODULE in node:
+            result.append(parts)
+        else:
+            stack.extend((child, parts + (part,)) for part, child in node.items())
+    return [_path(parts) for parts in sorted(result, key=_sort_key)]
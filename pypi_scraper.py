@@ -1,118 +1,340 @@
+import asyncio
+from collections import Counter
 from functools import lru_cache
+import math
 import os
-import tarfile
+from typing import NamedTuple, Optional
+from urllib.parse import unquote, urljoin
 import httpx
 from bs4 import BeautifulSoup
-import zipfile
+from packaging.utils import InvalidWheelFilename, parse_wheel_filename
+from packaging.version import InvalidVersion
 import re
-import io
 
-from lazy_zip import LazyZipOverHTTP
+from http_scheduler import AdaptiveTransport
+import metrics
+from lazy_zip import AsyncLazyZipOverHTTP, LazyZipOverHTTP
+from namespaces import find_explicit_namespaces
+from range_cache import cache_key
+from tar_stream import TarGzScanner
 
-WS = "\\s*"
-EXPLICIT_NS_PKG = re.compile(
-    "|".join(
-        [
-            f"(^.+extend_path\\(__path__,{WS}__name__\\))",
-            f"(^.+declare_namespace\\(__name__\\))",
-        ]
-    ),
-    flags=re.MULTILINE
-)
+# PEP 691 JSON, with the HTML page only for an index that can't do JSON
+SIMPLE_ACCEPT = "application/vnd.pypi.simple.v1+json, text/html;q=0.01"
+SIMPLE_JSON = "application/vnd.pypi.simple.v1+json"
+# The simple index crawled, and where the wheels missing from it are released
+PYPI_SIMPLE_URL = "https://pypi.org/simple/"
+GH_RELEASES_URL = "https://api.github.com/repos/thejcannon/keeping-it-wheel/releases?per_page=100&page={page}"
+
+def _gh_headers():
+    return {"Authorization": f"Token {os.getenv('GH_TOKEN', '')}"}
+
+def _add_gh_releases(result, response):
+    response.raise_for_status()
+    for release in response.json():
+        name = release["tag_name"].rsplit("-", 1)[0]
+        if release["assets"]:
+            result[name] = release["assets"][0]["browser_download_url"]
+    # A listing that fits on one page has no Link header at all
+    return "next" in response.headers.get("Link", "")
 
 @lru_cache(maxsize=1)
-def _get_gh_release_map():
+def _get_gh_release_map(releases_url=GH_RELEASES_URL):
     result = {}
     client = httpx.Client()
-    url = "https://api.github.com/repos/thejcannon/keeping-it-wheel/releases?per_page=100&page={page}"
     page = 1
-    while True:
-        response = client.get(url.format(page=page), headers={"Authorization": f"Token {os.getenv('GH_TOKEN', '')}"})
-        response.raise_for_status()
-        releases = response.json()
-        for release in releases:
-            name = release["tag_name"].rsplit("-", 1)[0]
-            if release["assets"]:
-                result[name] = release["assets"][0]["browser_download_url"]
-        if "next" in response.headers.get('Link'):
-            page +=1
-        else:
-            return result
+    while _add_gh_releases(result, client.get(releases_url.format(page=page), headers=_gh_headers())):
+        page += 1
+    return result
+
+async def _aget_gh_release_map(client, releases_url=GH_RELEASES_URL):
+    result = {}
+    page = 1
+    while _add_gh_releases(result, await client.get(releases_url.format(page=page), headers=_gh_headers())):
+        page += 1
+    return result
+
+def make_transport(max_connections=200):
+    """A pooled HTTP/2 transport, limiting and retrying requests per host."""
+    return AdaptiveTransport(httpx.AsyncHTTPTransport(
+        http2=True,
+        limits=httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_connections,
+            keepalive_expiry=60.0,
+        ),
+    ))
+
+def make_async_client(max_connections=200, transport=None):
+    """The one pooled HTTP/2 client shared by every stage of an async crawl."""
+    return httpx.AsyncClient(
+        transport=transport or make_transport(max_connections),
+        follow_redirects=True,
+        timeout=httpx.Timeout(30.0, connect=10.0),
+    )
+
+class WheelFile(NamedTuple):
+    """A wheel listed on a simple index page."""
+
+    filename: str
+    # With the #sha256= fragment when the index has it, it's what the range cache keys on
+    url: str
+    # PEP 700, None from an HTML page
+    size: Optional[int]
+    yanked: bool
+
+def _wheel_files_from_json(data, page_url):
+    files = []
+    for file in data["files"]:
+        if not file["filename"].endswith(".whl"):
+            continue
+        url = urljoin(page_url, file["url"])
+        if sha256 := file.get("hashes", {}).get("sha256"):
+            url = f"{url.split('#')[0]}#sha256={sha256}"
+        files.append(WheelFile(file["filename"], url, file.get("size"), bool(file.get("yanked"))))
+    return files
+
+def _wheel_files_from_html(text, page_url):
+    files = []
+    for link in BeautifulSoup(text, "html.parser").find_all("a", href=True):
+        url = urljoin(page_url, link["href"])
+        path = url.split("#")[0]
+        if path.endswith(".whl"):
+            files.append(WheelFile(unquote(path.rsplit("/", 1)[-1]), url, None, link.has_attr("data-yanked")))
+    return files
+
+def _wheel_files(response):
+    """Return the wheels of a simple page, whichever format the index answered in."""
+    if response.headers.get("Content-Type", "").startswith(SIMPLE_JSON):
+        return _wheel_files_from_json(response.json(), str(response.url))
+    return _wheel_files_from_html(response.text, str(response.url))
+
+def _pick_wheel(files):
+    """Return the wheel of the latest version that's cheapest to list, None if there's none.
+
+    Yanked files and pre-releases only count when there's nothing else.
+    Out of the latest version's wheels a pure-python one wins, then the
+    smallest (by PEP 700 size), then the last listed. When no filename
+    parses (legacy or non-normalized names), it's the last one listed.
+    """
+    candidates = []
+    for i, file in enumerate(files):
+        try:
+            _, version, _, tags = parse_wheel_filename(file.filename)
+        except (InvalidWheelFilename, InvalidVersion):
+            continue
+        pure = all(tag.abi == "none" and tag.platform == "any" for tag in tags)
+        candidates.append((file, version, pure, i))
+    if not candidates:
+        return ([file for file in files if not file.yanked] or files or [None])[-1]
+    candidates = [c for c in candidates if not c[0].yanked] or candidates
+    candidates = [c for c in candidates if not c[1].is_prerelease] or candidates
+    latest = max(version for _, version, _, _ in candidates)
+    file, *_ = min(
+        (c for c in candidates if c[1] == latest),
+        key=lambda c: (not c[2], math.inf if c[0].size is None else c[0].size, -c[3]),
+    )
+    return file
+
+def _wheel_info(wheel_url):
+    wheel_url, sha256 = cache_key(wheel_url)
+    wheel_name = wheel_url.split("/")[-1]
+    package_name, package_version, *rest = wheel_name.split("-")
+    return {
+        "package_name": PyPIScraper.normalize(package_name),
+        "package_version": package_version,
+        "url": wheel_url,
+        "sha256": sha256 and sha256.removeprefix("sha256="),
+    }
+
+def _sdist_members(scanner, found):
+    if scanner.missing:
+        raise KeyError(f"filenames {sorted(scanner.missing)!r} not found")
+    return found
 
 class PyPIScraper:
-    def __init__(self):
-        self.client = httpx.Client()
+    def __init__(self, cache=None, index_url=PYPI_SIMPLE_URL, gh_releases_url=GH_RELEASES_URL):
+        self.client = httpx.Client(follow_redirects=True)
+        self.cache = cache
+        self.index_url = index_url
+        self.gh_releases_url = gh_releases_url
+        # How many wheels took how many HTTP requests to list
+        self.requests_per_wheel = Counter()
 
     @staticmethod
     def normalize(name):
         return re.sub(r"[-_.]+", "-", name).lower()
 
-    def get_wheel_urls(self, package_name):
+    @metrics.timed_calls("scraper_seconds", op="simple_page")
+    def get_wheel_files(self, package_name):
         normalized_name = self.normalize(package_name)
-        response = self.client.get(f"https://pypi.org/simple/{normalized_name}/")
+        response = self.client.get(f"{self.index_url}{normalized_name}/", headers={"Accept": SIMPLE_ACCEPT})
         response.raise_for_status()
-        soup = BeautifulSoup(response.text, "html.parser")
-        hrefs = [
-            link.get("href").rsplit("#", 1)[0]
-            for link in soup.find_all("a", href=True)
-        ]
-        return [
-            link for link in hrefs if link.endswith(".whl")
-        ]
+        return _wheel_files(response)
 
+    def get_wheel_urls(self, package_name):
+        return [file.url for file in self.get_wheel_files(package_name)]
 
+    @metrics.timed_calls("scraper_seconds", op="scrape_wheel")
     def scrape_wheel(self, wheel_url):
-        wheel_name = wheel_url.split("/")[-1].split("#")[0]
-        package_name, package_version, *rest = wheel_name.split("-")
-        wheel_info = {
-            "package_name": self.normalize(package_name),
-            "package_version": package_version,
-            "url": wheel_url
-        }
-        with LazyZipOverHTTP(wheel_url) as zf:
-            with zipfile.ZipFile(zf, allowZip64=True) as zip_file:
-                filepaths = zip_file.namelist()
+        wheel_info = _wheel_info(wheel_url)
+        with LazyZipOverHTTP(wheel_url, session=self.client, cache=self.cache) as zf:
+            filepaths = zf.namelist()
+            self.requests_per_wheel[zf.request_count] += 1
+            wheel_info["upload_time"] = zf.last_modified
 
         return wheel_info, filepaths
 
     def scrape_package(self, package_name):
-        wheel_urls = self.get_wheel_urls(package_name)
-        if not wheel_urls:
-            release_map = _get_gh_release_map()
-            if url := release_map.get(package_name):
-                wheel_urls = [url]
-            else:
+        wheel = _pick_wheel(self.get_wheel_files(package_name))
+        if wheel is not None:
+            wheel_url = wheel.url
+        else:
+            release_map = _get_gh_release_map(self.gh_releases_url)
+            if not (wheel_url := release_map.get(package_name)):
                 return None
 
-        return self.scrape_wheel(wheel_urls[-1])
+        return self.scrape_wheel(wheel_url)
 
+    @metrics.timed_calls("scraper_seconds", op="namespace_check")
     def is_explicit_namespace_package(self, url, filepaths):
-        result = []
-
-        def handle_file(filepath, content):
-            content = content.replace("\r", "")
-            if re.search(EXPLICIT_NS_PKG, content):
-                result.append(filepath)
-
         if url.endswith(".tar.gz"):
-            response = self.client.get(url)
-            response.raise_for_status()
-            content = response.content
-
-            with tarfile.open(fileobj=io.BytesIO(content), mode="r:gz") as tar:
-                for filepath in filepaths:
-                    handle_file(
-                        filepath,
-                        tar.extractfile(filepath).read().decode("utf-8")
-                    )
+            # Stream it, and hang up as soon as every file has gone by
+            scanner, found = TarGzScanner(filepaths), []
+            with self.client.stream("GET", url, headers={"Accept-Encoding": "identity"}) as response:
+                response.raise_for_status()
+                for chunk in response.iter_bytes():
+                    found.extend(scanner.feed(chunk))
+                    if scanner.done:
+                        break
+            members = _sdist_members(scanner, found)
         else:
-            with LazyZipOverHTTP(url) as zf:
-                with zipfile.ZipFile(zf) as zip_file:
-                    for filepath in filepaths:
-                        with zip_file.open(filepath) as file:
-                            handle_file(filepath, file.read().decode("utf-8"))
+            with LazyZipOverHTTP(url, session=self.client, cache=self.cache) as zf:
+                contents = zf.read_members(filepaths)
+            members = [(filepath, contents[filepath]) for filepath in filepaths]
 
-        return result
+        return find_explicit_namespaces(members)
 
     def close(self):
         self.client.close()
+
+class AsyncPyPIScraper:
+    """asyncio version of PyPIScraper, running on one pooled AsyncClient.
+
+    Given a cpu_pool.CpuPool, central directory parsing and the namespace
+    regex scan are handed to it instead of running on the event loop.
+    """
+
+    normalize = staticmethod(PyPIScraper.normalize)
+
+    def __init__(self, client=None, max_connections=200, cache=None, cpu=None,
+                 index_url=PYPI_SIMPLE_URL, gh_releases_url=GH_RELEASES_URL):
+        self._owns_client = client is None
+        # The AdaptiveTransport of a client made here, for its per-host report
+        self.scheduler = None
+        if client is None:
+            self.scheduler = make_transport(max_connections)
+            client = make_async_client(transport=self.scheduler)
+        self.client = client
+        self.cache = cache
+        self.cpu = cpu
+        self.index_url = index_url
+        self.gh_releases_url = gh_releases_url
+        self.requests_per_wheel = Counter()
+        self._gh_release_map = None
+
+    async def get_wheel_urls(self, package_name):
+        wheel_files, _, _ = await self.get_simple_page(package_name)
+        return [file.url for file in wheel_files]
+
+    @metrics.timed_calls("scraper_seconds", op="simple_page")
+    async def get_simple_page(self, package_name, etag=None, last_modified=None):
+        """Return the WheelFiles, ETag and Last-Modified of a package's simple page.
+
+        Given the validators of an earlier fetch, the request is conditional
+        and the wheel files are None if the page hasn't changed since.
+        """
+        normalized_name = self.normalize(package_name)
+        headers = {"Accept": SIMPLE_ACCEPT}
+        if etag:
+            headers["If-None-Match"] = etag
+        if last_modified:
+            headers["If-Modified-Since"] = last_modified
+        response = await self.client.get(f"{self.index_url}{normalized_name}/", headers=headers)
+        if response.status_code == 304:
+            return None, etag, last_modified
+        response.raise_for_status()
+        return (
+            _wheel_files(response),
+            response.headers.get("ETag"),
+            response.headers.get("Last-Modified"),
+        )
+
+    @metrics.timed_calls("scraper_seconds", op="scrape_wheel")
+    async def scrape_wheel(self, wheel_url):
+        wheel_info = _wheel_info(wheel_url)
+        async with AsyncLazyZipOverHTTP(wheel_url, self.client, cache=self.cache) as zf:
+            central_directory = zf.central_directory() if self.cpu is not None else None
+            if central_directory is None:
+                filepaths = zf.namelist()
+            self.requests_per_wheel[zf.request_count] += 1
+            wheel_info["upload_time"] = zf.last_modified
+        if central_directory is not None:
+            filepaths = await self.cpu.central_directory_names(*central_directory)
+
+        return wheel_info, filepaths
+
+    async def get_gh_release_map(self):
+        # Shared by every task, so the first caller's fetch is awaited by the rest
+        # (shielded, a cancelled caller doesn't cancel it for the others)
+        future = self._gh_release_map
+        if future is None:
+            future = self._gh_release_map = asyncio.ensure_future(
+                _aget_gh_release_map(self.client, self.gh_releases_url)
+            )
+        try:
+            return await asyncio.shield(future)
+        except BaseException:
+            # A failed fetch isn't kept, the next caller tries again
+            if future.done() and self._gh_release_map is future:
+                self._gh_release_map = None
+            raise
+
+    async def pick_wheel_url(self, package_name, wheel_files):
+        """Return the URL of the wheel to scrape, None if there's none."""
+        wheel = _pick_wheel(wheel_files)
+        if wheel is not None:
+            return wheel.url
+        release_map = await self.get_gh_release_map()
+        return release_map.get(package_name)
+
+    async def scrape_package(self, package_name):
+        wheel_files, _, _ = await self.get_simple_page(package_name)
+        wheel_url = await self.pick_wheel_url(package_name, wheel_files)
+        if wheel_url is None:
+            return None
+
+        return await self.scrape_wheel(wheel_url)
+
+    @metrics.timed_calls("scraper_seconds", op="namespace_check")
+    async def is_explicit_namespace_package(self, url, filepaths):
+        if url.endswith(".tar.gz"):
+            scanner, found = TarGzScanner(filepaths), []
+            async with self.client.stream("GET", url, headers={"Accept-Encoding": "identity"}) as response:
+                response.raise_for_status()
+                async for chunk in response.aiter_bytes():
+                    found.extend(scanner.feed(chunk))
+                    if scanner.done:
+                        break
+            members = _sdist_members(scanner, found)
+        else:
+            async with AsyncLazyZipOverHTTP(url, self.client, cache=self.cache) as zf:
+                contents = await zf.read_members(filepaths)
+            members = [(filepath, contents[filepath]) for filepath in filepaths]
+
+        if self.cpu is None:
+            return find_explicit_namespaces(members)
+        return await self.cpu.find_explicit_namespaces(members)
+
+    async def aclose(self):
+        if self._owns_client:
+            await self.client.aclose()
@@ -0,0 +1,166 @@
+import sqlite3
+import threading
+import time
+
+def cache_key(url):
+    """Split a wheel URL into (url without fragment, sha256 key or None)."""
+    url, _, fragment = url.partition("#")
+    if fragment.startswith("sha256="):
+        return url, fragment
+    return url, None
+
+class RangeCache:
+    """Persistent cache of byte ranges fetched from wheel URLs.
+
+    Ranges are stored by content (the `#sha256=` fragment PyPI puts on every
+    file URL) and URLs without the fragment are aliased to the hash they
+    were last seen with, so the namespace stage (which only has the URL
+    stored in the package DB) hits the ranges the crawl fetched. URLs never
+    seen with a hash (e.g. GitHub release assets) are keyed by URL.
+
+    Overlapping and adjacent ranges are merged into one row, and once the
+    cache grows past max_bytes the least recently used files are evicted.
+    Every thread gets its own connection and the DB is in WAL mode, so
+    many workers (threads or processes) can share one cache file.
+    """
+
+    def __init__(self, db_path="range_cache.sqlite", max_bytes=2 * 1024 ** 3):
+        self.db_path = db_path
+        self.max_bytes = max_bytes
+        self._local = threading.local()
+        db = self._connect()
+        db.execute("""
+            CREATE TABLE IF NOT EXISTS files (
+                key TEXT PRIMARY KEY,
+                length INTEGER,
+                size INTEGER,
+                last_access REAL,
+                last_modified TEXT
+            )
+        """)
+        # For caches from before the column: NULL is "not known", "" is "the server sent none"
+        if "last_modified" not in {row[1] for row in db.execute("PRAGMA table_info(files)")}:
+            db.execute("ALTER TABLE files ADD COLUMN last_modified TEXT")
+        db.execute("CREATE INDEX IF NOT EXISTS idx_files_last_access ON files(last_access)")
+        db.execute("""
+            CREATE TABLE IF NOT EXISTS urls (
+                url TEXT PRIMARY KEY,
+                key TEXT
+            )
+        """)
+        db.execute("""
+            CREATE TABLE IF NOT EXISTS ranges (
+                key TEXT,
+                start INTEGER,
+                end INTEGER,
+                data BLOB,
+                PRIMARY KEY (key, start)
+            )
+        """)
+
+    def _connect(self):
+        db = getattr(self._local, "db", None)
+        if db is None:
+            # Autocommit, so writes can take the lock up front with BEGIN IMMEDIATE
+            db = sqlite3.connect(self.db_path, timeout=60, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self._local.db = db
+        return db
+
+    def _key(self, db, url):
+        url, key = cache_key(url)
+        if key is None:
+            row = db.execute("SELECT key FROM urls WHERE url = ?", (url,)).fetchone()
+            key = row[0] if row else url
+        return key
+
+    def info(self, url):
+        """Return the total length and the Last-Modified ("" if the server
+        sent none, None if not known) of the file at url, if it's cached."""
+        db = self._connect()
+        key = self._key(db, url)
+        row = db.execute("SELECT length, last_modified FROM files WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        # Coarse timestamps keep hits from turning into a write each
+        now = time.time()
+        db.execute("UPDATE files SET last_access = ? WHERE key = ? AND last_access < ?", (now, key, now - 60))
+        return row
+
+    def get(self, url, start, end):
+        """Return bytes start to end (inclusive) of url, or None unless all cached."""
+        db = self._connect()
+        row = db.execute("""
+            SELECT substr(data, ? - start + 1, ?)
+            FROM ranges
+            WHERE key = ? AND start <= ? AND end >= ?
+        """, (start, end - start + 1, self._key(db, url), start, end)).fetchone()
+        return None if row is None else row[0]
+
+    def put(self, url, length, start, data, last_modified=None):
+        """Store data found at offset start of url, a file of length bytes
+        (with the given Last-Modified, if known)."""
+        end = start + len(data) - 1
+        db = self._connect()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            bare_url, sha256 = cache_key(url)
+            key = self._key(db, url)
+            if sha256 is not None:
+                db.execute("INSERT OR REPLACE INTO urls (url, key) VALUES (?, ?)", (bare_url, key))
+
+            rows = db.execute("""
+                SELECT start, end, data FROM ranges
+                WHERE key = ? AND start <= ? AND end >= ?
+            """, (key, end + 1, start - 1)).fetchall()
+            merged_start = min([start] + [row[0] for row in rows])
+            merged_end = max([end] + [row[1] for row in rows])
+            merged = bytearray(merged_end - merged_start + 1)
+            for row_start, row_end, row_data in rows:
+                merged[row_start - merged_start:row_end - merged_start + 1] = row_data
+            merged[start - merged_start:end - merged_start + 1] = data
+
+            db.executemany(
+                "DELETE FROM ranges WHERE key = ? AND start = ?",
+                [(key, row[0]) for row in rows]
+            )
+            db.execute(
+                "INSERT INTO ranges (key, start, end, data) VALUES (?, ?, ?, ?)",
+                (key, merged_start, merged_end, merged)
+            )
+            added = len(merged) - sum(len(row[2]) for row in rows)
+            db.execute("""
+                INSERT INTO files (key, length, size, last_access, last_modified) VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT (key) DO UPDATE SET
+                    length = excluded.length,
+                    size = size + excluded.size,
+                    last_access = excluded.last_access,
+                    last_modified = COALESCE(excluded.last_modified, last_modified)
+            """, (key, length, added, time.time(), last_modified))
+            self._evict(db, keep=key)
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+
+    def _evict(self, db, keep):
+        (total,) = db.execute("SELECT COALESCE(SUM(size), 0) FROM files").fetchone()
+        if total <= self.max_bytes:
+            return
+        cursor = db.execute("SELECT key, size FROM files WHERE key != ? ORDER BY last_access", (keep,))
+        victims = []
+        for key, size in cursor:
+            victims.append((key,))
+            total -= size
+            if total <= self.max_bytes:
+                break
+        db.executemany("DELETE FROM ranges WHERE key = ?", victims)
+        db.executemany("DELETE FROM urls WHERE key = ?", victims)
+        db.executemany("DELETE FROM files WHERE key = ?", victims)
+
+    def close(self):
+        db = getattr(self._local, "db", None)
+        if db is not None:
+            db.close()
+            self._local.db = None
@@ -0,0 +1,158 @@
+"""Resolve import names to the distributions providing them.
+
+    python resolver.py [module ...]
+
+Prints the distributions (most popular first) for each module given, or
+for each line of stdin without any. The DB is `package_database.sqlite`,
+or the one in `DB_PATH`.
+
+    >>> from resolver import resolve
+    >>> resolve("google.cloud.storage.blob")
+    Resolution(module='google.cloud.storage.blob', prefix='google.cloud.storage', packages=('google-cloud-storage',), namespace=False)
+"""
+from functools import lru_cache
+import os
+import sys
+from typing import NamedTuple, Optional
+
+from package_database import PackageDatabase
+
+DB_PATH = os.getenv("DB_PATH", "package_database.sqlite")
+
+
+class Resolution(NamedTuple):
+    module: str
+    # The dotted prefix that matched, None if nothing did
+    prefix: Optional[str]
+    # Distribution names, best package_pos first
+    packages: tuple
+    # The module is a namespace, packages are everything that provides part of it
+    namespace: bool
+
+
+def module_parts(path):
+    """Return the names of the module at a prefix-style path ("a/b"), or
+    None if it isn't importable (top-level files, anchored paths, data dirs)."""
+    parts = path.split("/")
+    if parts and all(part.isidentifier() for part in parts):
+        return parts
+    return None
+
+
+class _Node:
+    __slots__ = ("children", "packages", "namespace", "contributors")
+
+    def __init__(self):
+        self.children = {}
+        self.packages = ()
+        self.namespace = False
+        self.contributors = None
+
+
+class Resolver:
+    """An in-memory trie of the DB's prefixes, over dotted module names.
+
+    Each node is one name segment, holding the packages with that prefix
+    (ranked by package_pos) and whether some package declares it as a
+    namespace package. A module resolves to the packages of its longest
+    matching prefix, except that a namespace's packages don't match below
+    it: `google.foo` doesn't resolve to whatever has a `google` prefix. A
+    namespace, or a module that is only a directory on the way to prefixes
+    (`azure.mgmt`), resolves to every package below it.
+    """
+
+    def __init__(self, ranked_prefixes, namespace_filepaths=()):
+        self.root = _Node()
+        self.package_pos = {}
+        ranked = {}
+        for prefix, package, package_pos in ranked_prefixes:
+            parts = module_parts(prefix)
+            if parts is None:
+                continue
+            self.package_pos.setdefault(package, package_pos)
+            ranked.setdefault(self._node(parts), []).append(package)
+        for node, packages in ranked.items():
+            node.packages = tuple(sorted(set(packages), key=self.package_pos.__getitem__))
+        for filepath in namespace_filepaths:
+            parts = module_parts(filepath.rpartition("/")[0])
+            if parts is not None:
+                self._node(parts).namespace = True
+
+    @classmethod
+    def from_database(cls, db):
+        return cls(db.iterate_ranked_prefixes(), db.get_namespace_filepaths())
+
+    def _node(self, parts):
+        node = self.root
+        for part in parts:
+            child = node.children.get(part)
+            if child is None:
+                child = node.children[part] = _Node()
+            node = child
+        return node
+
+    def resolve(self, module_name):
+        parts = module_name.split(".")
+        node = self.root
+        match = None
+        last = len(parts) - 1
+        for depth, part in enumerate(parts):
+            node = node.children.get(part)
+            if node is None:
+                break
+            if node.packages and (depth == last or not node.namespace):
+                match = depth, node
+        else:
+            if node.namespace or (match is None and node.children):
+                return Resolution(module_name, module_name, self._contributors(node), True)
+        if match is None:
+            return Resolution(module_name, None, (), False)
+        depth, node = match
+        prefix = module_name if depth == last else ".".join(parts[:depth + 1])
+        return Resolution(module_name, prefix, node.packages, False)
+
+    def resolve_many(self, module_names):
+        """Return {module: Resolution} for every name in module_names."""
+        resolve = self.resolve
+        return {module_name: resolve(module_name) for module_name in set(module_names)}
+
+    def _contributors(self, node):
+        if node.contributors is None:
+            packages = set()
+            stack = [node]
+            while stack:
+                current = stack.pop()
+                packages.update(current.packages)
+                stack.extend(current.children.values())
+            node.contributors = tuple(sorted(packages, key=self.package_pos.__getitem__))
+        return node.contributors
+
+
+@lru_cache(maxsize=None)
+def load(db_path=DB_PATH):
+    """Return the Resolver of db_path, built on the first call."""
+    db = PackageDatabase(db_path, read_only=True)
+    try:
+        return Resolver.from_database(db)
+    finally:
+        db.close()
+
+
+def resolve(module_name, db_path=DB_PATH):
+    return load(db_path).resolve(module_name)
+
+
+def resolve_many(module_names, db_path=DB_PATH):
+    return load(db_path).resolve_many(module_names)
+
+
+def main():
+    module_names = sys.argv[1:] or [line.strip() for line in sys.stdin if line.strip()]
+    resolutions = resolve_many(module_names)
+    for module_name in module_names:
+        resolution = resolutions[module_name]
+        print(f"{module_name}: {' '.join(resolution.packages) or '-'}")
+
+
+if __name__ == "__main__":
+    main()
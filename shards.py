@@ -0,0 +1,67 @@
+"""Split a crawl across processes or machines, and merge the results.
+
+    SHARDS=8 SHARD=3 python main.py
+    python shards.py merge package_database.shard-*-of-8.sqlite
+
+Each shard crawls the packages of packages.txt that hash to it (with the
+package_pos of the full list) into its own DB, and stops there: the
+namespace check of a duplicate `__init__.py` needs every package that
+has it, so that stage and the prefixes wait for the merge. `merge` copies
+the shard DBs into DB_PATH, in the order given, and then runs main.py
+over the merged DB, which crawls whatever a shard failed to and does the
+namespace and prefix stages for everything.
+"""
+import hashlib
+import os
+import sys
+
+from package_database import PackageDatabase
+
+DB_PATH = os.getenv("DB_PATH", "package_database.sqlite")
+
+
+def _jump_hash(key, buckets):
+    """Lamping and Veach's jump consistent hash: going from n to n + 1
+    buckets only moves 1/(n + 1) of the keys, all of them to the new one."""
+    bucket, j = -1, 0
+    while j < buckets:
+        bucket = j
+        key = (key * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+        j = int((bucket + 1) * ((1 << 31) / ((key >> 33) + 1)))
+    return bucket
+
+
+def shard_of(package_name, shards):
+    """Return the shard (0 to shards - 1) a normalized package name belongs to."""
+    key = int.from_bytes(hashlib.blake2b(package_name.encode(), digest_size=8).digest(), "little")
+    return _jump_hash(key, shards)
+
+
+def shard_path(db_path, shard, shards):
+    """package_database.sqlite -> package_database.shard-3-of-8.sqlite"""
+    stem, ext = os.path.splitext(db_path)
+    return f"{stem}.shard-{shard}-of-{shards}{ext}"
+
+
+def merge(db_path, shard_paths, compact=False):
+    db = PackageDatabase(db_path, compact=compact)
+    db.create_tables()
+    for path in shard_paths:
+        print(f"merged {db.merge_shard(path)} packages from {path}")
+    db.close()
+
+
+def main():
+    if sys.argv[1:2] != ["merge"] or len(sys.argv) < 3:
+        sys.exit(__doc__)
+    # Imported only now, main reads its settings on import
+    import main
+
+    if main.SHARDS > 1:
+        sys.exit("unset SHARDS to merge, the merged DB is crawled and finished as a whole")
+    merge(DB_PATH, sys.argv[2:], main.COMPACT_FILEPATHS)
+    main.main()
+
+
+if __name__ == "__main__":
+    main()
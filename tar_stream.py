@@ -0,0 +1,122 @@
+import tarfile
+import zlib
+
+BLOCK_SIZE = tarfile.BLOCKSIZE
+# Most decompressed bytes held at once, however well the sdist compresses
+MAX_INFLATE = 64 * 1024
+
+
+class TarGzScanner:
+    """Incremental scanner picking members out of a .tar.gz as it downloads.
+
+    Feed it the raw (compressed) bytes in whatever chunks they arrive; it
+    inflates them a bounded piece at a time, walks the tar headers in
+    stream order and keeps only the content of the wanted members, so a
+    scan needs about one block of buffer plus the wanted files no matter
+    how big the sdist is. Once done is True the rest of the download can
+    be dropped.
+
+        scanner = TarGzScanner(filepaths)
+        for chunk in response.iter_bytes():
+            found.extend(scanner.feed(chunk))
+            if scanner.done:
+                break
+    """
+
+    def __init__(self, wanted):
+        self.missing = set(wanted)
+        self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self._buffer = bytearray()
+        self._end_of_archive = False
+        # What the bytes after the current header are: None for the next
+        # header, else a (kind, member name, size, padded size) tuple
+        self._pending = None
+        self._long_name = None
+
+    @property
+    def done(self):
+        """Whether every wanted member was found, or the archive ended."""
+        return not self.missing or self._end_of_archive
+
+    def feed(self, data):
+        """Consume compressed bytes and return the wanted (name, content) found."""
+        found = []
+        while not self.done:
+            chunk = self._decompressor.decompress(data, MAX_INFLATE)
+            data = self._decompressor.unconsumed_tail
+            if self._decompressor.eof:
+                # Concatenated gzip members are a valid .gz too
+                data = self._decompressor.unused_data + data
+                self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            elif not chunk and not data:
+                break
+            self._buffer += chunk
+            found.extend(self._parse())
+        return found
+
+    def _parse(self):
+        found = []
+        while not self.done:
+            if self._pending is None:
+                if len(self._buffer) < BLOCK_SIZE:
+                    break
+                header = bytes(self._buffer[:BLOCK_SIZE])
+                del self._buffer[:BLOCK_SIZE]
+                self._pending = self._read_header(header)
+                continue
+
+            kind, name, size, padded = self._pending
+            if kind == "skip":
+                # Not wanted, so drop it without ever holding all of it
+                dropped = min(padded, len(self._buffer))
+                del self._buffer[:dropped]
+                padded -= dropped
+                self._pending = None if padded == 0 else (kind, name, size, padded)
+                if padded:
+                    break
+                continue
+
+            if len(self._buffer) < padded:
+                break
+            content = bytes(self._buffer[:size])
+            del self._buffer[:padded]
+            self._pending = None
+            if kind == "longname":
+                self._long_name = content.rstrip(b"\0").decode("utf-8", "surrogateescape")
+            elif kind == "pax":
+                self._long_name = _pax_path(content) or self._long_name
+            else:
+                self.missing.discard(name)
+                found.append((name, content))
+        return found
+
+    def _read_header(self, header):
+        if header.count(0) == BLOCK_SIZE:
+            self._end_of_archive = True
+            return None
+        info = tarfile.TarInfo.frombuf(header, "utf-8", "surrogateescape")
+        padded = -(-info.size // BLOCK_SIZE) * BLOCK_SIZE
+        if info.type == tarfile.GNUTYPE_LONGNAME:
+            return ("longname", None, info.size, padded)
+        if info.type == tarfile.XHDTYPE:
+            return ("pax", None, info.size, padded)
+
+        name, self._long_name = self._long_name or info.name, None
+        if info.isreg() and name in self.missing:
+            return ("member", name, info.size, padded)
+        return ("skip", name, info.size, padded) if padded else None
+
+
+def _pax_path(content):
+    """Return the path record of a pax extended header, if any."""
+    pos = 0
+    while pos < len(content):
+        length = content[pos:content.find(b" ", pos)]
+        if not length.isdigit():
+            break
+        record = content[pos:pos + int(length)]
+        key, _, value = record[len(length) + 1:].rstrip(b"\n").partition(b"=")
+        if key == b"path":
+            return value.decode("utf-8", "surrogateescape")
+        pos += int(length)
+    return None